@@ -0,0 +1,273 @@
+'''Load test of the Socket.IO server with the simulation driver.
+
+A server is started in a subprocess with the simulation config loaded, then for each
+load level a number of python-socketio clients connect. Up to one client per valve
+drives commands at a fixed rate on a valve of its own, alternating `openValves` and
+`toggleValve` so that every command changes the valve. Every client, drivers and
+observers, records when the `state` delta of each change arrives and resyncs with
+`stateSync` once per second, as a reconnecting browser would.
+
+A delta can repeat changes that another delta already carried, so a command counts as
+delivered to a client at the first frame that shows its valve in the state the command
+set, and latency is measured from the command to that frame reaching each client. A driver sends its next command once
+the previous one was broadcast back to it and the next send time is reached, so the
+achieved command rate falls below the target when the server saturates.
+
+Reports per load level: command throughput, broadcast frames delivered per second,
+command to own broadcast and command to every client latency percentiles, resync
+round trip percentiles, lost commands and server threads, plus the server side latency
+histograms of /metrics.json. The report is written as JSON and can be compared with a
+report of another release.
+
+Every client runs in this process, so at high client counts latencies include
+contention between clients. Compare reports taken on the same machine.
+
+Requires requests and websocket-client, the benchmarks extra, and uses the server
+helpers of socket_modes.py.
+
+    python benchmarks/socket_load.py --clients 1 10 50 --rates 5 20 --report load.json
+    python benchmarks/socket_load.py --baseline load.json
+'''
+import argparse
+import importlib.metadata
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+from datetime import datetime, timezone
+from time import perf_counter, sleep
+
+import requests
+import socketio
+
+from socket_modes import freePort, serverThreads, startServer
+
+SYNC_INTERVAL = 1
+COMMAND_TIMEOUT = 5
+
+
+def percentiles(samples):
+    """Returns count and p50, p95, p99 and max in milliseconds."""
+    if not samples:
+        return {'count': 0, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None, 'max_ms': None}
+    samples = sorted(samples)
+    at = lambda q: 1000 * samples[math.ceil(q * len(samples)) - 1]  # Nearest rank
+    return {'count': len(samples), 'p50_ms': 1000 * statistics.median(samples), 'p95_ms': at(0.95), 'p99_ms': at(0.99), 'max_ms': 1000 * samples[-1]}
+
+
+class LoadRun():
+    """Commands sent during a load level and the broadcasts that answered them."""
+
+    def __init__(self, valves):
+        self.bits = {valve: 1 << index for index, valve in enumerate(valves)}
+        self.lock = threading.Lock()
+        self.sent = {}  # Valve to send times of its commands, in order
+        self.owner = {}  # Valve to the client driving it
+        self.seen = {}  # (client, valve) to [commands delivered, seq of the last frame that showed the valve]
+        self.own = {'openValves': [], 'toggleValve': []}  # Latency from command to the broadcast reaching its sender
+        self.fanout = []  # Latency from command to the broadcast reaching any client
+        self.sync = []  # Round trips of stateSync
+        self.frames = 0
+
+    def drive(self, client, valve):
+        self.sent[valve] = []
+        self.owner[valve] = client
+
+    def send(self, valve):
+        with self.lock:
+            self.sent[valve].append(perf_counter())
+            return len(self.sent[valve]) - 1
+
+    def received(self, client, frame, t_arrival):
+        if 'changed' not in frame:
+            return
+        changed = int(frame['changed'], 16)
+        open_mask = int(frame['open'], 16)
+        with self.lock:
+            self.frames += 1
+            for valve, sent in self.sent.items():
+                if not changed & self.bits[valve]:
+                    continue
+                seen = self.seen.setdefault((client, valve), [0, -1])
+                index = seen[0]
+                if frame['seq'] < seen[1] or index >= len(sent):
+                    continue  # Frame older than one already applied, or a change this run did not send
+                seen[1] = frame['seq']
+                if bool(open_mask & self.bits[valve]) != (index % 2 == 0):
+                    continue  # Repeats the state of an earlier command, even commands open
+                seen[0] = index + 1
+                latency = t_arrival - sent[index]
+                self.fanout.append(latency)
+                if self.owner[valve] is client:
+                    self.own['openValves' if index % 2 == 0 else 'toggleValve'].append(latency)
+                    client.answered.set()
+
+    def lost(self):
+        with self.lock:
+            return sum(len(sent) - self.seen.get((self.owner[valve], valve), [0])[0] for valve, sent in self.sent.items())
+
+
+class LoadClient():
+    """Socket.IO client that drives a valve or only observes, and resyncs periodically."""
+
+    def __init__(self, url, run):
+        self.run = run
+        self.seq = -1
+        self.answered = threading.Event()
+        self.client = socketio.Client(reconnection=False)
+        self.client.on('state', self.onState)
+        self.client.connect(url, transports=['websocket'], wait_timeout=10)
+
+    def onState(self, frame):
+        self.run.received(self, frame, perf_counter())
+        self.seq = max(self.seq, frame['seq'])
+
+    def syncState(self):
+        t_start = perf_counter()
+        frame = self.client.call('stateSync', {'seq': self.seq}, timeout=COMMAND_TIMEOUT)
+        self.run.sync.append(perf_counter() - t_start)
+        self.seq = max(self.seq, frame['seq'])
+
+    def command(self, valve):
+        """Change a valve and wait until the change is broadcast back. Valves start closed."""
+        self.answered.clear()
+        if self.run.send(valve) % 2 == 0:
+            self.client.emit('openValves', {'valves': [valve]})
+        else:
+            self.client.emit('toggleValve', {'valve': valve})
+        self.answered.wait(COMMAND_TIMEOUT)
+
+    def loop(self, valve, rate, t_end):
+        """Send commands on valve at rate per second until t_end, resyncing every SYNC_INTERVAL seconds.
+
+        Observers pass valve None and only resync.
+        """
+        t_next = t_sync = perf_counter()
+        while True:
+            now = perf_counter()
+            if now >= t_end:
+                break
+            if now >= t_sync:
+                t_sync += SYNC_INTERVAL
+                self.syncState()
+            elif valve is not None and now >= t_next:
+                self.command(valve)
+                t_next = max(t_next + 1 / rate, perf_counter())  # A slow server lowers the rate instead of queueing a burst
+            else:
+                sleep(min(t_sync, t_end) - now if valve is None else min(t_next, t_sync, t_end) - now)
+
+
+def level(url, server_pid, valves, clients, rate, duration):
+    run = LoadRun(valves)
+    requests.post(url + '/valveStates', json={'states': dict.fromkeys(valves, 'closed')}, timeout=5)
+    requests.get(url + '/latency', params={'reset': 1}, timeout=5)
+    connected = []
+    try:
+        for _ in range(clients):
+            connected.append(LoadClient(url, run))
+        drivers = dict(zip(connected, valves))
+        for client, valve in drivers.items():
+            run.drive(client, valve)
+        sleep(0.5)
+        t_start = perf_counter()
+        t_end = t_start + duration
+        threads = [threading.Thread(target=client.loop, args=(drivers.get(client), rate, t_end)) for client in connected]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - t_start
+        server_threads = serverThreads(server_pid)  # While every client is still connected
+        sleep(1)  # Broadcasts in flight
+        server = requests.get(url + '/metrics.json', timeout=5).json()
+    finally:
+        for client in connected:
+            client.client.disconnect()
+    commands = sum(len(sent) for sent in run.sent.values())
+    return {'clients': len(connected),
+            'drivers': len(drivers),
+            'target_rate': rate * len(drivers),
+            'throughput': commands / elapsed,
+            'frames_per_s': run.frames / elapsed,
+            'lost': run.lost(),
+            'server_threads': server_threads,
+            'command': {op: percentiles(samples) for op, samples in run.own.items()},
+            'broadcast': percentiles(run.fanout),
+            'sync': percentiles(run.sync),
+            'server_latency': [entry for entry in server['latency'] if entry['hop'] in ['model', 'write']]}
+
+
+def version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        try:
+            return importlib.metadata.version('plfluidics')
+        except importlib.metadata.PackageNotFoundError:
+            return 'unknown'
+
+
+def printLevel(result, baseline=None):
+    def ms(value):
+        return f'{value:>8.2f}' if value is not None else f'{"-":>8}'
+    line = (f'{result["clients"]:>7} {result["target_rate"]:>7.0f} {result["throughput"]:>7.1f} {result["frames_per_s"]:>9.0f} '
+            f'{ms(result["broadcast"]["p50_ms"])} {ms(result["broadcast"]["p99_ms"])} {ms(result["sync"]["p50_ms"])} '
+            f'{ms(result["sync"]["p99_ms"])} {result["lost"]:>5}')
+    if baseline and baseline['broadcast']['p99_ms'] and result['broadcast']['p99_ms']:
+        line += (f'  p99 x{result["broadcast"]["p99_ms"] / baseline["broadcast"]["p99_ms"]:.2f},'
+                 f' throughput x{result["throughput"] / baseline["throughput"]:.2f}')
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='threading', help='Async mode of the server')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--rates', type=float, nargs='+', default=[5, 20], help='Commands per second of each driving client')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per load level')
+    parser.add_argument('--report', default='socket_load_report.json', help='Path of the JSON report')
+    parser.add_argument('--baseline', help='Report of another release to compare with')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(result['clients'], result['target_rate']): result for result in json.load(f)['levels']}
+
+    report = {'version': version(),
+              'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'mode': args.mode,
+              'duration_s': args.duration,
+              'levels': []}
+    port = freePort()
+    with tempfile.TemporaryDirectory() as log_dir:
+        server, url = startServer(args.mode, port, log_dir)
+        try:
+            probe = socketio.Client(reconnection=False)
+            probe.connect(url, transports=['websocket'], wait_timeout=10)
+            valves = probe.call('stateSnapshot', {}, timeout=COMMAND_TIMEOUT)['valves']
+            probe.disconnect()
+            print(f'{report["version"]} {args.mode}, {len(valves)} valves, {args.duration:.0f} s per level')
+            print(f'{"clients":>7} {"target":>7} {"cmd/s":>7} {"frames/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"sync p50":>8} {"sync p99":>8} {"lost":>5}')
+            for clients in args.clients:
+                for rate in args.rates:
+                    result = level(url, server.pid, valves, clients, rate, args.duration)
+                    report['levels'].append(result)
+                    printLevel(result, baseline.get((result['clients'], result['target_rate'])))
+        finally:
+            server.terminate()
+            server.wait()
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f'Report written to {args.report}')
+
+
+if __name__ == '__main__':
+    main()
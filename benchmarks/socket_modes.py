@@ -0,0 +1,157 @@
+'''Compare Socket.IO async modes of the server with many observing browsers.
+
+For each async mode a server is started in a subprocess with the simulation config
+loaded. Observers connect with python-socketio clients, then one client toggles a
+valve repeatedly and every observer records when the `state` broadcast arrives. Then
+the client runs a short script and every observer waits for the `stop` event, so the
+script engine and processor threads are exercised in each mode.
+
+Reports connection time, connected observers, server thread count, broadcast latency
+from the toggle request to each observer, script run time and the fraction of observers
+that received the end of the script. Every observer runs in this process,
+so absolute latencies include contention between clients and are best compared
+between modes.
+
+Requires the optional packages of each mode (eventlet, gevent) plus requests and
+websocket-client for the clients, i.e. the eventlet, gevent and benchmarks extras.
+
+    python benchmarks/socket_modes.py --observers 50 --toggles 50
+'''
+import argparse
+import importlib.util
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+
+import requests
+import socketio
+
+SERVER = '''
+from plfluidics.app import createApp, socketio
+app = createApp()
+socketio.run(app, host='127.0.0.1', port={port}, debug=False, use_reloader=False, log_output=False, allow_unsafe_werkzeug=True)
+'''
+CONFIG = 'simulation_phage_ip_rev_e.config'
+VALVE = 'in'
+SCRIPT = 'open in\nwait 100 ms\nclose in\nopen out\nwait 100 ms\nclose out\n'
+SCRIPT_TIMEOUT = 10
+
+
+def freePort():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serverThreads(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                return int(line.split()[1])
+    return None
+
+
+def startServer(mode, port, log_dir):
+    env = dict(os.environ, PLFLUIDICS_ASYNC_MODE=mode)
+    server = subprocess.Popen([sys.executable, '-c', SERVER.format(port=port)], env=env, cwd=log_dir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.post(url + '/configLoad', data={'item_selected': CONFIG}, timeout=5)
+            return server, url
+        except requests.ConnectionError:
+            sleep(0.1)
+    server.kill()
+    raise RuntimeError(f'Server in {mode} mode did not start.')
+
+
+class Observer():
+    """Client that records the arrival time of every valve broadcast and of the script end."""
+
+    def __init__(self, url):
+        self.client = socketio.Client(reconnection=False)
+        self.arrivals = []
+        self.stopped = threading.Event()
+        self.client.on('state', self.onValve)
+        self.client.on('stop', self.stopped.set)
+        self.client.connect(url, transports=['websocket'], wait_timeout=10)
+
+    def onValve(self, data):
+        self.arrivals.append(perf_counter())
+
+
+def benchmark(mode, observers, toggles, interval):
+    port = freePort()
+    with tempfile.TemporaryDirectory() as log_dir:
+        server, url = startServer(mode, port, log_dir)
+        clients = []
+        try:
+            t_start = perf_counter()
+            for _ in range(observers):
+                try:
+                    clients.append(Observer(url))
+                except socketio.exceptions.ConnectionError:
+                    break
+            t_connect = perf_counter() - t_start
+            sleep(0.5)
+            threads = serverThreads(server.pid)
+            sent = []
+            driver = clients[0].client
+            for _ in range(toggles):
+                sent.append(perf_counter())
+                driver.emit('toggleValve', {'valve': VALVE})
+                sleep(interval)
+            sleep(1)
+            latencies = []
+            for client in clients:
+                latencies += [arrival - t_sent for t_sent, arrival in zip(sent, client.arrivals)]
+            received = sum(len(client.arrivals) for client in clients)
+            t_script = perf_counter()
+            driver.emit('play-pause', {'panel_text': SCRIPT})
+            script_s = perf_counter() - t_script if clients[0].stopped.wait(SCRIPT_TIMEOUT) else float('nan')
+            stopped = sum(client.stopped.wait(1) for client in clients)
+        finally:
+            server.terminate()
+            server.wait()
+            for client in clients:
+                client.client.disconnect()
+    latencies.sort()
+    return {'mode': mode,
+            'observers': len(clients),
+            'connect_s': t_connect,
+            'threads': threads,
+            'received': received / (toggles * max(len(clients), 1)),
+            'script_s': script_s,
+            'stopped': stopped / max(len(clients), 1),
+            'p50_ms': 1000 * statistics.median(latencies) if latencies else float('nan'),
+            'p99_ms': 1000 * latencies[int(0.99 * (len(latencies) - 1))] if latencies else float('nan'),
+            'max_ms': 1000 * latencies[-1] if latencies else float('nan')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', nargs='+', default=['threading', 'eventlet', 'gevent'])
+    parser.add_argument('--observers', type=int, default=50)
+    parser.add_argument('--toggles', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.02, help='Seconds between valve toggles')
+    args = parser.parse_args()
+
+    print(f'{"mode":<10} {"observers":>9} {"connect s":>9} {"threads":>7} {"received":>8} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8} {"script s":>8} {"stopped":>7}')
+    for mode in args.modes:
+        if mode != 'threading' and importlib.util.find_spec(mode) is None:
+            print(f'{mode:<10} not installed')
+            continue
+        result = benchmark(mode, args.observers, args.toggles, args.interval)
+        print(f'{result["mode"]:<10} {result["observers"]:>9} {result["connect_s"]:>9.2f} {result["threads"]:>7} '
+              f'{result["received"]:>8.0%} {result["p50_ms"]:>8.2f} {result["p99_ms"]:>8.2f} {result["max_ms"]:>8.2f} '
+              f'{result["script_s"]:>8.2f} {result["stopped"]:>7.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,28 @@
 Purpose:
 
 Create an application that listens for commands on a specified port. Commands are used to operate a microfluidic controller or provide status information.
+
+The Socket.IO server runs in the mode named by the PLFLUIDICS_ASYNC_MODE environment
+variable. 'threading' (default) serves every browser from its own thread. 'eventlet' and
+'gevent' serve browsers and run the controller's background tasks as green threads, so
+many observers can watch a running device. Green modes patch the standard library and
+must be selected before the application is imported.
 """
-#import eventlet
-#eventlet.monkey_patch()
+import os
+ASYNC_MODES = ['threading', 'eventlet', 'gevent']
+ASYNC_MODE = os.environ.get('PLFLUIDICS_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE not in ASYNC_MODES:
+    raise ValueError(f'PLFLUIDICS_ASYNC_MODE must be one of {ASYNC_MODES}. Received: {ASYNC_MODE}')
 from flask import Flask
 from flask_socketio import SocketIO
 import logging
 from logging.handlers import TimedRotatingFileHandler
-import os
 from plfluidics.server.controller import MicrofluidicController
 
 
@@ -31,10 +45,11 @@ def createApp():
     logger.addHandler(handler_file)
 
     app_server = Flask(__name__)
-    #socketio.init_app(app_server, cors_allowed_origins="*", async_mode='eventlet')
-    socketio.init_app(app_server, cors_allowed_origins="*", async_mode='threading')
-    ctrl = MicrofluidicController(app_server, socketio, log_file_handler=handler_file)
+    socketio.init_app(app_server, cors_allowed_origins="*", async_mode=ASYNC_MODE)
+    ctrl = MicrofluidicController(app_server, socketio, log_file_handler=handler_file, script_cache_dir=os.path.join(ndir, 'script_cache'),
+                                 journal_dir=os.path.join(ndir, 'journal'))
     ctrl.logger.info(f'Log file location: {log_loc}')
+    ctrl.logger.info(f'Socket.IO async mode: {socketio.async_mode}')
 
     app_server.static_folder = ctrl.templatesDir()
     app_server.template_folder = ctrl.templatesDir()
@@ -55,14 +70,30 @@ def createApp():
     app_server.add_url_rule('/loadScript', view_func=ctrl.scriptLoad, methods=['POST'])
     app_server.add_url_rule('/saveScript', view_func=ctrl.scriptSave, methods=['POST'])
     # Media
+    socketio.on_event('connect', ctrl.logConnect)
+    socketio.on_event('disconnect', ctrl.logDisconnect)
     socketio.on_event('poll', ctrl.poll)
     socketio.on_event('play-pause',ctrl.scriptToggle)
     socketio.on_event('skip', ctrl.scriptSkip)
+    socketio.on_event('seek', ctrl.scriptSeek)
+    socketio.on_event('validateScript', ctrl.scriptValidate)
     app_server.add_url_rule('/stopScript', view_func=ctrl.scriptStop, methods=['POST'])
+    app_server.add_url_rule('/scriptTiming', view_func=ctrl.scriptTiming, methods=['GET'])
+    app_server.add_url_rule('/scriptWindow', view_func=ctrl.scriptWindow, methods=['GET'])
+    app_server.add_url_rule('/scriptProgress', view_func=ctrl.scriptProgress, methods=['GET'])
+    app_server.add_url_rule('/simulateScript', view_func=ctrl.scriptSimulate, methods=['POST'])
+    app_server.add_url_rule('/latency', view_func=ctrl.latencyGet, methods=['GET'])
+    app_server.add_url_rule('/metrics', view_func=ctrl.metricsGet, methods=['GET'])
+    app_server.add_url_rule('/metrics.json', view_func=ctrl.metricsJson, methods=['GET'])
+    app_server.add_url_rule('/logHistory', view_func=ctrl.logHistoryGet, methods=['GET'])
     # Valves
     socketio.on_event('toggleValve', ctrl.valveToggle)
     socketio.on_event('openValves',ctrl.valveOpenList)
     socketio.on_event('closeValves', ctrl.valveCloseList)
+    socketio.on_event('setValveStates', ctrl.valveStatesSet)
+    socketio.on_event('stateSnapshot', ctrl.stateSnapshot)
+    socketio.on_event('stateSync', ctrl.stateSync)
+    app_server.add_url_rule('/valveStates', view_func=ctrl.valveStates, methods=['GET', 'POST'])
 
     return app_server
 
@@ -0,0 +1,121 @@
+'''Peristaltic pumping with on-chip valves.'''
+import logging
+import threading
+from time import perf_counter, sleep
+
+logger = logging.getLogger(__name__)
+
+
+class PeristalticPump():
+    """Drives a sequence of valves through an N-phase peristaltic pattern.
+
+    A pump cycle has 2N phases. Valve i is closed for N consecutive phases starting at
+    phase 2i, which produces the standard 101, 100, 110, 010, 011, 001 pattern for three
+    valves (1 = closed). Exactly one valve changes state per phase.
+
+    Phases are scheduled from a dedicated thread against a monotonic timeline so that
+    the pump keeps its rate while the script engine and controller continue working.
+
+    Attributes
+    ----------
+    valves: list        - Valve aliases in pumping order
+    frequency: float    - Requested pump cycles per second
+    on_phase: callable  - Optional, called with (opened, closed) valve lists after each phase is written
+
+    Methods
+    -------
+    start()             - Start pumping in a background thread
+    stop()              - Stop pumping and wait for the thread to finish
+    statusGet()         - Returns requested and achieved frequency
+    """
+
+    def __init__(self, valve_controller, valves, frequency, on_phase=None):
+        """
+        Parameters
+        ----------
+        valve_controller: ValveController   - Controller that owns the valves
+        valves: list                        - Valve aliases in pumping order, at least 3
+        frequency: float                    - Pump cycles per second
+        on_phase: callable                  - Called from the pump thread with the valves each phase opened and closed
+        """
+        if len(valves) < 3:
+            raise ValueError(f'Peristaltic pump requires at least 3 valves. Received: {valves}')
+        if frequency <= 0:
+            raise ValueError(f'Pump frequency must be positive. Received: {frequency}')
+        self.controller = valve_controller
+        self.valves = list(valves)
+        self.frequency = frequency
+        self.on_phase = on_phase
+        self.phases = self.phaseTable(len(self.valves))
+        self.time_spin = 0.002
+        self.steps = 0
+        self.time_start = 0
+        self.time_last = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def phaseTable(n):
+        """Returns list of 2n phases, each a list of n closed (True) / open (False) valve states."""
+        phases = []
+        for phase in range(2 * n):
+            phases.append([((phase - 2 * valve) % (2 * n)) < n for valve in range(n)])
+        return phases
+
+    def start(self):
+        logger.info(f'Starting pump. Valves: {self.valves}, Frequency: {self.frequency} Hz')
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def statusGet(self):
+        elapsed = self.time_last - self.time_start
+        achieved = self.steps / len(self.phases) / elapsed if elapsed > 0 else 0
+        return {'valves': self.valves,
+                'frequency': self.frequency,
+                'achieved': achieved,
+                'cycles': self.steps // len(self.phases),
+                'running': self._thread is not None}
+
+    def _setPhase(self, phase, previous=None):
+        opened, closed_list = [], []
+        for valve, closed, was_closed in zip(self.valves, phase, previous or [None] * len(phase)):
+            if closed == was_closed:
+                continue
+            if closed:
+                self.controller.setValveClose(valve)
+                closed_list.append(valve)
+            else:
+                self.controller.setValveOpen(valve)
+                opened.append(valve)
+        if self.on_phase is not None:
+            self.on_phase(opened, closed_list)
+
+    def _run(self):
+        period = 1 / (self.frequency * len(self.phases))
+        self.steps = 0
+        self.time_start = perf_counter()
+        self.time_last = self.time_start
+        self._setPhase(self.phases[0])
+        while True:
+            step = self.steps + 1
+            deadline = self.time_start + step * period
+            remaining = deadline - perf_counter()
+            if remaining > self.time_spin:
+                if self._stop_event.wait(remaining - self.time_spin):
+                    break
+            elif self._stop_event.is_set():
+                break
+            while perf_counter() < deadline:
+                sleep(0)
+            index = step % len(self.phases)
+            self._setPhase(self.phases[index], self.phases[index - 1])
+            self.time_last = perf_counter()
+            self.steps = step
@@ -74,6 +74,12 @@ class Valve():
     def _writeState(self, output):
         pass
 
+    def _stageState(self, operation):
+        '''Record the desired state and return the output for a controller that writes several valves at once.'''
+        output = self.polarity^operation
+        self._state = operation
+        return output
+
 
 class ValveRGS(Valve):
     """Valve class for the USB valve controller in the R.G-S. design.
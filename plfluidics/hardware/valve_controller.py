@@ -1,4 +1,6 @@
 import logging
+import threading
+from time import perf_counter
 import ftd2xx
 from ft4222 import FT2XXDeviceError
 from plfluidics.drivers.ft4222_hub import FT4222Hub
@@ -21,6 +23,7 @@ class ValveController():
     getValvesStates()       - Returns list of valve states
     setValvesOpen(list)     - Sets valve addresses in list to open
     setValvesClosed(list)   - Sets valve addresses in list to closed
+    setValvesState(list, list) - Opens and closes valves in a single transaction
     """
 
     def __init__(self, valve_param_list):
@@ -34,24 +37,57 @@ class ValveController():
                                    [addrN, polN, stateN, alias (optional)]]
         """
         self.valve_dict = {}
+        self.lock = threading.RLock()  # Serializes writes from script, pump and user threads
+        self.latency = None  # Optional function(hop, op, seconds) that records lock and write durations
         self._initValveBanks(valve_param_list)
         self._initValves(valve_param_list)
 
     def setValveOpen(self, valve):
-        self.valve_dict[valve].open()
+        t_request = perf_counter()
+        with self.lock:
+            t_write = perf_counter()
+            self.valve_dict[valve].open()
+            t_done = perf_counter()
+        if self.latency:
+            self.latency('lock', 'open', t_write - t_request)
+            self.latency('write', 'open', t_done - t_write)
         logger.info('Valve set to open - {}'.format(valve))
 
     def setValvesOpen(self, valve_list: list):
-        for valve in valve_list:
-            self.setValveOpen(valve)
+        self.setValvesState(open_list=valve_list)
 
     def setValveClose(self, valve):
-        self.valve_dict[valve].close()
+        t_request = perf_counter()
+        with self.lock:
+            t_write = perf_counter()
+            self.valve_dict[valve].close()
+            t_done = perf_counter()
+        if self.latency:
+            self.latency('lock', 'close', t_write - t_request)
+            self.latency('write', 'close', t_done - t_write)
         logger.info('Valve set to closed - {}'.format(valve))
 
     def setValvesClose(self, valve_list: list):
-        for valve in valve_list:
-            self.setValveClose(valve)
+        self.setValvesState(close_list=valve_list)
+
+    def setValvesState(self, open_list=(), close_list=()):
+        """Open and close several valves as one transaction.
+
+        Drivers that can address several valves per write group the valves so that
+        they actuate together instead of one write apart.
+        """
+        for valve in list(open_list) + list(close_list):
+            if valve not in self.valve_dict:
+                raise KeyError(f'Valve not in controller: {valve}')
+        t_request = perf_counter()
+        with self.lock:
+            t_write = perf_counter()
+            self._writeValves(open_list, close_list)
+            t_done = perf_counter()
+        if self.latency:
+            self.latency('lock', 'valves', t_write - t_request)
+            self.latency('write', 'valves', t_done - t_write)
+        logger.info('Valves set - open: {}, closed: {}'.format(list(open_list), list(close_list)))
 
     def getValvesStates(self):
         states = []
@@ -60,6 +96,12 @@ class ValveController():
         logger.info('Valve states - {}'.format(states))
         return states
 
+    def _writeValves(self, open_list, close_list):
+        for valve in open_list:
+            self.valve_dict[valve].open()
+        for valve in close_list:
+            self.valve_dict[valve].close()
+
     def _initValves(self, valve_param_list):
         valve_number = 0
         for valve in valve_param_list:
@@ -111,6 +153,16 @@ class ValveControllerRGS(ValveController):
 
     def _valveConstructor(self, addr, pol, state):
         return ValveRGS(USB_device=self.device, address=addr,default_state=state, polarity_inverted=pol)
+
+    def _writeValves(self, open_list, close_list):
+        """Send the commands of every valve in one USB write."""
+        commands = []
+        for valve, operation in [(v, False) for v in open_list] + [(v, True) for v in close_list]:
+            valve_obj = self.valve_dict[valve]
+            output = valve_obj._stageState(operation)
+            commands.append(valve_obj._command('H' if output else 'L', valve_obj.address))
+        if commands:
+            self.device.write(b''.join(commands))
     
     
 class ValveControllerPLRD1(ValveController):
@@ -163,6 +215,20 @@ class ValveControllerPLRD1(ValveController):
             
         logger.info('PLRD1 device initialized.')
             
+    def _writeValves(self, open_list, close_list):
+        """Write the output enable register of each affected bank once."""
+        banks = {}
+        for valve, operation in [(v, False) for v in open_list] + [(v, True) for v in close_list]:
+            valve_obj = self.valve_dict[valve]
+            output = valve_obj._stageState(operation)
+            banks.setdefault(valve_obj.device, []).append((valve_obj._bit_mask, output))
+        for device, outputs in banks.items():
+            en = device.en
+            for bit_mask, output in outputs:
+                en = en | bit_mask if output else en & ~bit_mask
+            device.cmdWriteAddr(device.addr_en, en)
+            logger.debug('Valve bank set. {}'.format(en))
+
     def _valveConstructor(self, addr, pol, state):
         if addr < 8:
             return ValvePLRD1(USB_device=self.device['A'], address=addr,default_state=state, polarity_inverted=pol)
@@ -195,16 +261,6 @@ class ValveControllerFT425R(ValveController):
             
         logger.info('PLRD1 device initialized.')
             
-    def _valveConstructor(self, addr, pol, state):
-        if addr < 8:
-            return ValvePLRD1(USB_device=self.device['A'], address=addr,default_state=state, polarity_inverted=pol)
-        if addr < 16:
-            return ValvePLRD1(USB_device=self.device['B'], address=addr-8,default_state=state, polarity_inverted=pol)
-        if addr < 24:
-            return ValvePLRD1(USB_device=self.device['C'], address=addr-16,default_state=state, polarity_inverted=pol)
-        else:
-            raise ValueError(f'Address exceeds capacity of the system. Addr: {addr}')
-
     def _valveConstructor(self, addr, pol, state):
         return ValveRGS(USB_device=self.device, address=addr,default_state=state, polarity_inverted=pol)
 
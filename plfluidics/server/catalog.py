@@ -0,0 +1,119 @@
+'''In-memory catalog of the config and script files served by the application.
+'''
+import copy
+import os
+import threading
+from time import monotonic
+
+
+class FileCatalog():
+    """Names, metadata and content of the files in a directory, refreshed when the files change.
+
+    The directory is listed once and listed again when its modification time changes,
+    which happens when files are added, removed or renamed. File content is read on first
+    use and read again when the size or modification time of the file changes.
+    Modification times are checked at most every `check_interval` seconds, so repeated
+    page renders are served from memory.
+
+    Attributes
+    ----------
+    path: str               - Directory of the files
+    parse: function         - Optional function that converts file text into parsed content
+    check_interval: float   - Minimum seconds between checks of modification times
+    max_bytes: int          - Content of larger files is read from disk on every use instead of cached
+    entries: dict           - File name to {'size', 'mtime', 'checked', 'text', 'parsed'}
+
+    Methods
+    -------
+    names()                 - Returns sorted file names
+    info(name)              - Returns {'size', 'mtime'} of a file
+    read(name)              - Returns text of a file
+    parsed(name)            - Returns a copy of the parsed content of a file
+    invalidate(name)        - Check the directory, or a file, for changes on next use
+    """
+
+    def __init__(self, path, parse=None, check_interval=1, max_bytes=1 << 20):
+        self.path = str(path)
+        self.parse = parse
+        self.check_interval = check_interval
+        self.max_bytes = max_bytes
+        self.entries = {}
+        self._names = []
+        self._dir_mtime = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def names(self):
+        with self._lock:
+            self._refresh()
+            return list(self._names)
+
+    def info(self, name):
+        with self._lock:
+            entry = self._entry(name)
+            return {'size': entry['size'], 'mtime': entry['mtime']}
+
+    def read(self, name):
+        with self._lock:
+            return self._read(name, self._entry(name))
+
+    def parsed(self, name):
+        """Returns parsed content of a file. A copy is returned so that callers can modify it."""
+        with self._lock:
+            entry = self._entry(name)
+            if entry['parsed'] is None:
+                entry['parsed'] = self.parse(self._read(name, entry))
+            return copy.deepcopy(entry['parsed'])
+
+    def invalidate(self, name=None):
+        with self._lock:
+            self._checked = None
+            if name in self.entries:
+                self.entries[name]['checked'] = None
+
+    def _due(self, checked):
+        return checked is None or monotonic() - checked >= self.check_interval
+
+    def _refresh(self):
+        """List the directory again if files were added, removed or renamed."""
+        if not self._due(self._checked):
+            return
+        self._checked = monotonic()
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self._dir_mtime:
+            return
+        self._dir_mtime = mtime
+        entries = {}
+        with os.scandir(self.path) as scan:
+            for item in scan:
+                if item.name.startswith(('.', '__')) or not item.is_file():
+                    continue
+                entries[item.name] = self.entries.get(item.name) or self._newEntry(item.stat())
+        self.entries = entries
+        self._names = sorted(entries)
+
+    def _entry(self, name):
+        """Returns entry of a file, dropping cached content if the file changed."""
+        self._refresh()
+        if name not in self.entries:
+            raise FileNotFoundError(f'File not found: {name}')
+        entry = self.entries[name]
+        if self._due(entry['checked']):
+            stat = os.stat(os.path.join(self.path, name))
+            if (stat.st_size, stat.st_mtime_ns) != (entry['size'], entry['mtime']):
+                entry = self._newEntry(stat)
+                self.entries[name] = entry
+            entry['checked'] = monotonic()
+        return entry
+
+    def _read(self, name, entry):
+        if entry['text'] is not None:
+            return entry['text']
+        with open(os.path.join(self.path, name), 'r') as f:
+            text = f.read()
+        if entry['size'] <= self.max_bytes:
+            entry['text'] = text
+        return text
+
+    def _newEntry(self, stat):
+        return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'checked': monotonic(), 'text': None, 'parsed': None}
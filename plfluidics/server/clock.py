@@ -0,0 +1,67 @@
+'''Clocks that drive the script engine.
+
+The engine reads time and blocks for user commands through a clock object, so a
+script can run on the real monotonic clock or on a virtual clock that jumps straight
+to the next deadline.
+'''
+import math
+import queue
+from time import perf_counter, sleep
+
+
+class MonotonicClock():
+    """Real time clock based on perf_counter.
+
+    Methods
+    -------
+    now()               - Returns current time in seconds
+    get(q, timeout)     - Returns next item of queue, blocking up to timeout seconds (None blocks until available)
+    spinUntil(deadline) - Busy-wait until deadline, yielding to other threads between checks
+    """
+
+    def now(self):
+        return perf_counter()
+
+    def get(self, q, timeout=None):
+        return q.get(timeout=timeout)
+
+    def spinUntil(self, deadline):
+        while perf_counter() < deadline:
+            sleep(0)  # Keeps green threads cooperative when the server runs in an async mode
+
+
+class VirtualClock():
+    """Simulated clock that advances instantly instead of sleeping.
+
+    A timed `get` on an empty queue moves the clock forward by the timeout and raises
+    queue.Empty, so hours of waits are executed as fast as the engine can step.
+    An untimed `get` still blocks for another thread to submit a command.
+
+    Attributes
+    ----------
+    time: float         - Current virtual time in seconds
+    """
+
+    def __init__(self, start=0):
+        self.time = start
+
+    def now(self):
+        return self.time
+
+    def advance(self, seconds):
+        time = self.time + seconds
+        if seconds > 0 and time == self.time:  # Step smaller than float resolution
+            time = math.nextafter(self.time, math.inf)
+        self.time = time
+
+    def get(self, q, timeout=None):
+        try:
+            return q.get_nowait()
+        except queue.Empty:
+            if timeout is None:
+                return q.get()
+            self.advance(timeout)
+            raise
+
+    def spinUntil(self, deadline):
+        self.time = max(self.time, deadline)
@@ -1,26 +1,36 @@
 '''Controller in model-view-controller framework for microfluidic hardware control application.
 '''
 import json
+import functools
 import importlib.resources
+import os
 import queue
-import threading
 import logging
-import io
-from time import sleep
+from datetime import datetime
+from time import sleep, perf_counter
 from flask import request, render_template
 
 from plfluidics.server.models import ModelHardware, ModelConfig, ModelScript
+from plfluidics.server.script import ScriptCache, ScriptFile
+from plfluidics.server.simulation import ScriptSimulator
+from plfluidics.server.metrics import CounterMetrics, LatencyMetrics, TimedQueue, prometheusText
+from plfluidics.server.logstream import LogHistory, LogStream
+from plfluidics.server.catalog import FileCatalog
+from plfluidics.server import journal
+from plfluidics.server.journal import RunJournal
 
 
 class MicrofluidicController():
 
-    def __init__(self, flask_app, socketio_instance, log_level=logging.INFO, log_file_handler=None):
+    def __init__(self, flask_app, socketio_instance, log_level=logging.INFO, log_file_handler=None, script_cache_dir=None, log_rate=10, journal_dir=None):
         self.app = flask_app
         self.socketio = socketio_instance
         self.log_level = log_level
+        self.log_rate = log_rate  # Maximum log frames per second sent to each browser
+        self.log_stream = LogStream()
 
         self.userQ = queue.Queue()
-        self.scriptQ = queue.Queue()
+        self.scriptQ = TimedQueue()  # Items are stamped on submission for latency metrics
         self.logQ = queue.Queue()
 
         log_format = logging.Formatter('%(asctime)s - %(message)s', '%H:%M:%S')
@@ -31,19 +41,36 @@ class MicrofluidicController():
         self.log_queue.setLevel(self.log_level)
         self.log_queue.setFormatter(log_format)
 
-        self.log_var = io.StringIO()
-        log_var_handler = logging.StreamHandler(self.log_var)
-        log_var_handler.setFormatter(log_format)
-        log_var_handler.setLevel(self.log_level)
+        self.log_history = LogHistory()  # Most recent records, the page loads the tail and older pages on demand
+        self.log_history.setFormatter(log_format)
+        self.log_history.setLevel(self.log_level)
+        self.log_page = 200
 
         self.logger.addHandler(self.log_queue)
-        self.logger.addHandler(log_var_handler)
+        self.logger.addHandler(self.log_history)
         if log_file_handler is not None:
             self.logger.addHandler(log_file_handler)
 
+        # Compiled scripts outlive configuration changes, keys include the valve list
+        self.script_cache = ScriptCache(persist_dir=script_cache_dir)  # None keeps compiled scripts in memory only
+        self.latency = LatencyMetrics()
+        self.counters = CounterMetrics()  # Loop iterations, valve operations and emits, read from /metrics
+        self.t_started = perf_counter()
+        self.stream_bytes = 1 << 20  # Larger script files are streamed and previewed in pages
+        self.preview_lines = 200
+        self.journal_dir = journal_dir  # Directory of the binary journal written for each script run, None disables it
+        self.journal = None
+
+        # File lists and contents are served from memory and refreshed when the files change
+        self.catalogs = {'configs': FileCatalog(importlib.resources.files('plfluidics.server').joinpath('configs'), parse=json.loads),
+                         'scripts': FileCatalog(importlib.resources.files('plfluidics.server').joinpath('scripts'), max_bytes=self.stream_bytes)}
+
         self.reset()
 
     def reset(self):
+        if getattr(self, 'valve_model', None):
+            self.valve_model.pumpStop()
+        self.journalClose()
         self.userQ.queue.clear()
         self.scriptQ.queue.clear()
         self.logQ.queue.clear()
@@ -59,9 +86,9 @@ class MicrofluidicController():
         self.config_model = None
         self.script_model = None
 
-        self.valve_model = ModelHardware(logger_name='controller.valves')
+        self.valve_model = ModelHardware(logger_name='controller.valves', latency=self.latency, counters=self.counters, pump_phase=self.journalPump)
         self.config_model = ModelConfig(options=self.valve_model.optionsGet(), logger_name='controller.config')
-        self.script_model = ModelScript(self.userQ, self.scriptQ, valve_list=None, logger_name='controller.script')
+        self.script_model = ModelScript(self.userQ, self.scriptQ, valve_list=None, logger_name='controller.script', cache=self.script_cache, counters=self.counters)
 
         self.logger.debug('MicrofluidicController initialized.')
 
@@ -73,13 +100,41 @@ class MicrofluidicController():
     ############
 
     def logEmitter(self):
+        """Send log records to every connected browser in batched frames.
+
+        The emitter blocks until a record is logged, then drains every pending record.
+        Each browser is sent at most `log_rate` frames per second and acknowledges each
+        frame, and records for a browser that has not acknowledged its last frame wait in
+        its backlog of the LogStream.
+        """
+        interval = 1 / self.log_rate
         with self.app.app_context():
             while True:
+                self.counters.inc('loop_iterations', thread='logger')
+                records = []
                 try:
-                    msg = self.logQ.get(timeout=0.01)
-                    self.socketio.emit('log_msg', {'msg': msg})
+                    records.append(self.logQ.get(timeout=interval if self.log_stream.pending() else None))
+                    while True:
+                        records.append(self.logQ.get_nowait())
                 except queue.Empty:
-                    sleep(0.04)
+                    pass
+                self.log_stream.put(records)
+                self.counters.inc('log_records', len(records))
+                for sid, frame in self.log_stream.frames():
+                    self.emit('log_msgs', frame, to=sid, callback=functools.partial(self.log_stream.ack, sid))
+                sleep(interval)
+
+    def logHistoryGet(self):
+        """Returns a page of log records logged before the requested record number."""
+        before = request.args.get('before', default=self.log_history.count, type=int)
+        count = min(request.args.get('count', default=self.log_page, type=int), self.log_history.capacity)
+        return {'records': self.log_history.page(before, count), 'first': self.log_history.first()}
+
+    def logConnect(self, auth=None):
+        self.log_stream.connect(request.sid)
+
+    def logDisconnect(self, reason=None):
+        self.log_stream.disconnect(request.sid)
 
     ################
     # PAGE SERVICE #
@@ -106,12 +161,16 @@ class MicrofluidicController():
         if self.error:
             self.logger.warning(f'{self.error}')
         if not self.flag_thread_logger:
-            self.thread_logger = threading.Thread(target=self.logEmitter)
-            self.thread_logger.daemon = True
-            self.thread_logger.start()      
+            self.thread_logger = self.socketio.start_background_task(self.logEmitter)      
             self.flag_thread_logger = True
         page_name = self.valve_model.data['config']['device'] + '.html'
         valves = self.valve_model.data['server']['valve_states']
+        script = self.script_model.preview_text
+        log = self.log_history.tail(self.log_page)
+        script_first = 1
+        if self.script_model.script_file:
+            script_first, lines = self.script_model.script_file.window(self.script_model.line_count, self.preview_lines)
+            script = '\n'.join(lines)
         self.logger.debug(f'Control page: {page_name}')
         return render_template(page_name, 
                                valves = valves,
@@ -119,8 +178,12 @@ class MicrofluidicController():
                                script_selected = self.script_model.selected,
                                script_state = self.script_model.state,
                                script_processed = True if self.script_model.script else False,
-                               script = self.script_model.preview_text,
-                               log = self.log_var.getvalue())
+                               script = script,
+                               script_first = script_first,
+                               script_streamed = True if self.script_model.script_file else False,
+                               script_line_stopped = self.script_model.line_stopped,
+                               log = ''.join(record['msg'] + '\n' for record in log),
+                               log_first = log[0]['seq'] if log else self.log_history.count)
 
     ##########
     # CONFIG #
@@ -149,6 +212,7 @@ class MicrofluidicController():
             file_path = importlib.resources.files('plfluidics.server.configs').joinpath(file_name + '.config')
             with open(file_path, 'w') as f:
                 json.dump(config,f, indent=4)
+            self.catalogs['configs'].invalidate(file_name + '.config')
             self.logger.info(f'Configuration saved: {file_path}')
         except Exception as e:
             self.error = f'Error saving config. {e}'
@@ -164,7 +228,7 @@ class MicrofluidicController():
             else:
                 if not self.config_model.file_name:
                     self.config_model.file_name = request.form.get('item_selected')  
-                data = self.configRead(self.config_model.file_name)
+                data = self.catalogs['configs'].parsed(self.config_model.file_name)
                 self.logger.info(f'Loading configuration from file: {self.config_model.file_name}')
             config = self.config_model.processConfig(data)
             linear_config = self.config_model.configLinearize(config)
@@ -193,25 +257,23 @@ class MicrofluidicController():
     ##############
 
     def configRead(self, file_name):
-            file_path = importlib.resources.files('plfluidics.server.configs').joinpath(file_name)
-            self.logger.debug(f'Reading configuration: {file_path}')
-            with open(file_path, 'r') as f:
-                file_content = f.read()
-            return file_content
+        self.logger.debug(f'Reading configuration: {file_name}')
+        return self.catalogs['configs'].read(file_name)
 
     def scriptRead(self, file_name):
-            file_path = importlib.resources.files('plfluidics.server.scripts').joinpath(file_name)
-            self.logger.debug(f'Reading script: {file_path}')
-            with open(file_path, 'r') as f:
-                file_content = f.read()
-            return file_content
+        self.logger.debug(f'Reading script: {file_name}')
+        return self.catalogs['scripts'].read(file_name)
+
+    def scriptPath(self, file_name):
+        return importlib.resources.files('plfluidics.server.scripts').joinpath(file_name)
 
     def loadFileList(self, dir):
         self.logger.debug(f'Loading file list: {dir}')
+        file_list = []
         try:
-            file_list = list(importlib.resources.contents('plfluidics.server.' + dir))
+            file_list = self.catalogs[dir].names()
             if file_list == []:
-                raise ValueError(f"No config files found in: {importlib.resources.files('plfluidics.server.' + dir)}")
+                raise ValueError(f"No files found in: {self.catalogs[dir].path}")
         except Exception as e:
             self.error = e
         return file_list
@@ -240,10 +302,7 @@ class MicrofluidicController():
         self.logger.debug('Opening list of valves.')
         self.error = None
         try:
-            valves = data.get('valves')
-            for valve in valves:
-                if self.checkValveExists(valve):
-                    self.openValve(valve)
+            self.valveStatesApply(dict.fromkeys(data.get('valves'), 'open'))
         except Exception as e:
             self.error = f'Failed to open list of valves. {e}'
 
@@ -251,28 +310,114 @@ class MicrofluidicController():
         self.logger.debug('Closing list of valves.')
         self.error = None
         try:
-            valves = data.get('valves')
-            for valve in valves:
-                if self.checkValveExists(valve):
-                    self.closeValve(valve)
+            self.valveStatesApply(dict.fromkeys(data.get('valves'), 'closed'))
         except Exception as e:
             self.error = f'Failed to close list of valves. {e}'
 
+    def valveStatesSet(self, data):
+        """Socket event that sets valves to a complete or partial target state, e.g. {'states': {'in': 'open'}}.
+
+        Returns the valves that changed, or an error, to the requesting client.
+        """
+        self.logger.debug('Setting valve states.')
+        try:
+            opened, closed = self.valveStatesApply(data.get('states'))
+            return {'open': opened, 'close': closed}
+        except Exception as e:
+            self.logger.warning(f'Failed to set valve states. {e}')
+            return {'error': f'{e}'}
+
+    def valveStates(self):
+        """GET returns the state of every valve. POST sets valves to a target state like the `setValveStates` event."""
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            try:
+                opened, closed = self.valveStatesApply(data.get('states'))
+            except Exception as e:
+                self.logger.warning(f'Failed to set valve states. {e}')
+                return {'error': f'{e}'}, 400
+            return {'valve_states': self.valve_model.data['server']['valve_states'], 'open': opened, 'close': closed}
+        return {'valve_states': self.valve_model.data['server']['valve_states']}
+
     ###################
     # VALVE UTILITIES #
     ###################
 
     def openValve(self, valve):
         if self.valve_model.data['server']['valve_states'][valve] == 'closed':
+            base = self.valve_model.state_seq
             self.valve_model.openValve(valve)
+            self.journalValves([valve], [], journal.SOURCE_USER)
             if self.valve_model.data['server']['valve_states'][valve] == 'open':
-                self.socketio.emit('valve',{'action':'open','valve':valve})
+                self.emit('state', self.valve_model.stateDelta(base))
 
     def closeValve(self, valve):
         if self.valve_model.data['server']['valve_states'][valve] == 'open':
+            base = self.valve_model.state_seq
             self.valve_model.closeValve(valve)
+            self.journalValves([], [valve], journal.SOURCE_USER)
             if self.valve_model.data['server']['valve_states'][valve] == 'closed':
-                self.socketio.emit('valve',{'action':'close','valve':valve})
+                self.emit('state', self.valve_model.stateDelta(base))
+
+    def setValves(self, open_list, close_list, emit=True, source=journal.SOURCE_USER):
+        """Apply a state change of several valves as one transaction and one interface update.
+
+        Returns [opened, closed] valves, leaving out valves that were already in the requested state.
+        """
+        states = self.valve_model.data['server']['valve_states']
+        open_list = [valve for valve in open_list if states[valve] == 'closed']
+        close_list = [valve for valve in close_list if states[valve] == 'open']
+        if open_list or close_list:
+            base = self.valve_model.state_seq
+            self.valve_model.setValves(open_list, close_list)
+            self.journalValves(open_list, close_list, source)
+            if emit:
+                self.emit('state', self.valve_model.stateDelta(base))
+        return [open_list, close_list]
+
+    def stateSnapshot(self, data=None):
+        """Returns state frame of every valve to the requesting client."""
+        return self.valve_model.stateSnapshot()
+
+    def stateSync(self, data=None):
+        """Returns the changes since the sequence number a reconnecting client last applied.
+
+        The client receives one delta frame of every valve and script field that changed,
+        or a snapshot if it has no state yet or the changes are no longer kept.
+        """
+        try:
+            base = int(data['seq'])
+        except (TypeError, KeyError, ValueError):
+            return self.valve_model.stateSnapshot()
+        return self.valve_model.stateDelta(base)
+
+    def valveStatesApply(self, states):
+        """Set valves to a target state vector of valve to 'open' or 'closed'.
+
+        Valves that are not in the vector keep their state. The vector is checked in full
+        before anything is written, then valves whose state differs are changed in one
+        hardware transaction, which writes each bank of the controller once, and one
+        aggregated update is broadcast.
+
+        Returns [opened, closed] valves
+        """
+        if not isinstance(states, dict):
+            raise ValueError(f'Target state must map valves to states. Received: {states}')
+        for valve, state in states.items():
+            self.checkValveExists(valve)
+            if state not in ('open', 'closed'):
+                raise ValueError(f"Valve state must be 'open' or 'closed'. Received: {valve} {state}")
+        return self.setValves([valve for valve, state in states.items() if state == 'open'],
+                              [valve for valve, state in states.items() if state == 'closed'])
+
+    def pumpSet(self, valves, frequency):
+        try:
+            if frequency > 0:
+                self.valve_model.pumpStart(valves, frequency)
+            else:
+                self.valve_model.pumpStop(valves)
+        except Exception as e:
+            self.logger.warning(f'Failed to set pump. {e}')
 
     def checkValveExists(self, valve):
         self.logger.debug(f'Checking existence of valve: {valve}')
@@ -290,7 +435,13 @@ class MicrofluidicController():
         self.error = None
         try:
             file_name = request.form.get('script')
-            self.script_model.preview_text = self.scriptRead(file_name).replace('\r\n', '\n')
+            file_path = self.scriptPath(file_name)
+            if self.catalogs['scripts'].info(file_name)['size'] > self.stream_bytes:
+                self.script_model.script_file = ScriptFile(file_path)
+                self.logger.info(f'Script has {self.script_model.script_file.line_count} lines and is streamed while it runs.')
+            else:
+                self.script_model.script_file = None
+                self.script_model.preview_text = self.scriptRead(file_name).replace('\r\n', '\n')
             self.script_model.selected = file_name
             self.logger.info(f'Loaded script: {file_name}')
         except Exception as e:
@@ -304,12 +455,18 @@ class MicrofluidicController():
             file_name = request.form.get('file_name')
             if not file_name:
                 raise ValueError('No file name.')
+            if self.script_model.script_file:
+                raise ValueError('Streamed scripts only show a page of the file and cannot be saved from the panel.')
             data = request.form.get('panel_text').replace('\r\n', '\n')
             self.script_model.preview_text=data  # Preserve user text
-            self.script_model.processScript(data)  # Generate error if data not formatted correctly
+            diagnostics = self.script_model.validate(data)  # Report every formatting error at once
+            if diagnostics:
+                raise SyntaxError(' '.join([diagnostic['msg'] for diagnostic in diagnostics]))
+            self.script_model.processScript(data)
             file_path = importlib.resources.files('plfluidics.server.scripts').joinpath(file_name)
             with open(file_path, 'w') as f:
                 f.write(self.script_model.preview_text)
+            self.catalogs['scripts'].invalidate(file_name)
             self.script_model.selected = file_name
             self.logger.info(f'Script saved: {file_path}')
         except Exception as e:
@@ -323,13 +480,68 @@ class MicrofluidicController():
             self.logger.info('User request: play')
         try:
             if not self.script_model.script:  # On 1st press: extract, process, store user text
-                text = data.get('panel_text').replace('\r\n', '\n')
-                self.script_model.preview_text=text
-                self.script_model.script = self.script_model.processScript(text)
+                self.scriptCompile(data)
             self.startPauseScriptEngine()
         except Exception as e:
             self.logger.warning(f'Error starting/pausing script. {e}')
 
+    def scriptCompile(self, data):
+        """Compile the script in the panel, or stream the loaded file if it is too large to preview."""
+        if self.script_model.script_file:
+            return self.script_model.loadStream(self.script_model.script_file.lines())
+        text = data.get('panel_text').replace('\r\n', '\n')
+        self.script_model.preview_text = text
+        return self.script_model.processScript(text)
+
+    def scriptWindow(self):
+        """Returns a page of lines of a streamed script around the requested line."""
+        if not self.script_model.script_file:
+            return {'error': 'No streamed script loaded.'}, 400
+        line = request.args.get('line', default=self.script_model.line_count, type=int)
+        first, lines = self.script_model.script_file.window(line, self.preview_lines)
+        return {'first': first, 'lines': lines, 'line_count': self.script_model.script_file.line_count}
+
+    def scriptValidate(self, data):
+        """Returns formatting errors of the editor panel text to the requesting client."""
+        try:
+            text = data.get('panel_text').replace('\r\n', '\n')
+            return {'diagnostics': self.script_model.validate(text)}
+        except Exception as e:
+            self.logger.warning(f'Error validating script. {e}')
+            return {'diagnostics': []}
+
+    def scriptSimulate(self):
+        """Fast-forward the submitted script from the current valve states without touching hardware."""
+        self.logger.debug('Simulating script.')
+        data = request.get_json(silent=True) or request.form
+        try:
+            text = data.get('panel_text').replace('\r\n', '\n')
+            simulator = ScriptSimulator(self.valve_model.data['server']['valve_states'], cache=self.script_cache)
+            result = simulator.run(text)
+            self.logger.info(f"Simulated script: {result['duration']} s, {len(result['invalid'])} invalid actions.")
+            for action in result['invalid']:
+                self.logger.warning(f"Line {action['line']} at {action['time']} s: {action['action']} {action['valves']}. {action['reason']}")
+            return result
+        except Exception as e:
+            self.logger.warning(f'Error simulating script. {e}')
+            return {'error': f'{e}'}, 400
+
+    def scriptSeek(self, data):
+        """Start the script in the panel at a line, with the valve state it would have by then."""
+        self.logger.info(f"User request: start at line {data.get('line')}")
+        if self.script_model.state != 'idle':
+            self.logger.warning('Error starting script at line. Script is already running.')
+            return
+        try:
+            line = int(data.get('line'))
+            self.scriptCompile(data)
+            self.script_model.seek(line)
+        except Exception as e:
+            self.script_model.script = []  # Next play press processes the panel again
+            self.logger.warning(f'Error starting script at line. {e}')
+            return
+        self.startPauseScriptEngine()
+
     def scriptSkip(self):
         self.logger.info('User request: skip')
         self.skipScriptEngine()
@@ -359,21 +571,26 @@ class MicrofluidicController():
             if not self.flag_thread_processor:
                 self.logger.debug('Starting thread for interfacing with script engine.')
                 self.userQ.queue.clear()
-                self.thread_script_processor = threading.Thread(target=self.scriptProcessor)
-                self.thread_script_processor.daemon = True
-                self.thread_script_processor.start()
+                self.thread_script_processor = self.socketio.start_background_task(self.scriptProcessor)
 
             if not self.script_model.flag_thread_engine:
                 self.logger.debug('Starting thread for script engine.')
                 self.scriptQ.queue.clear()
-                self.thread_script_state_machine = threading.Thread(target=self.script_model.engine)
-                self.thread_script_state_machine.daemon = True
-                self.thread_script_state_machine.start()
+                self.thread_script_state_machine = self.socketio.start_background_task(self.script_model.engine)
+
+            self.journalOpen()
+            self.journalEvent(journal.EVENT_START, journal.SOURCE_USER, self.script_model.seek_line or 1)
+        elif self.script_model.state == 'running':
+            self.journalEvent(journal.EVENT_PAUSE, journal.SOURCE_USER, self.script_model.line_count)
+        else:
+            self.journalEvent(journal.EVENT_RESUME, journal.SOURCE_USER, self.script_model.line_count)
 
+        base = self.valve_model.state_seq
         if self.script_model.state == 'running':
-            self.socketio.emit('pause')
+            self.valve_model.scriptSet(state='paused')
         else:
-            self.socketio.emit('play')
+            self.valve_model.scriptSet(state='running')
+        self.emit('state', self.valve_model.stateDelta(base))
 
         self.logger.debug('Submitting start-pause command.')
         self.userQ.put('start-pause')
@@ -382,12 +599,14 @@ class MicrofluidicController():
         """While script is loaded, skip the next uncompleted step."""
         if self.script_model:
             self.logger.debug('Submitting skip command.')
+            self.journalEvent(journal.EVENT_SKIP, journal.SOURCE_USER, self.script_model.line_count)
             self.userQ.put('skip')
 
     def stopScriptEngine(self):
         """Manually terminate script state machine and processor threads"""
         if self.script_model.script:
             self.logger.debug('Submitting stop command.')
+            self.journalEvent(journal.EVENT_STOP, journal.SOURCE_USER, self.script_model.line_count)
             self.userQ.put('stop')
             self.thread_script_state_machine.join()
             self.logger.debug('Script engine thread terminated.')
@@ -398,6 +617,100 @@ class MicrofluidicController():
     def poll(self):
         self.userQ.put('poll')
 
+    def scriptTiming(self):
+        """Report lateness of each wait step for the current or most recent script run."""
+        return self.script_model.timingGet()
+
+    def scriptProgress(self):
+        """Report script progress, `?line=N` adds the planned time at which line N is reached."""
+        progress = self.script_model.progressGet()
+        line = request.args.get('line', type=int)
+        if line is not None:
+            try:
+                progress['line_time'] = self.script_model.timeAtLine(line)
+            except (ValueError, IndexError) as e:
+                return {'error': f'{e}'}, 400
+        return progress
+
+    def latencyGet(self):
+        """Report latency histograms of the script to hardware path, `?reset=1` clears them afterwards."""
+        summary = {'hops': self.latency.summary()}
+        if request.args.get('reset'):
+            self.latency.reset()
+        return summary
+
+    def metricsGauges(self):
+        """Returns {'name', 'labels', 'value'} of values sampled when metrics are requested."""
+        gauges = [{'name': 'queue_depth', 'labels': {'queue': name}, 'value': q.qsize()}
+                  for name, q in [['user', self.userQ], ['script', self.scriptQ], ['log', self.logQ]]]
+        gauges += [{'name': 'log_clients', 'labels': {}, 'value': len(self.log_stream.clients)},
+                   {'name': 'script_running', 'labels': {}, 'value': int(self.script_model.state == 'running')},
+                   {'name': 'valve_state_seq', 'labels': {}, 'value': self.valve_model.state_seq},
+                   {'name': 'uptime_seconds', 'labels': {}, 'value': perf_counter() - self.t_started}]
+        for status in self.valve_model.pumpStatusGet():
+            labels = {'valves': ' '.join(status['valves'])}
+            gauges += [{'name': 'pump_requested_hz', 'labels': labels, 'value': status['frequency']},
+                       {'name': 'pump_achieved_hz', 'labels': labels, 'value': status['achieved']},
+                       {'name': 'pump_cycles', 'labels': labels, 'value': status['cycles']}]
+        return gauges
+
+    def metricsGet(self):
+        """Report counters, gauges and latency histograms in the Prometheus text format."""
+        text = prometheusText(self.counters.values(), self.metricsGauges(), self.latency.buckets())
+        return text, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    def metricsJson(self):
+        """Report counters, gauges and latency summaries as JSON."""
+        return {'counters': self.counters.values(),
+                'gauges': self.metricsGauges(),
+                'latency': self.latency.summary()}
+
+    def emit(self, event, *args, **kwargs):
+        self.counters.inc('emits', event=event)
+        self.socketio.emit(event, *args, **kwargs)
+
+    def latencyRecord(self, op, t_queued, t_start, t_done):
+        driver = self.valve_model.data['config']['driver']
+        self.latency.record('queue', op, t_start - t_queued, driver)
+        self.latency.record('controller', op, t_done - t_start, driver)
+        self.latency.record('total', op, t_done - t_queued, driver)
+
+    def journalOpen(self):
+        """Start the binary journal of a script run, see plfluidics/server/journal.py."""
+        if self.journal_dir is None:
+            return
+        self.journalClose()
+        try:
+            os.makedirs(self.journal_dir, exist_ok=True)
+            path = os.path.join(self.journal_dir, f'run_{datetime.now():%Y%m%d_%H%M%S_%f}.plj')
+            meta = {'config_name': self.valve_model.data['config']['config_name'],
+                    'driver': self.valve_model.data['config']['driver'],
+                    'script': self.script_model.selected or None}
+            self.journal = RunJournal(path, self.valve_model.data['server']['valve_states'], meta)
+            self.logger.info(f'Run journal: {path}')
+        except OSError as e:
+            self.logger.warning(f'Run journal could not be opened. {e}')
+
+    def journalValves(self, open_list, close_list, source):
+        run_journal = self.journal  # The processor thread closes the journal when the run ends
+        if run_journal:
+            run_journal.valvesSet(open_list, close_list, source)
+
+    def journalPump(self, open_list, close_list):
+        """Called from pump threads with the valves of each phase."""
+        self.journalValves(open_list, close_list, journal.SOURCE_PUMP)
+
+    def journalEvent(self, code, source, line, flush=True):
+        run_journal = self.journal
+        if run_journal:
+            run_journal.event(code, source, line, flush)
+
+    def journalClose(self):
+        run_journal = getattr(self, 'journal', None)
+        self.journal = None
+        if run_journal:
+            run_journal.close()
+
     #########################
     # CTRL SCRIPT PROCESSOR #
     #########################
@@ -407,40 +720,111 @@ class MicrofluidicController():
 
         Signals consist of valve operations or termination. The processor 
         thread is not active if the script state machine is in an idle state.
+
+        The processor blocks until the engine submits a message and then drains every
+        message that is pending, so a burst of engine events is dispatched in one wake-up.
         """
         self.logger.debug('Script processor initializing.')
         self.flag_thread_processor = True
         while(True):
+            batch = [self.scriptQ.get()]
+            self.counters.inc('loop_iterations', thread='processor')
+            self.scriptQ.task_done()
             try:
-                msg = self.scriptQ.get_nowait()
-                self.scriptQ.task_done()
-                if msg is None:
-                    # Terminate loop
-                    break
-                elif msg[0] == 'open':
-                    self.openValve(msg[1])
-                    self.socketio.emit('valve',{'name':msg[1], 'state':'o'})
-                elif msg[0] == 'close':
-                    self.closeValve(msg[1])
-                    self.socketio.emit('valve',{'name':msg[1], 'state':'c'})
-                elif msg[0] == 'pause':
-                    self.socketio.emit('pause')
-                elif msg[0] == 't_e':
-                    self.socketio.emit('time',{'event':'t_e','value':msg[1]})
-                elif msg[0] == 't_a':
-                    self.socketio.emit('time',{'event':'t_a','remaining':msg[1], 'duration':msg[2]})
-                elif msg[0] == 't_n':
-                    self.socketio.emit('time',{'event':'t_n','value':msg[1]})
-                elif msg[0] == 't_r':
-                    self.socketio.emit('time',{'event':'t_r','remaining':msg[1], 'duration':msg[2]})
-                elif msg[0] == 'line':
-                    self.socketio.emit('line',{'index':msg[1]})
-
-            except queue.Empty as e:
-                sleep(.001)
+                while True:
+                    batch.append(self.scriptQ.get_nowait())
+                    self.scriptQ.task_done()
+            except queue.Empty:
+                pass
+            self.counters.inc('script_messages', len(batch))
+            if self.scriptDispatch(batch):
+                break
+        self.valve_model.pumpStop()
         self.flag_thread_processor = False
+        self.valve_model.scriptSet(state='idle')
+        self.journalClose()
+        self.latency.logSummary(self.logger)
         self.logger.debug('Script processor terminated.')
-        self.socketio.emit('stop')
+        self.emit('stop')
+
+    def scriptDispatch(self, batch):
+        """Apply a batch of (submit time, message) pairs from the script engine.
+
+        Valve messages are merged into one hardware transaction until a message changes a
+        valve that the pending transaction already changes the other way, or a pump or pause
+        message needs the valves applied first, so every valve transition of the script
+        still reaches the hardware in order. The line, progress and pauses update the script
+        state of the valve model, and the interface receives a single `state` delta of
+        every valve and script field that changed. Steps are journaled when the transaction
+        carrying their valves is applied, so the journal keeps the order of the script.
+
+        Returns True if the batch terminates the processor.
+        """
+        script = {}
+        base = self.valve_model.state_seq
+        pending = {}  # Valve to requested state of the pending transaction
+        pending_queued = []  # Submit times of the valve messages in the pending transaction
+        pending_steps = []  # Lines of the steps whose valves are in the pending transaction
+        steps = []  # Lines reached since the last valve message
+
+        def flush():
+            """Apply the pending transaction, journaling its steps before its valve transitions."""
+            for line in pending_steps:
+                self.journalEvent(journal.EVENT_STEP, journal.SOURCE_SCRIPT, line, flush=False)
+            pending_steps.clear()
+            if not pending:
+                return
+            t_start = perf_counter()
+            self.setValves([valve for valve, state in pending.items() if state == 'open'],
+                           [valve for valve, state in pending.items() if state == 'closed'],
+                           emit=False, source=journal.SOURCE_SCRIPT)
+            t_done = perf_counter()
+            for t_queued in pending_queued:
+                self.latencyRecord('valves', t_queued, t_start, t_done)
+            pending.clear()
+            pending_queued.clear()
+
+        def settle():
+            """Flush, then journal the steps reached after the last valve message."""
+            flush()
+            pending_steps.extend(steps)
+            steps.clear()
+            flush()
+
+        terminate = False
+        for t_queued, msg in batch:
+            if msg is None:
+                terminate = True
+                break
+            elif msg[0] == 'valves':
+                changes = dict.fromkeys(msg[1], 'open')
+                changes.update(dict.fromkeys(msg[2], 'closed'))
+                if any(pending.get(valve, state) != state for valve, state in changes.items()):
+                    flush()
+                pending.update(changes)
+                pending_queued.append(t_queued)
+                pending_steps.extend(steps)
+                steps.clear()
+            elif msg[0] == 'pump':
+                settle()
+                t_start = perf_counter()
+                self.pumpSet(msg[2], msg[1])
+                self.latencyRecord('pump', t_queued, t_start, perf_counter())
+            elif msg[0] == 'pause':
+                settle()
+                script['state'] = 'paused'
+                self.journalEvent(journal.EVENT_PAUSE, journal.SOURCE_SCRIPT, script.get('line', self.script_model.line_count))
+            elif msg[0] == 'progress':
+                script['progress'] = msg[1]
+            elif msg[0] == 'line':
+                script['line'] = msg[1]
+                steps.append(msg[1])
+        settle()
+        if script:
+            self.valve_model.scriptSet(**script)
+        if self.valve_model.state_seq != base:
+            self.emit('state', self.valve_model.stateDelta(base))
+        return terminate
 
 class QueueLogHandler(logging.Handler):
     def __init__(self, log_queue):
@@ -0,0 +1,126 @@
+'''Append-only binary journal of the valve transitions and script events of a run.
+
+A journal file starts with a header followed by fixed-width little-endian records:
+
+    t_ns    uint64  - time.monotonic_ns() when the event was recorded
+    index   uint16  - Valve index in config order, or the script line of step and start events
+    state   uint8   - New valve state or event code, see STATE_* and EVENT_*
+    source  uint8   - What caused the event, see SOURCE_*
+
+The header is the magic b'PLFJ', uint16 version, uint16 record size and uint32 header
+length, followed by UTF-8 JSON metadata padded with spaces to the header length. The
+metadata holds the valve names in index order and the wall clock and monotonic times
+at which the journal was opened, so record times can be converted to dates.
+
+Records are only appended, so a journal can be read, or memory-mapped, while the run
+is still writing it. A record cut short by a crash is ignored by the reader. Script
+lines beyond 65535 are stored modulo 65536 and can be unwrapped with the record order.
+'''
+import json
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'PLFJ'
+VERSION = 1
+HEADER = struct.Struct('<4sHHI')
+RECORD = struct.Struct('<QHBB')
+
+STATE_CLOSED = 0
+STATE_OPEN = 1
+EVENT_STEP = 2
+EVENT_START = 3
+EVENT_PAUSE = 4
+EVENT_RESUME = 5
+EVENT_SKIP = 6
+EVENT_STOP = 7
+EVENT_END = 8
+STATES = ['closed', 'open', 'step', 'start', 'pause', 'resume', 'skip', 'stop', 'end']
+
+SOURCE_SYSTEM = 0
+SOURCE_USER = 1
+SOURCE_SCRIPT = 2
+SOURCE_PUMP = 3
+SOURCES = ['system', 'user', 'script', 'pump']
+
+
+class RunJournal():
+    """Writer of a journal file. Thread-safe, records are buffered and flushed on events.
+
+    Attributes
+    ----------
+    path: str               - Path of the journal file
+    valves: list            - Valve names, the index of a valve record is its position in this list
+    closed: bool            - True after close, later records are ignored
+
+    Methods
+    -------
+    valvesSet(open_list, close_list, source)    - Record valve transitions
+    event(code, source, index)                  - Record a script event and flush
+    close()                                     - Record the end of the run and close the file
+    """
+
+    def __init__(self, path, valves, meta=None, buffer_size=1 << 16):
+        self.path = str(path)
+        self.valves = list(valves)
+        self.valve_index = {valve: index for index, valve in enumerate(self.valves)}
+        self.closed = False
+        self._lock = threading.Lock()
+        info = dict(meta or {}, valves=self.valves, time_ns=time.time_ns(), monotonic_ns=time.monotonic_ns())
+        text = json.dumps(info).encode()
+        header_len = HEADER.size + len(text)
+        header_len += -header_len % RECORD.size  # Records start on a record boundary of the file
+        self._file = open(self.path, 'xb', buffering=buffer_size)
+        self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, header_len) + text.ljust(header_len - HEADER.size))
+
+    def valvesSet(self, open_list=(), close_list=(), source=SOURCE_USER):
+        t_ns = time.monotonic_ns()
+        data = b''.join([RECORD.pack(t_ns, self.valve_index[valve], STATE_OPEN, source) for valve in open_list] +
+                        [RECORD.pack(t_ns, self.valve_index[valve], STATE_CLOSED, source) for valve in close_list])
+        with self._lock:
+            if not self.closed:
+                self._file.write(data)
+
+    def event(self, code, source=SOURCE_SCRIPT, index=0, flush=True):
+        with self._lock:
+            if self.closed:
+                return
+            self._file.write(RECORD.pack(time.monotonic_ns(), index & 0xFFFF, code, source))
+            if flush:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self._file.write(RECORD.pack(time.monotonic_ns(), 0, EVENT_END, SOURCE_SYSTEM))
+            self._file.close()
+            self.closed = True
+
+
+def recordDtype():
+    import numpy as np
+    return np.dtype([('t_ns', '<u8'), ('index', '<u2'), ('state', 'u1'), ('source', 'u1')])
+
+
+def readJournal(path):
+    """Returns (metadata, records) of a journal file.
+
+    Records are a NumPy structured array with fields t_ns, index, state and source that
+    is memory-mapped from the file, so even a journal of a multi-day run loads at once
+    and is only read from disk as fields are used. Requires NumPy.
+    """
+    import numpy as np
+    with open(path, 'rb') as f:
+        magic, version, record_size, header_len = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f'Not a run journal: {path}')
+        if version != VERSION or record_size != RECORD.size:
+            raise ValueError(f'Unsupported run journal version {version} with {record_size} byte records: {path}')
+        meta = json.loads(f.read(header_len - HEADER.size))
+    count = (os.path.getsize(path) - header_len) // RECORD.size
+    dtype = recordDtype()
+    if count == 0:
+        return meta, np.zeros(0, dtype=dtype)
+    return meta, np.memmap(path, dtype=dtype, mode='r', offset=header_len, shape=(count,))
@@ -0,0 +1,136 @@
+'''Log history and delivery of log records to the browsers that display the control page.
+'''
+import logging
+import threading
+from collections import deque
+from time import perf_counter
+
+
+class LogStream():
+    """Per client backlog of log records that are sent to browsers in batched frames.
+
+    Each client has at most one unacknowledged frame in flight. Records that arrive
+    while a frame is in flight wait in the backlog of the client. When the backlog is
+    full the oldest records are dropped and the next frame reports how many were
+    skipped, so a browser that falls behind never holds up the server or other browsers.
+
+    Attributes
+    ----------
+    backlog: int            - Maximum number of records waiting per client
+    ack_timeout: float      - Seconds after which an unacknowledged frame is considered lost
+    clients: dict           - Client id to {'records', 'dropped', 'sent'} of each connected client
+
+    Methods
+    -------
+    connect(sid)            - Start delivering records to a client
+    disconnect(sid)         - Stop delivering records to a client
+    put(records)            - Add records to the backlog of every client
+    frames()                - Returns [client id, frame] of every client that can receive a frame
+    ack(sid)                - Mark the frame in flight to a client as received
+    pending()               - Returns True if a client has records waiting
+    """
+
+    def __init__(self, backlog=1000, ack_timeout=5):
+        self.backlog = backlog
+        self.ack_timeout = ack_timeout
+        self.clients = {}
+        self._lock = threading.Lock()
+
+    def connect(self, sid):
+        with self._lock:
+            self.clients[sid] = {'records': deque(maxlen=self.backlog), 'dropped': 0, 'sent': None}
+
+    def disconnect(self, sid):
+        with self._lock:
+            self.clients.pop(sid, None)
+
+    def put(self, records):
+        if not records:
+            return
+        with self._lock:
+            for client in self.clients.values():
+                backlog = client['records']
+                count = len(backlog) + len(records)
+                backlog.extend(records)
+                client['dropped'] += count - len(backlog)
+
+    def frames(self):
+        """Returns [client id, frame] for every client with records and no frame in flight.
+
+        A frame is {'msgs': [records], 'dropped': number of records skipped before them}.
+        """
+        frames = []
+        now = perf_counter()
+        with self._lock:
+            for sid, client in self.clients.items():
+                if client['sent'] is not None and now - client['sent'] < self.ack_timeout:
+                    continue
+                if not client['records'] and not client['dropped']:
+                    continue
+                frames.append([sid, {'msgs': list(client['records']), 'dropped': client['dropped']}])
+                client['records'].clear()
+                client['dropped'] = 0
+                client['sent'] = now
+        return frames
+
+    def ack(self, sid):
+        with self._lock:
+            if sid in self.clients:
+                self.clients[sid]['sent'] = None
+
+    def pending(self):
+        with self._lock:
+            return any(client['records'] or client['dropped'] for client in self.clients.values())
+
+
+class LogHistory(logging.Handler):
+    """Logging handler that keeps the most recent records in a fixed capacity ring buffer.
+
+    Records are numbered in the order they are logged. A record is stored at its number
+    modulo the capacity, so new records overwrite the oldest ones and memory use does not
+    grow with the length of a run.
+
+    Attributes
+    ----------
+    capacity: int           - Maximum number of records kept
+    count: int              - Number of records logged, the number of the next record
+
+    Methods
+    -------
+    emit(record)            - Store a formatted log record
+    first()                 - Returns number of the oldest record kept
+    tail(count)             - Returns the most recent records
+    page(before, count)     - Returns the records logged before a record number
+    """
+
+    def __init__(self, capacity=10000):
+        super().__init__()
+        self.capacity = capacity
+        self.count = 0
+        self._records = [None] * capacity
+
+    def emit(self, record):
+        try:
+            msg = self.format(record).strip()
+            with self.lock:
+                self._records[self.count % self.capacity] = (self.count, record.created, record.levelname, msg)
+                self.count += 1
+        except Exception:
+            self.handleError(record)
+
+    def first(self):
+        return max(self.count - self.capacity, 0)
+
+    def tail(self, count):
+        return self.page(self.count, count)
+
+    def page(self, before, count):
+        """Returns up to count records numbered before a record number, oldest first.
+
+        Each record is {'seq': number, 'time': epoch seconds, 'level': level name, 'msg': formatted message}.
+        """
+        with self.lock:
+            stop = min(before, self.count)
+            start = max(stop - count, self.first())
+            records = [self._records[seq % self.capacity] for seq in range(start, stop)]
+        return [{'seq': seq, 'time': created, 'level': level, 'msg': msg} for seq, created, level, msg in records]
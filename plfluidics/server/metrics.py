@@ -0,0 +1,208 @@
+'''Latency instrumentation of the script to hardware path.
+
+A scripted valve operation passes through several hops before it reaches the valve
+driver. Each hop records its duration into a histogram keyed by hop, operation and
+driver so that slow hops can be found and regressions caught.
+
+Hops
+----
+queue       - Script engine submitting a message to the script processor picking it up
+controller  - MicrofluidicController handling the message, including the interface update
+model       - ModelHardware updating the valve model and calling the valve controller
+lock        - Waiting for the valve controller lock held by pumps and other threads
+write       - Valve driver write, e.g. the SPI or USB transfer
+total       - Script engine submitting a message to the controller finishing it
+
+Counters of loop iterations, valve operations and interface messages, gauges read when
+metrics are requested and the latency histograms are exported in the Prometheus text
+format by `prometheusText`.
+'''
+import bisect
+import queue
+import threading
+from time import perf_counter
+
+HOPS = ['queue', 'controller', 'model', 'lock', 'write', 'total']
+
+
+class LatencyHistogram():
+    """Histogram of durations with quarter-octave buckets from 1 us to about 2 minutes.
+
+    Percentiles are reported as the upper bound of the bucket that contains them, so
+    they are within 19 % of the recorded value.
+    """
+    bounds = [1e-6 * 2 ** (i / 4) for i in range(108)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q):
+        """Returns duration in seconds below which fraction q of the recorded durations fall."""
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                bound = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(bound, self.max)
+        return self.max
+
+    def buckets(self, step=4):
+        """Returns [upper bound, cumulative count] of every step-th bucket, ending with infinity."""
+        buckets = []
+        seen = 0
+        for index, count in enumerate(self.counts[:-1]):
+            seen += count
+            if index % step == 0:
+                buckets.append([self.bounds[index], seen])
+        buckets.append([float('inf'), self.count])
+        return buckets
+
+    def summary(self):
+        return {'count': self.count,
+                'mean_ms': 1000 * self.total / self.count if self.count else 0,
+                'p50_ms': 1000 * self.percentile(0.5),
+                'p99_ms': 1000 * self.percentile(0.99),
+                'max_ms': 1000 * self.max}
+
+
+class LatencyMetrics():
+    """Thread-safe collection of latency histograms keyed by hop, operation and driver.
+
+    Methods
+    -------
+    record(hop, op, seconds, driver)    - Add a duration to the histogram of a hop
+    recorder(driver)                    - Returns function(hop, op, seconds) bound to a driver
+    summary()                           - Returns list of histogram summaries
+    logSummary(logger)                  - Write histogram summaries to a logger
+    reset()                             - Remove all histograms
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def record(self, hop, op, seconds, driver='none'):
+        key = (hop, op, driver)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def recorder(self, driver):
+        def record(hop, op, seconds):
+            self.record(hop, op, seconds, driver)
+        return record
+
+    def summary(self):
+        with self.lock:
+            items = [(key, histogram.summary()) for key, histogram in self.histograms.items()]
+        items.sort(key=lambda item: (item[0][2], item[0][1], HOPS.index(item[0][0]) if item[0][0] in HOPS else len(HOPS)))
+        return [dict({'hop': hop, 'op': op, 'driver': driver}, **summary) for (hop, op, driver), summary in items]
+
+    def logSummary(self, logger):
+        for entry in self.summary():
+            logger.info(f"Latency {entry['driver']} {entry['op']} {entry['hop']}: n={entry['count']}, "
+                        f"p50 {entry['p50_ms']:.3f} ms, p99 {entry['p99_ms']:.3f} ms, max {entry['max_ms']:.3f} ms")
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+    def buckets(self):
+        """Returns list of {'hop', 'op', 'driver', 'buckets', 'count', 'sum'} of every histogram."""
+        with self.lock:
+            return [{'hop': hop, 'op': op, 'driver': driver, 'buckets': histogram.buckets(),
+                     'count': histogram.count, 'sum': histogram.total}
+                    for (hop, op, driver), histogram in sorted(self.histograms.items())]
+
+
+class CounterMetrics():
+    """Thread-safe counters keyed by name and labels.
+
+    Counters only increase. Rates, e.g. loop iterations or valve operations per second,
+    are the difference between two readings divided by the time between them.
+
+    Methods
+    -------
+    inc(name, value, **labels)          - Add to a counter
+    values()                            - Returns list of {'name', 'labels', 'value'}
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def values(self):
+        with self.lock:
+            items = sorted(self.counters.items())
+        return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in items]
+
+
+def prometheusLabels(labels):
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for key, value in labels.items()]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def prometheusText(counters, gauges, latency, prefix='plfluidics'):
+    """Returns metrics in the Prometheus text exposition format.
+
+    Parameters
+    ----------
+    counters: list          - {'name', 'labels', 'value'} of every counter, see CounterMetrics.values
+    gauges: list            - {'name', 'labels', 'value'} of every gauge
+    latency: list           - Histograms, see LatencyMetrics.buckets
+    """
+    lines = []
+    for kind, suffix, samples in [['counter', '_total', counters], ['gauge', '', gauges]]:
+        names = []
+        for sample in samples:
+            if sample['name'] not in names:
+                names.append(sample['name'])
+        for name in names:
+            lines.append(f'# TYPE {prefix}_{name}{suffix} {kind}')
+            lines += [f'{prefix}_{name}{suffix}{prometheusLabels(sample["labels"])} {sample["value"]}'
+                      for sample in samples if sample['name'] == name]
+    if latency:
+        name = f'{prefix}_latency_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for histogram in latency:
+            labels = {'hop': histogram['hop'], 'op': histogram['op'], 'driver': histogram['driver']}
+            for bound, count in histogram['buckets']:
+                le = '+Inf' if bound == float('inf') else f'{bound:.6g}'
+                lines.append(f'{name}_bucket{prometheusLabels(dict(labels, le=le))} {count}')
+            lines.append(f'{name}_sum{prometheusLabels(labels)} {histogram["sum"]}')
+            lines.append(f'{name}_count{prometheusLabels(labels)} {histogram["count"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class TimedQueue(queue.Queue):
+    """Queue that stamps items with the monotonic time they were submitted.
+
+    `put` accepts plain items, `get` returns (submit time, item) tuples. Items are stamped
+    in `put` rather than `_put`, because the green queues that eventlet and gevent
+    substitute count unfinished tasks in their own `_put`.
+    """
+
+    def put(self, item, block=True, timeout=None):
+        super().put((perf_counter(), item), block, timeout)
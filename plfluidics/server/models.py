@@ -6,10 +6,19 @@ Model:
 - Updates state as dictated
 - Returns to controller
 '''
-from time import time, sleep
+from array import array
+from time import perf_counter
 import json
 import logging
+import queue
+import heapq
+import threading
+from collections import deque
 from plfluidics.hardware.valve_controller import ValveControllerRGS, SimulatedValveController, ValveControllerPLRD1, ValveControllerFT425R
+from plfluidics.hardware.peristaltic_pump import PeristalticPump
+from plfluidics.server.clock import MonotonicClock
+from plfluidics.server.protocol import snapshotFrame, deltaFrame
+from plfluidics.server.script import ChunkPrefetch, ScriptProgram, TrackCursor, OP_CODES, OP_VALVES, OP_WAIT, OP_PUMP, OP_PAUSE
 
 class ModelConfig():
     def __init__(self, options, logger_name=None):
@@ -82,7 +91,7 @@ class ModelConfig():
         if isinstance(data,str):
             data = json.loads(data)
         new_dict = {}
-        for key in set(data):
+        for key in data:  # Keeps the order of the file, valve bit masks and cached scripts depend on it
             value = data[key]
             if isinstance(value, int):
                 new_dict[key.lower()] = value 
@@ -102,7 +111,7 @@ class ModelConfig():
 
 class ModelHardware():
 
-    def __init__(self, logger_name=None):
+    def __init__(self, logger_name=None, latency=None, counters=None, pump_phase=None):
         if logger_name:
             self.logger = logging.getLogger(logger_name)
         else:
@@ -117,11 +126,21 @@ class ModelHardware():
                         'valve_fields': valve_fields, 
                         'valve_commands': valve_commands}
         
+        self.pumps = {}
+        self.latency = latency  # Optional LatencyMetrics
+        self.counters = counters  # Optional CounterMetrics
+        self.pump_phase = pump_phase  # Optional, called with (opened, closed) valves whenever a pump changes them
+        self.state_seq = 0  # Incremented on every change of valve or script state
+        self.state_lock = threading.Lock()
+        self.history = deque(maxlen=1024)  # (seq, changed valve mask, changed script fields) of recent changes
+        self.history_floor = 0  # Deltas can only be computed from this sequence number onwards
+        self.script_state = {'state': 'idle', 'line': 1, 'progress': None}
         self.reset()
         self.logger.debug('ModelHardware initialized.')
 
     def reset(self):
         self.logger.debug('Resetting ModelHardware to default values.')
+        self.pumpStop()
         server_status = {'status': 'no_config', 
                          'valve_states':{}}
         config_status = {'config_name':'none',
@@ -129,6 +148,7 @@ class ModelHardware():
                          'device':'none',
                          'valves':[]}
         self.data = {'server': server_status, 'config': config_status, 'controller':[]}
+        self.valve_bits = {}
 
     def optionsGet(self):
         return self.options
@@ -176,95 +196,257 @@ class ModelHardware():
             self.data['controller'] = ValveControllerFT425R(valve_list)
         elif config['driver'] == 'none':
             self.data['controller'] = []
+        if self.latency is not None and self.data['controller']:
+            self.data['controller'].latency = self.latency.recorder(config['driver'])
 
         self.data['server']['valve_states']= valve_def_position
+        self.valve_bits = {valve: 1 << index for index, valve in enumerate(valve_def_position)}
+        with self.state_lock:
+            # Valve order changed, clients that saw an earlier config need a snapshot
+            self.state_seq += 1
+            self.history.clear()
+            self.history_floor = self.state_seq
         self.logger.info(f'Valve controller driver set: {config["driver"]}')         
     
     def openValve(self, valve):
+        t_start = perf_counter()
         self.logger.debug(f'Opening valve: {valve}')
         self.data['controller'].setValveOpen(valve)
         self.data['server']['valve_states'][valve] = 'open'
+        self.stateChanged(self.valve_bits[valve])
         self.logger.info(f'Valve opened: {valve}')
+        if self.latency is not None:
+            self.latency.record('model', 'open', perf_counter() - t_start, self.data['config']['driver'])
+        if self.counters is not None:
+            self.counters.inc('valve_ops', op='open')
 
     def closeValve(self, valve):
+        t_start = perf_counter()
         self.logger.debug(f'Closing valve: {valve}')
         self.data['controller'].setValveClose(valve)
         self.data['server']['valve_states'][valve] = 'closed'
+        self.stateChanged(self.valve_bits[valve])
         self.logger.info(f'Valve closed: {valve}')
+        if self.latency is not None:
+            self.latency.record('model', 'close', perf_counter() - t_start, self.data['config']['driver'])
+        if self.counters is not None:
+            self.counters.inc('valve_ops', op='close')
+
+    def setValves(self, open_list=(), close_list=()):
+        """Open and close several valves in one hardware transaction."""
+        t_start = perf_counter()
+        self.logger.debug(f'Setting valves. Open: {list(open_list)}, Close: {list(close_list)}')
+        self.data['controller'].setValvesState(open_list, close_list)
+        for valve in open_list:
+            self.data['server']['valve_states'][valve] = 'open'
+        for valve in close_list:
+            self.data['server']['valve_states'][valve] = 'closed'
+        self.stateChanged(self.valveBits(list(open_list) + list(close_list)))
+        self.logger.info(f'Valves set. Opened: {list(open_list)}, Closed: {list(close_list)}')
+        if self.latency is not None:
+            self.latency.record('model', 'valves', perf_counter() - t_start, self.data['config']['driver'])
+        if self.counters is not None:
+            self.counters.inc('valve_ops', len(open_list), op='open')
+            self.counters.inc('valve_ops', len(close_list), op='close')
+            self.counters.inc('valve_transactions')
+
+    def stateChanged(self, valves=0, script=()):
+        """Advance the state sequence number and record which valves and script fields changed."""
+        with self.state_lock:
+            self.state_seq += 1
+            self.history.append((self.state_seq, valves, tuple(script)))
+
+    def scriptSet(self, **fields):
+        """Update script state fields, e.g. state, line or progress. Returns True if a field changed."""
+        changed = [key for key, value in fields.items() if self.script_state.get(key) != value]
+        if not changed:
+            return False
+        for key in changed:
+            self.script_state[key] = fields[key]
+        self.stateChanged(script=changed)
+        return True
+
+    def valveBits(self, valves):
+        mask = 0
+        for valve in valves:
+            mask |= self.valve_bits[valve]
+        return mask
+
+    def valveMask(self):
+        """Returns bit mask of open valves, in config order."""
+        mask = 0
+        for valve, state in self.data['server']['valve_states'].items():
+            if state == 'open':
+                mask |= self.valve_bits[valve]
+        return mask
+
+    def stateSnapshot(self):
+        with self.state_lock:
+            return snapshotFrame(self.state_seq, self.data['server']['valve_states'], self.valveMask(), dict(self.script_state))
+
+    def stateDelta(self, base):
+        """Returns delta frame of the changes after sequence number base.
+
+        Changes are merged from the history, so a client that is any number of changes
+        behind receives one frame. A snapshot frame is returned instead if the history no
+        longer reaches back to base, e.g. after the config changed or a long disconnect.
+        """
+        with self.state_lock:
+            covered = self.history_floor <= base <= self.state_seq and \
+                (base == self.state_seq or self.history[0][0] <= base + 1)
+            if not covered:
+                return snapshotFrame(self.state_seq, self.data['server']['valve_states'], self.valveMask(), dict(self.script_state))
+            valves = 0
+            script = {}
+            for seq, changed_valves, changed_script in reversed(self.history):
+                if seq <= base:
+                    break
+                valves |= changed_valves
+                script.update(dict.fromkeys(changed_script))
+            script = {key: self.script_state[key] for key in script}
+            return deltaFrame(self.state_seq, base, valves, self.valveMask(), script)
+
+    def pumpStart(self, valves, frequency):
+        """Start a peristaltic pump on a sequence of valves, replacing any pump on the same valves."""
+        key = tuple(valves)
+        if key in self.pumps:
+            self.pumpStop(valves)
+        pump = PeristalticPump(self.data['controller'], valves, frequency, on_phase=self.pump_phase)
+        pump.start()
+        self.pumps[key] = pump
+        self.logger.info(f'Pump started: {list(valves)} at {frequency} Hz')
+
+    def pumpStop(self, valves=None):
+        """Stop the pump on a sequence of valves, or every pump if no valves are given.
+
+        Pump valves are returned to the states recorded in the model once pumping ends.
+        """
+        keys = [tuple(valves)] if valves else list(self.pumps)
+        for key in keys:
+            pump = self.pumps.pop(key, None)
+            if pump is None:
+                continue
+            pump.stop()
+            status = pump.statusGet()
+            self.logger.info(f'Pump stopped: {list(key)}. Requested {status["frequency"]} Hz, achieved {status["achieved"]:.3f} Hz over {status["cycles"]} cycles.')
+            states = self.data['server']['valve_states']
+            open_list = [valve for valve in key if states.get(valve) == 'open']
+            close_list = [valve for valve in key if states.get(valve) != 'open']
+            self.data['controller'].setValvesState(open_list=open_list, close_list=close_list)
+            if self.pump_phase is not None:
+                self.pump_phase(open_list, close_list)
+
+    def pumpStatusGet(self):
+        """Returns requested and achieved frequency of every running pump, read by the metrics routes."""
+        return [pump.statusGet() for pump in list(self.pumps.values())]
 
 
 class ModelScript():
             
-    def __init__(self, user_queue, script_queue, valve_list, logger_name=None):
+    def __init__(self, user_queue, script_queue, valve_list, logger_name=None, cache=None, clock=None, counters=None):
         if logger_name:
             self.logger = logging.getLogger(logger_name)
         else:
             self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
         self.logger.setLevel(logging.DEBUG)
-        self.operations = ['open','close', 'wait', 'pump','pause']
+        self.operations = ['open','close', 'wait', 'pump','pause', 'repeat', 'track']
         self.wait_units = ['ms','s', 'm', 'h']
         self.pump_units = ['hz']
         self.file_list = []
         self.flag_thread_engine = False
         self.flag_pause = False
+        self.flag_pump = False
         self.line_count = 1
+        self.line_stopped = None  # Last line reached by a script that was stopped before it finished
+        self.seek_line = None  # Line at which the next run starts
+        self.script_file = None  # ScriptFile of a loaded script that is too large to preview
+        self.stream = None  # ChunkPrefetch of the remaining chunks of a streamed script
+        self.stream_steps = 4096
+        self.stream_block_steps = 65536
         self.preview_text = "Loaded script text\nis editable.\n\nScripts that are\nactively being executed\ncannot be edited."
+        self.time_spin = 0.002
+        self.clock = clock if clock is not None else MonotonicClock()
         self.resetTimers()
+        self.resetLateness()
         self.state = 'idle'
         self.selected = []
         self.script = []
+        self.tracks = []
+        self.schedule = []
         self.userQ = user_queue
         self.scriptQ = script_queue
         self.valve_list = valve_list
+        self.cache = cache
+        self.counters = counters  # Optional CounterMetrics of engine wake-ups and executed steps
+        self.resetValidation()
         self.logger.debug('ModelScript initialized.')
 
     def engine(self):
         """State machine for executing scripts. Designed to be run as a threaded process.
-        
-            Future considerations - 
-            If idle or paused, state machine can be blocked until message is presented by user.
-            This would require reworking the logic for termination on a None signal, but would increase cpu availability, if needed.
+
+        The engine blocks on the user queue between events. While idle or paused it
+        waits until the user submits a command. While running it only wakes when the
+        next step is due or the progress display on the interface needs updating.
+
+        Step deadlines are scheduled on a monotonic timeline that starts when the script
+        is started. Each wait ends at the script origin plus the cumulative planned time,
+        so latency in one step is not carried into the following steps.
+
+        The main body and each parallel track have their own cursor. Cursors are kept in
+        a heap ordered by the planned time of their next step, so every track is driven
+        from this thread with a single clock.
         """
         self.logger.debug('Script engine initializing.')
         self.flag_thread_engine = True
         while(1):
+            if self.counters is not None:
+                self.counters.inc('loop_iterations', thread='engine')
             next_state = self.state
             interrupt = ''
             try:
-                interrupt = self.userQ.get_nowait()
+                interrupt = self.clock.get(self.userQ, timeout=self.interruptTimeout())
                 self.userQ.task_done()
                 self.logger.debug(f'Interrupt received: {interrupt}')
-            except Exception as e:
-                pass
+            except queue.Empty:
+                self.spinUntilDeadline()
 
             # IDLE #
             if self.state == 'idle':
                 if interrupt == 'start-pause':
                     if self.script:
                         self.logger.info('Executing script.')
-                        self.scriptQ.put(['t_e',self.time_expected])
-                        self.line_count = 1
-                        self.scriptQ.put(['line', self.line_count])
-                        next_state = 'running'
+                        self.resetLateness()
+                        if self.seek_line:
+                            t_start = self.startAt(self.seek_line)
+                            self.seek_line = None
+                        else:
+                            self.startTracks()
+                            t_start = 0
+                        self.time_origin = self.clock.now() - t_start
+                        self.progressPut()
+                        if self.scriptDone():
+                            self.logger.info('End of script.')
+                            next_state = self.stop()
+                        else:
+                            next_state = 'running'
                         self.logger.debug(f'Changing to {next_state} from {self.state}')
 
-                if self.script == []:
+                if not self.script:
                     self.scriptQ.put(None)  # Terminate controller thread
                     break
             
             # PAUSED #
             if self.state == 'paused':
                 if interrupt == 'start-pause':
-                    if self.time_step_next:
-                        self.time_step_next = self.time_step_remaining + time()
+                    # Shift the timeline by the time spent paused
+                    self.time_origin += self.clock.now() - self.time_paused
                     next_state = 'running'
                     self.flag_pause = False
                     self.logger.debug(f'Changing to {next_state} from {self.state}')
 
                 elif interrupt == 'skip':
-                    self.logger.info(f'Skipping line: {self.line_count} {self.script[0]} ')
-                    self.advance()
-                    if self.script != []:
+                    self.skip()
+                    if not self.scriptDone():
                         next_state = 'paused'
                     else:
                         self.logger.info('End of script.')
@@ -276,12 +458,7 @@ class ModelScript():
                     self.logger.debug(f'Changing to {next_state} from {self.state}')
 
                 elif interrupt == 'poll':
-                    self.scriptQ.put(['line', self.line_count])
-                    self.scriptQ.put(['t_e',self.time_expected])
-                    self.scriptQ.put(['t_n',self.time_step_duration])
-                    t_r = round(self.time_step_remaining)
-                    self.scriptQ.put(['t_r', t_r, self.time_step_duration - t_r])
-                    self.scriptQ.put(['t_a',self.time_expected - self.time_accumulated - self.time_step_duration + t_r, self.time_accumulated + self.time_step_duration - t_r])
+                    self.progressPoll()
 
             # RUNNING #
             if self.state == 'running':
@@ -290,105 +467,328 @@ class ModelScript():
                     self.logger.debug(f'Changing to {next_state} from {self.state}')
 
                 elif interrupt == 'start-pause':
-                    self.time_step_remaining = self.time_step_next - time()
+                    self.time_paused = self.clock.now()
                     next_state = 'paused'
                     self.logger.debug(f'Changing to {next_state} from {self.state}')
 
                 elif interrupt == 'skip':
-                    self.logger.info(f'Skipping line: {self.line_count} {self.script[0]} ')
-                    self.advance()
-                    if self.script != []:
-                        next_state = self.state
-                    else:
+                    self.skip()
+                    if self.scriptDone():
                         next_state = self.stop()
                         self.logger.debug(f'Changing to {next_state} from {self.state}')
 
                 elif interrupt == 'poll':
-                    self.scriptQ.put(['line', self.line_count])
-                    self.scriptQ.put(['t_e',self.time_expected])
-                    self.scriptQ.put(['t_n',self.time_step_duration])
-                    t_r = round(self.time_step_next - time())
-                    self.scriptQ.put(['t_r', t_r, self.time_step_duration - t_r])
-                    self.scriptQ.put(['t_a',self.time_expected - self.time_accumulated - self.time_step_duration + t_r, self.time_accumulated + self.time_step_duration - t_r])
-
+                    self.progressPoll()
 
                 else:
-                    if not self.time_step_next:
-                        self.execute()
-
-                    t_r = self.time_step_next - time()
-                    if t_r < 0:
-                        self.advance()
-                    else: # Increment progress bar on interface every second
-                        t_r_new = round(t_r)
-                        if t_r_new != self.t_r_old:
-                            self.scriptQ.put(['t_r', t_r_new, self.time_step_duration - t_r_new])
-                            self.scriptQ.put(['t_a',self.time_expected - self.time_accumulated - self.time_step_duration + t_r_new, self.time_accumulated + self.time_step_duration - t_r_new])
-                            self.t_r_old = t_r_new
-
-                    if self.script != []:
-                        if self.flag_pause == True:
-                            next_state = 'paused'
-                        else:
-                            next_state = 'running'
-                    else:
+                    self.runDue()
+                    if self.scriptDone():
                         self.logger.info('End of script.')
                         next_state = self.stop()
                         self.logger.debug(f'Changing to {next_state} from {self.state}')
+                    elif self.flag_pause == True:
+                        self.time_paused = self.clock.now()
+                        next_state = 'paused'
+                    else: # Increment progress bar on interface every second
+                        self.progressTick()
             self.state = next_state
-            sleep(0.0001)
         self.flag_thread_engine = False
         self.logger.debug('Script engine terminated.')
 
+    def interruptTimeout(self):
+        """Return the time in seconds that the engine can block while waiting for an interrupt.
+
+        None blocks until the user submits a command and 0 returns immediately.
+        """
+        if self.state == 'idle':
+            return None if self.script else 0  # Empty script must terminate the engine
+        if self.state == 'paused':
+            return None
+        if self.flag_pause or not self.schedule:
+            return 0
+        t_r = self.nextDeadline() - self.clock.now()
+        if t_r <= self.time_spin:
+            return 0
+        # Wake up when the rounded time remaining shown on the interface changes
+        t_tick = (t_r - 0.5) % 1 or 1
+        return max(min(t_r - self.time_spin, t_tick), 0)
+
+    def spinUntilDeadline(self):
+        """Busy-wait through the final stretch of a step.
+
+        Blocking on the queue is only as precise as the OS scheduler, so the last
+        `time_spin` seconds before a deadline are spun to release short waits on time.
+        """
+        if self.state != 'running' or not self.schedule:
+            return
+        deadline = self.nextDeadline()
+        if deadline - self.clock.now() <= self.time_spin:
+            self.clock.spinUntil(deadline)
+
+    def nextDeadline(self):
+        """Return the monotonic time at which the next track is due, or 0 if no track is scheduled."""
+        if not self.schedule:
+            return 0
+        return self.time_origin + self.schedule[0][0]
+
+    def resetLateness(self):
+        self.lateness = array('d')
+        self.lateness_lines = array('L')
+
+    def recordLateness(self, lateness, line):
+        """Record how late a wait step finished relative to its scheduled deadline."""
+        self.lateness.append(lateness)
+        self.lateness_lines.append(line)
+
+    def timingGet(self):
+        """Summarize step lateness in milliseconds for the current or most recent run."""
+        count = len(self.lateness)
+        if count == 0:
+            return {'steps': 0, 'mean_ms': 0, 'max_ms': 0, 'lateness': []}
+        return {'steps': count,
+                'mean_ms': 1000 * sum(self.lateness) / count,
+                'max_ms': 1000 * max(self.lateness),
+                'lateness': [[line, 1000 * late] for line, late in zip(self.lateness_lines, self.lateness)]}
+
     def resetStepTimers(self):
         self.logger.debug('Resetting step timers.')
-        self.time_step_next = 0
-        self.time_step_remaining = 0
         self.time_step_duration = 0
-        self.t_r_old = 0
+        self.step_current = None
+        self.t_r_old = None
 
     def resetTimers(self):
         self.logger.debug('Resetting timers.')
         self.time_expected = 0
-        self.time_accumulated = 0
+        self.time_origin = 0
+        self.time_paused = 0
+        self.resetStepTimers()
+
+    def startTracks(self):
+        """Create cursors for the main body and each track of the script, all due at time zero."""
+        self.tracks = [TrackCursor('main', 0)]
+        self.tracks += [TrackCursor(name, start) for name, start, _ in self.script.tracks]
+        self.schedule = []
+        for index, cursor in enumerate(self.tracks):
+            self.settle(cursor)
+            if not cursor.done:
+                heapq.heappush(self.schedule, (cursor.time, index))
+        self.resetStepTimers()
+
+    def seek(self, line):
+        """Start the next run at a line instead of the beginning of the script.
+
+        Raises ValueError if the loaded script cannot be resumed at the line.
+        """
+        if not self.script:
+            raise ValueError('No script loaded.')
+        if self.stream is not None:
+            raise ValueError('Streamed scripts cannot be resumed from a line.')
+        self.script.seek(line)
+        self.seek_line = line
+
+    def startAt(self, line):
+        """Create the cursor of a run that resumes at a line.
+
+        The valve state the script would have set by then is submitted as one bulk valve
+        change, followed by the pumps that would be running.
+
+        Returns planned time of the line, at which the script timeline starts.
+        """
+        program = self.script
+        pc, loops, open_mask, close_mask, pumps = program.seek(line)
+        self.logger.info(f'Resuming script at line {program.lines[pc]}.')
+        if open_mask or close_mask:
+            self.scriptQ.put(['valves', program.maskValves(open_mask), program.maskValves(close_mask)])
+        for frequency, valves in pumps:
+            self.flag_pump = True
+            self.scriptQ.put(['pump', frequency, valves])
+        cursor = TrackCursor('main', pc)
+        cursor.loops = loops
+        cursor.time = program.starts[pc]
+        cursor.settle(program)
+        self.tracks = [cursor]
+        self.schedule = [] if cursor.done else [(cursor.time, 0)]
         self.resetStepTimers()
+        return program.starts[pc]
+
+    def runDue(self):
+        """Execute every track whose next step is due, in order of planned time."""
+        t_now = self.clock.now() - self.time_origin
+        wait_ended = False
+        while self.schedule and self.schedule[0][0] <= t_now and not self.flag_pause:
+            _, index = heapq.heappop(self.schedule)
+            cursor = self.tracks[index]
+            if cursor.waiting:
+                self.recordLateness(t_now - cursor.time, cursor.line)
+                self.endWait(cursor)
+                wait_ended = True
+            self.runTrack(cursor)
+            if cursor.waiting or not cursor.done:
+                heapq.heappush(self.schedule, (cursor.time, index))
+        if self.stepUpdate() or wait_ended:
+            self.progressPut()
+
+    def runTrack(self, cursor):
+        """Execute steps of a track until it reaches a wait, a pause or its end."""
+        while not cursor.done:
+            pc = cursor.pc
+            op = self.script.ops[pc]
+            cursor.line = self.script.lines[pc]
+            self.line_count = cursor.line
+            self.scriptQ.put(['line', cursor.line])
+            self.execute(cursor)
+            cursor.pc += 1
+            self.settle(cursor)
+            if cursor.waiting or op == OP_PAUSE:
+                break
+
+    def endWait(self, cursor):
+        cursor.waiting = False
+        cursor.step_duration = 0
+
+    def stepUpdate(self):
+        """Follow the wait that ends next with the step timer on the interface.
+
+        Returns True if the followed wait changed.
+        """
+        current = None
+        duration = 0
+        if self.schedule:
+            time_due, index = self.schedule[0]
+            cursor = self.tracks[index]
+            if cursor.waiting:
+                current = (index, time_due)
+                duration = cursor.step_duration
+        if current == self.step_current:
+            return False
+        self.step_current = current
+        self.time_step_duration = duration
+        self.t_r_old = None
+        return True
+
+    def progressTick(self):
+        if self.step_current is None:
+            return
+        t_r_new = max(round(self.nextDeadline() - self.clock.now()), 0)
+        if t_r_new != self.t_r_old:
+            self.progressPut()
+
+    def progressGet(self, now=None):
+        """Returns progress of the script. Every value is a constant time lookup.
 
-    def advance(self):
-        step = self.script.pop(0)
-        self.logger.debug(f'Removing step {step} from script queue.')
-        if step[0] == 'wait':
-            self.resetStepTimers()
-            self.time_accumulated += step[1]
-            self.scriptQ.put(['t_n', 0])
-            self.scriptQ.put(['t_r',0,0])
-            self.scriptQ.put(['t_a',self.time_expected - self.time_accumulated,self.time_accumulated])
-
-        self.line_count += 1
-        self.scriptQ.put(['line', self.line_count])
-
-    def execute(self):
-        cmd = self.script[0]
-        self.logger.info(f'Line: {self.line_count} {cmd}')
-        if cmd[0] == 'open':
-            self.scriptQ.put(['open', cmd[1]])
-        elif cmd[0] == 'close':
-            self.scriptQ.put(['close', cmd[1]])
-        elif cmd[0] == 'wait':
-            self.time_step_duration = cmd[1]
-            self.time_step_next = time() + self.time_step_duration
-            self.scriptQ.put(['t_n',self.time_step_duration])
-        elif cmd[0] == 'pause':
+        Elapsed time is measured on the script timeline, so it already accounts for pauses
+        and skips, and the planned duration and step deadlines are fixed at compile time.
+        """
+        if now is None:
+            now = self.time_paused if self.state == 'paused' else self.clock.now()
+        if self.schedule or self.state != 'idle':
+            t_elapsed = min(max(now - self.time_origin, 0), self.time_expected)
+        else:
+            t_elapsed = 0
+        t_r = max(round(self.nextDeadline() - now), 0) if self.step_current else 0
+        return {'line': self.line_count,
+                'expected': self.time_expected,
+                'elapsed': round(t_elapsed, 3),
+                'remaining': round(self.time_expected - t_elapsed),
+                'step_duration': self.time_step_duration,
+                'step_remaining': t_r}
+
+    def progressPut(self, now=None):
+        progress = self.progressGet(now)
+        self.t_r_old = progress['step_remaining']
+        self.scriptQ.put(['progress', progress])
+
+    def progressPoll(self):
+        self.progressPut()
+
+    def timeAtLine(self, line):
+        """Returns planned time in seconds, relative to the script start, at which a line is first reached."""
+        if not self.script:
+            raise ValueError('No script loaded.')
+        if self.stream is not None:
+            raise ValueError('Streamed scripts are compiled while they run and have no planned line times.')
+        return self.script.timeAtLine(line)
+
+    def skip(self):
+        """Skip the step that the script is currently waiting on.
+
+        Skipping fast-forwards the shared timeline by the time the skipped step would
+        have taken, so every track keeps its position relative to the others.
+        """
+        if not self.schedule:
+            return
+        program = self.script
+        now = self.time_paused if self.state == 'paused' else self.clock.now()
+        _, index = heapq.heappop(self.schedule)
+        cursor = self.tracks[index]
+        if cursor.waiting:
+            self.logger.info(f"Skipping line: {cursor.line} ['wait', {cursor.step_duration}] ")
+            t_r = cursor.time - (now - self.time_origin)
+            if t_r > 0:
+                self.time_origin -= t_r
+            self.endWait(cursor)
+        else:
+            pc = cursor.pc
+            self.logger.info(f'Skipping line: {program.lines[pc]} {program.step(pc)} ')
+            if program.ops[pc] == OP_WAIT:
+                cursor.time += program.values[pc]
+                self.time_origin -= program.values[pc]
+            cursor.pc += 1
+            self.settle(cursor)
+        if not cursor.done:
+            heapq.heappush(self.schedule, (cursor.time, index))
+            self.line_count = self.script.lines[cursor.pc]
+            self.scriptQ.put(['line', self.line_count])
+        elif cursor.waiting:
+            heapq.heappush(self.schedule, (cursor.time, index))
+        self.stepUpdate()
+        self.progressPut(now)
+
+    def execute(self, cursor):
+        program = self.script
+        pc = cursor.pc
+        op = program.ops[pc]
+        if self.counters is not None:
+            self.counters.inc('script_steps')
+        if len(self.tracks) > 1:
+            self.logger.info(f'Line: {cursor.line} [{cursor.name}] {program.step(pc)}')
+        else:
+            self.logger.info(f'Line: {cursor.line} {program.step(pc)}')
+        if op in OP_VALVES:
+            open_mask, close_mask = program.valveMasks(pc)
+            self.scriptQ.put(['valves', program.maskValves(open_mask), program.maskValves(close_mask)])
+        elif op == OP_WAIT:
+            cursor.step_duration = program.values[pc]
+            cursor.time += cursor.step_duration
+            cursor.waiting = cursor.step_duration > 0
+        elif op == OP_PUMP:
+            self.flag_pump = True
+            self.scriptQ.put(['pump', program.values[pc], program.pumpValves(program.masks[pc])])
+        elif op == OP_PAUSE:
             # Create a delay so that script does not advance
             # this gives controller time to interrupt script engine
             self.flag_pause = True
             self.scriptQ.put(['pause'])
 
+    def scriptDone(self):
+        return not self.schedule
 
     def stop(self):
         self.logger.info('Stopping script execution.')
+        self.line_stopped = self.line_count if self.schedule else None
+        if self.flag_pump:
+            self.scriptQ.put(['pump', 0, []])  # Pumps do not outlive the script
+        timing = self.timingGet()
+        if timing['steps']:
+            self.logger.info(f"Step timing: {timing['steps']} waits, mean lateness {timing['mean_ms']:.3f} ms, max lateness {timing['max_ms']:.3f} ms")
         self.resetTimers()
         self.flag_pause = False
+        self.flag_pump = False
         self.script=[]
+        self.streamClose()
+        self.tracks = []
+        self.schedule = []
+        self.seek_line = None
         self.line_count = 1
         next_state = 'idle'
         return next_state
@@ -402,70 +802,321 @@ class ModelScript():
         4. Skips `#` comment lines
         5. Identifies operation
         6. Extracts necessary parameters (Ignores end of line comments)
-        7. Returns processed script
+        7. Compiles steps into a ScriptProgram and returns it
+
+        `open v1 v2 ...` and `close v1 v2 ...` change several valves at once. Valve
+        statements that follow each other without a wait are compiled into one state
+        change that the controller applies as a single hardware transaction.
+
+        Steps can be repeated by wrapping them in a `repeat N {` ... `}` block.
+        Blocks can be nested.
+
+        Steps in a top level `track NAME {` ... `}` block run in parallel with the main
+        body and other tracks, all starting when the script starts. The script ends
+        when every track has finished.
+
+        `pump N hz v1 v2 v3 ...` runs a peristaltic sequence on the listed valves in the
+        background while the script continues. `pump 0 hz` stops every pump, or only the
+        pump on the listed valves. Pumps stop when the script stops.
+
+        When a ScriptCache is attached, a script that was already compiled for the
+        same valve list is returned from the cache without being parsed.
+
+        Script files too large to hold in memory are compiled by processStream instead.
         """
+        self.streamClose()
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(input, self.valve_list)
+            program = self.cache.get(key)
+            if program is not None:
+                self.logger.debug('Script found in cache.')
+                self.script = program
+                self.time_expected = program.time_expected
+                return program
+
         self.logger.debug('Processing script.')
+        program = ScriptProgram(self.valve_list)
+        blocks = []  # [block type, program counter, line number] of open repeat and track blocks
+        input_list = input.lower().split('\n')  # Split script into list based on new lines
+        for line_number, line in enumerate(input_list, start=1):
+            step = self.parseLine(line, line_number)
+            if step is not None:
+                self.compileStep(program, blocks, step, line_number)
+        if blocks:
+            raise SyntaxError(self.formatError(blocks[-1][2], f'`{blocks[-1][0]}` block is not closed with `}}`.'))
+
+        program.finish(len(input_list))
+        if key is not None:
+            self.cache.put(key, program)
+        self.script = program
+        self.time_expected = program.time_expected
+
+        return program
+
+    def compileStep(self, program, blocks, step, line_number):
+        """Add a parsed step to a program, opening and closing blocks on the block stack."""
+        op = step[0]
+        if op == 'open' or op == 'close':
+            mask = 0
+            for valve in step[1:]:
+                mask |= program.valveMask(valve)
+            if op == 'open':
+                program.appendValves(open_mask=mask, line=line_number)
+            else:
+                program.appendValves(close_mask=mask, line=line_number)
+        elif op == 'wait':
+            if step[1] > 0:  # Zero waits do not separate valve changes
+                program.append(OP_CODES[op], value=step[1], line=line_number)
+        elif op == 'pump':
+            program.append(OP_CODES[op], mask=program.pumpIndex(step[2:]), value=step[1], line=line_number)
+        elif op == 'repeat':
+            blocks.append(['repeat', program.openRepeat(step[1], line=line_number), line_number])
+        elif op == 'track':
+            if blocks:
+                raise SyntaxError(self.formatError(line_number, '`track` blocks cannot be nested in other blocks.'))
+            if step[1] in [track[0] for track in program.tracks]:
+                raise SyntaxError(self.formatError(line_number, f'Track `{step[1]}` is already defined.'))
+            blocks.append(['track', program.openTrack(step[1], line=line_number), line_number])
+        elif op == 'end':
+            if not blocks:
+                raise SyntaxError(self.formatError(line_number, '`}` does not close a `repeat` or `track` block.'))
+            block, pc, _ = blocks.pop()
+            if block == 'repeat':
+                program.closeRepeat(pc, line=line_number)
+            else:
+                program.closeTrack(pc, line=line_number)
+        else:
+            program.append(OP_CODES[op], line=line_number)
+
+    def processStream(self, lines):
+        """Compile script lines into a sequence of programs, one chunk at a time.
+
+        Lines are parsed as the generator is advanced. A chunk ends at the first top level
+        step after `stream_steps` steps, so at most one chunk plus the block being compiled
+        is held by the generator. Blocks longer than `stream_block_steps` steps cannot be streamed.
+        Tracks run in parallel with the whole script and are not supported.
+
+        Times in each chunk are relative to the start of the chunk and source line numbers
+        are relative to the start of the file.
+        """
+        program = ScriptProgram(self.valve_list)
+        blocks = []
+        line_number = 0
+        for line_number, line in enumerate(lines, start=1):
+            step = self.parseLine(line.lower(), line_number)
+            if step is None:
+                continue
+            if step[0] == 'track':
+                raise SyntaxError(self.formatError(line_number, '`track` blocks cannot be used in streamed scripts.'))
+            self.compileStep(program, blocks, step, line_number)
+            if blocks and len(program) > self.stream_block_steps:
+                raise SyntaxError(self.formatError(blocks[0][2], f'`{blocks[0][0]}` block is longer than {self.stream_block_steps} steps and cannot be streamed.'))
+            if not blocks and len(program) >= self.stream_steps:
+                yield program
+                program = ScriptProgram(self.valve_list)
+        if blocks:
+            raise SyntaxError(self.formatError(blocks[-1][2], f'`{blocks[-1][0]}` block is not closed with `}}`.'))
+        yield program
+
+    def loadStream(self, lines):
+        """Load a script that is compiled chunk by chunk while it runs.
+
+        The first chunk is compiled before returning, so errors at the start of the
+        script are raised here. Later chunks are compiled on a background thread one
+        chunk ahead of the engine, so that switching to the next chunk does not delay
+        the step after it. Planned duration grows as chunks are compiled.
+
+        Returns first chunk
+        """
+        self.logger.debug('Streaming script.')
+        self.streamClose()
+        chunks = self.processStream(lines)
+        program = next(chunks)
+        self.stream = ChunkPrefetch(chunks)
+        self.script = program
+        self.time_expected = program.time_expected
+        return program
+
+    def settle(self, cursor):
+        """Settle a cursor on its next step, continuing the main body in the next chunk of a streamed script."""
+        cursor.settle(self.script)
+        while cursor.done and self.stream is not None and cursor.name == 'main':
+            try:
+                program = self.stream.next()
+            except SyntaxError as e:
+                self.logger.warning(f'Ending streamed script. {e}')
+                program = None
+            if program is None:
+                self.streamClose()
+                break
+            self.script = program
+            self.time_expected += program.time_expected
+            cursor.pc = 0
+            cursor.done = False
+            cursor.settle(program)
+
+    def streamClose(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def resetValidation(self):
+        self.validated_valves = None
+        self.validated_lines = []
+        self.validated_results = []  # [step, error detail] of each validated line
+
+    def validate(self, input):
+        """Check a script for every formatting error without compiling it.
+
+        Per line parse results are kept between calls. Only the lines between the
+        unchanged head and tail of the previous text are parsed again, so repeated
+        validation of a large script while it is edited only costs the edited lines
+        plus a pass over block structure.
+
+        Returns list of diagnostics, e.g. [{'line': 3, 'msg': 'Script formatting error. Line 3 : ...'}]
+        """
+        lines = input.replace('\r\n', '\n').split('\n')
+        if self.validated_valves != self.valve_list:
+            self.resetValidation()
+            self.validated_valves = list(self.valve_list) if self.valve_list else self.valve_list
+        old = self.validated_lines
+        limit = min(len(old), len(lines))
+        head = 0
+        while head < limit and old[head] == lines[head]:
+            head += 1
+        tail = 0
+        while tail < limit - head and old[-1 - tail] == lines[-1 - tail]:
+            tail += 1
+        changed = [self.validateLine(line) for line in lines[head:len(lines) - tail]]
+        self.validated_results = self.validated_results[:head] + changed + self.validated_results[len(old) - tail:]
+        self.validated_lines = lines
+        self.logger.debug(f'Validated {len(changed)} of {len(lines)} script lines.')
+
+        diagnostics = []
+        def report(line_number, detail):
+            diagnostics.append({'line': line_number, 'msg': self.formatError(line_number, detail)})
+
+        blocks = []  # [block type, line number] of open repeat and track blocks
+        track_names = set()
+        for line_number, (step, detail) in enumerate(self.validated_results, start=1):
+            if detail:
+                report(line_number, detail)
+            elif step is None:
+                continue
+            elif step[0] == 'repeat':
+                blocks.append(['repeat', line_number])
+            elif step[0] == 'track':
+                if blocks:
+                    report(line_number, '`track` blocks cannot be nested in other blocks.')
+                elif step[1] in track_names:
+                    report(line_number, f'Track `{step[1]}` is already defined.')
+                track_names.add(step[1])
+                blocks.append(['track', line_number])
+            elif step[0] == 'end':
+                if blocks:
+                    blocks.pop()
+                else:
+                    report(line_number, '`}` does not close a `repeat` or `track` block.')
+        for block, line_number in blocks:
+            report(line_number, f'`{block}` block is not closed with `}}`.')
+        diagnostics.sort(key=lambda diagnostic: diagnostic['line'])
+        return diagnostics
+
+    def validateLine(self, line):
         try:
-            approx_time = 0
-            line_number = 0
-            new_script = []
-            input_list = input.lower().split('\n')  # Split script into list based on new lines
-            for line in input_list:
-                new_line = []
-                if line:  # Skip empty lines
-                    no_space = line.lstrip()  # Remove leading spaces
-                    if no_space[0] !='#':  # Skip commented lines
-                        line_number += 1
-                        op = no_space.split(' ')  # Split line arguments by space
-                        if op[0] not in self.operations:  # Identify operation
-                            raise SyntaxError(f'Script formatting error. Line {line_number} : Operation `{op[0]}` not in recognized list: {self.operations}.')
-
-                        if (op[0] == 'open') or (op[0] == 'close'):
-                            if len(op) < 2:  # Identify missing argument
-                                raise SyntaxError(f'Script formatting error. Line {line_number} : Operation `{op[0]} requires a valve.')
-                            valve = op[1]
-                            if valve not in self.valve_list:  # Identify typos
-                                raise SyntaxError(f'Script formatting error. Line {line_number} : Valve `{valve}` in operation `{op}` not recognized.')
-                            new_line = [op[0],valve]
-
-                        if op[0] =='wait':
-                            if len(op) < 3:  # Identify missing argument
-                                raise SyntaxError(f'Script formatting error. Line {line_number} : Operation `wait` requires a duration and unit of time.')
-                            if not op[1].isdigit():  # Check if wait duration is an integer
-                                raise SyntaxError(f'Script formatting error. Line {line_number} : Operation `wait` duration length is not an integer - {op[1]}')
-                            if op[2] not in self.wait_units:  # Check if wait unit is recognized
-                                raise SyntaxError(f'Script formatting error. Line {line_number} : Operation `wait` duration unit must be one of the following - {self.wait_units}')                    
-                            step_time = 0
-                            if op[2] == 'm':
-                                step_time = 60 * int(op[1])
-                            elif op[2] == 'h':
-                                step_time = 3600 * int(op[1])
-                            elif op[2] == 'ms':
-                                step_time = 0.001 * int(op[1])
-                            else:
-                                step_time = int(op[1])
-                            approx_time += step_time
-                            new_line = [op[0], step_time]
-
-                        if op[0] == 'pump':
-                            if len(op) < 3:  # Identify missing argument
-                                raise SyntaxError(f'Script formatting error. Line {line_number} : Operation `pump` requires a frequency value and unit.')
-                            if not op[1].isdigit():  # Check if frequency value is an integer
-                                raise SyntaxError(f'Script formatting error. Line {line_number} : Operation `pump` frequency value is not an integer - {op[1]}')
-                            if op[2] not in self.pump_units:  # check if frequency unit is recognized
-                                raise SyntaxError(f'Script formatting error. Line {line_number} : Operation `pump` unit must be one of the following - {self.pump_units}')
-                            new_line = [op[0], op[1]]
-
-                        if op[0] == 'pause':
-                            new_line = [op[0]]
-
-                if new_line:
-                    new_script.append(new_line)
+            return [self.lineStep(line.lower()), None]
+        except SyntaxError as e:
+            return [None, str(e)]
 
-        except Exception as e:
-            raise e
-        
-        self.script = new_script
-        self.time_expected = approx_time
+    def parseLine(self, line, line_number):
+        """Validate a single lowercase script line.
+
+        Returns the step in list form, e.g. ['wait', 60], or None for blank and comment lines.
+        Raises a SyntaxError if the line is not formatted properly.
+        """
+        try:
+            return self.lineStep(line)
+        except SyntaxError as e:
+            raise SyntaxError(self.formatError(line_number, e)) from None
+
+    def formatError(self, line_number, detail):
+        return f'Script formatting error. Line {line_number} : {detail}'
+
+    def lineStep(self, line):
+        """Returns the step of a lowercase script line, independent of its position in the script."""
+        no_space = line.strip()  # Remove leading spaces
+        if not no_space or no_space[0] == '#':  # Skip empty and commented lines
+            return None
+        op = no_space.split(' ')  # Split line arguments by space
+        if op[0] == '}':  # End of repeat block
+            return ['end']
+        if op[0] not in self.operations:  # Identify operation
+            raise SyntaxError(f'Operation `{op[0]}` not in recognized list: {self.operations}.')
+
+        if (op[0] == 'open') or (op[0] == 'close'):
+            valves = self.lineArguments(op[1:])
+            if not valves:  # Identify missing argument
+                raise SyntaxError(f'Operation `{op[0]} requires a valve.')
+            for valve in valves:
+                if valve not in self.valve_list:  # Identify typos
+                    raise SyntaxError(f'Valve `{valve}` in operation `{op}` not recognized.')
+            return [op[0]] + valves
+
+        if op[0] =='wait':
+            if len(op) < 3:  # Identify missing argument
+                raise SyntaxError('Operation `wait` requires a duration and unit of time.')
+            if not op[1].isdigit():  # Check if wait duration is an integer
+                raise SyntaxError(f'Operation `wait` duration length is not an integer - {op[1]}')
+            if op[2] not in self.wait_units:  # Check if wait unit is recognized
+                raise SyntaxError(f'Operation `wait` duration unit must be one of the following - {self.wait_units}')
+            if op[2] == 'm':
+                step_time = 60 * int(op[1])
+            elif op[2] == 'h':
+                step_time = 3600 * int(op[1])
+            elif op[2] == 'ms':
+                step_time = 0.001 * int(op[1])
+            else:
+                step_time = int(op[1])
+            return [op[0], step_time]
+
+        if op[0] == 'pump':
+            if len(op) < 3:  # Identify missing argument
+                raise SyntaxError('Operation `pump` requires a frequency value and unit.')
+            if not op[1].isdigit():  # Check if frequency value is an integer
+                raise SyntaxError(f'Operation `pump` frequency value is not an integer - {op[1]}')
+            if op[2] not in self.pump_units:  # check if frequency unit is recognized
+                raise SyntaxError(f'Operation `pump` unit must be one of the following - {self.pump_units}')
+            valves = self.lineArguments(op[3:])
+            for valve in valves:
+                if valve not in self.valve_list:  # Identify typos
+                    raise SyntaxError(f'Valve `{valve}` in operation `{op}` not recognized.')
+            if len(set(valves)) != len(valves):
+                raise SyntaxError('Operation `pump` lists a valve more than once.')
+            if int(op[1]) > 0 and len(valves) < 3:
+                raise SyntaxError('Operation `pump` requires at least 3 valves in pumping order.')
+            return [op[0], int(op[1])] + valves
+
+        if op[0] == 'track':
+            if len(op) < 3 or op[2] != '{':  # Identify missing argument
+                raise SyntaxError('Operation `track` requires a name followed by `{`.')
+            return [op[0], op[1]]
+
+        if op[0] == 'repeat':
+            if len(op) < 3 or op[2] != '{':  # Identify missing argument
+                raise SyntaxError('Operation `repeat` requires a count followed by `{`.')
+            if not op[1].isdigit():  # Check if repeat count is an integer
+                raise SyntaxError(f'Operation `repeat` count is not an integer - {op[1]}')
+            return [op[0], int(op[1])]
+
+        return [op[0]]
 
-        return new_script
\ No newline at end of file
+    def lineArguments(self, args):
+        """Return arguments preceding an end of line comment, ignoring repeated spaces."""
+        arguments = []
+        for arg in args:
+            if arg.startswith('#'):
+                break
+            if arg:
+                arguments.append(arg)
+        return arguments
@@ -0,0 +1,41 @@
+'''Compact wire format of the valve state frames sent to the interface.
+
+Valve states are encoded as a bitmask in the order of the valves in the config, with
+bit i set when valve i is open. Masks are sent as hexadecimal strings so that they stay
+exact in JavaScript for any number of valves.
+
+Every change of valve or script state increments a sequence number. A snapshot frame
+carries the valve order, the state of every valve and the script state. A delta frame
+carries the valves that changed after sequence number `base` and their new state, plus
+the script fields that changed, and applies to a client whose state is at least as
+recent as `base`. Clients that missed changes, e.g. after reconnecting, send the last
+sequence number they applied and receive one delta covering every change since then,
+or a snapshot if the server no longer has the changes.
+
+    snapshot: {'v': 1, 'seq': 12, 'valves': ['in', 'out', 'waste'], 'open': '5',
+               'script': {'state': 'running', 'line': 4, 'progress': {...}}}
+    delta:    {'v': 1, 'seq': 14, 'base': 12, 'changed': '3', 'open': '2', 'script': {'line': 5}}
+'''
+PROTOCOL_VERSION = 1
+
+
+def encodeMask(mask):
+    return format(mask, 'x')
+
+
+def decodeMask(text):
+    return int(text, 16)
+
+
+def snapshotFrame(seq, valves, open_mask, script=None):
+    frame = {'v': PROTOCOL_VERSION, 'seq': seq, 'valves': list(valves), 'open': encodeMask(open_mask)}
+    if script is not None:
+        frame['script'] = script
+    return frame
+
+
+def deltaFrame(seq, base, changed, open_mask, script=None):
+    frame = {'v': PROTOCOL_VERSION, 'seq': seq, 'base': base, 'changed': encodeMask(changed), 'open': encodeMask(open_mask & changed)}
+    if script:
+        frame['script'] = script
+    return frame
@@ -0,0 +1,627 @@
+'''Compiled representation of user scripts executed by the script engine.
+
+Scripts are compiled once into parallel arrays of opcodes and operands. Valve
+aliases are resolved to bit masks at compile time so that the engine can step
+through a program with a counter instead of reparsing or popping lines.
+
+Repeat blocks are compiled into a REPEAT/END pair that jump to each other, so
+loop bodies are stored once no matter how many times they are executed.
+
+Track blocks are compiled in place between a TRACK and a HALT step. The main
+body jumps over them and each track is executed by its own TrackCursor.
+
+Consecutive open and close statements are merged into one step, so valves that
+change at the same instant are applied to the hardware as a single state change.
+
+Valve and pump state at any step is reconstructed from checkpoints taken every
+`checkpoint_interval` steps plus the steps since the checkpoint, which lets a run
+resume from any line without replaying the script.
+
+Compiled programs are cached by ScriptCache, keyed on the script text and valve set,
+so that unchanged scripts are not parsed again when they are saved or played.
+
+Script files that are too large to hold in memory are read through ScriptFile, which
+yields lines for streamed compilation and pages of lines for the preview panel. The
+chunks of a streamed script are compiled one chunk ahead of the engine by ChunkPrefetch.
+'''
+import bisect
+import hashlib
+import logging
+import os
+import pickle
+import queue
+import threading
+from array import array
+from collections import OrderedDict
+
+OP_OPEN = 0
+OP_CLOSE = 1
+OP_WAIT = 2
+OP_PUMP = 3
+OP_PAUSE = 4
+OP_REPEAT = 5
+OP_END = 6
+OP_TRACK = 7
+OP_HALT = 8
+OP_SET = 9
+
+OP_NAMES = ['open', 'close', 'wait', 'pump', 'pause', 'repeat', 'end', 'track', 'halt', 'set']
+OP_VALVES = (OP_OPEN, OP_CLOSE, OP_SET)
+OP_CODES = {name: code for code, name in enumerate(OP_NAMES)}
+
+
+class ScriptProgram():
+    """Array backed script program.
+
+    Attributes
+    ----------
+    valve_list: list        - Valve aliases, position in list is the bit of the valve in a mask
+    ops: array              - Opcode of each step
+    masks: array            - Valve bit mask of open and close steps, jump target of repeat, end and
+                              track steps, index into pumps of pump steps, index into sets of set steps
+    values: array           - Duration in seconds of wait steps, frequency of pump steps, count of repeat steps
+    lines: array            - Source line number of each step
+    starts: array           - Planned start time of each step in seconds, first iteration of loops
+    line_starts: array      - Planned start time of each source line, filled by finish()
+    pumps: list             - Valve sequences referenced by pump steps
+    sets: list              - [open mask, close mask] of set steps, which open some valves and close others
+    tracks: list            - [name, first program counter, planned duration] of each parallel track
+    time_expected: float    - Planned duration of the program in seconds
+
+    Methods
+    -------
+    append(op, mask, value, line) - Add a step to the end of the program
+    appendValves(open_mask, close_mask, line) - Add a valve state change, merged into a preceding valve step
+    openRepeat(count)       - Add a repeat step and return its program counter
+    closeRepeat(pc)         - Add the end step of the repeat block starting at pc
+    openTrack(name)         - Add a track step and return its program counter
+    closeTrack(pc)          - Add the halt step of the track starting at pc
+    finish(line_count)      - Build the table of planned start times per source line
+    timeAtLine(line)        - Returns planned time in seconds at which a source line is first reached
+    seek(line)              - Returns where and in which valve and pump state execution resumes at a line
+    stateAt(pc)             - Returns [open mask, close mask, pumps] set by the steps before a program counter
+    step(pc)                - Returns step at program counter in list form, e.g. ['open', 'waste']
+    pumpIndex(valves)       - Returns index of a pump valve sequence, adding it if needed
+    pumpValves(index)       - Returns valve sequence of a pump step
+    valveMasks(pc)          - Returns [open mask, close mask] of a valve step
+    valveMask(valve)        - Returns bit mask of a valve alias
+    maskValves(mask)        - Returns list of valve aliases in a bit mask
+    """
+
+    checkpoint_interval = 256
+
+    def __init__(self, valve_list):
+        self.valve_list = list(valve_list) if valve_list else []
+        if len(self.valve_list) > 64:
+            raise ValueError(f'Scripts support up to 64 valves. Config has {len(self.valve_list)}.')
+        self.valve_index = {valve: index for index, valve in enumerate(self.valve_list)}
+        self.ops = array('B')
+        self.masks = array('Q')
+        self.values = array('d')
+        self.lines = array('L')
+        self.starts = array('d')
+        self.line_starts = array('d')
+        self.pumps = [[]]  # Valve sequences of pump steps, index 0 stops all pumps
+        self.sets = []
+        self.tracks = []
+        self.time_main = 0  # Planned time of steps outside of track blocks
+        self._time = 0  # Planned time of the block being compiled
+        self._in_track = False
+        self._repeat_time = {}
+        self.checkpoints = None  # [open mask, close mask, pumps] before every checkpoint_interval steps, built on first use
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __getitem__(self, pc):
+        if pc < 0:
+            pc += len(self.ops)
+        if not 0 <= pc < len(self.ops):
+            raise IndexError('Program counter out of range.')
+        return self.step(pc)
+
+    @property
+    def time_expected(self):
+        time_main = self.time_main if self._in_track else self._time
+        return max([time_main] + [track[2] for track in self.tracks])
+
+    def append(self, op, mask=0, value=0, line=0):
+        self.ops.append(op)
+        self.masks.append(mask)
+        self.values.append(value)
+        self.lines.append(line)
+        self.starts.append(self._time)
+        if op == OP_WAIT:
+            self._time += value
+
+    def appendValves(self, open_mask=0, close_mask=0, line=0):
+        """Add a valve state change.
+
+        If the previous step also changes valves, nothing can execute between the two, so
+        the change is merged into that step. A valve named in both keeps the later state.
+        Block boundaries are steps of their own, so merging never crosses into a loop body
+        or track.
+        """
+        pc = len(self.ops) - 1
+        if pc >= 0 and self.ops[pc] in OP_VALVES:
+            prev_open, prev_close = self.valveMasks(pc)
+            open_mask, close_mask = (prev_open & ~close_mask) | open_mask, (prev_close & ~open_mask) | close_mask
+        else:
+            pc = len(self.ops)
+            self.append(OP_OPEN, line=line)
+        if open_mask and close_mask:
+            if self.ops[pc] == OP_SET:
+                self.sets[self.masks[pc]] = [open_mask, close_mask]
+            else:
+                self.sets.append([open_mask, close_mask])
+                self.ops[pc] = OP_SET
+                self.masks[pc] = len(self.sets) - 1
+        else:
+            self.ops[pc] = OP_OPEN if open_mask else OP_CLOSE
+            self.masks[pc] = open_mask or close_mask
+
+    def openRepeat(self, count, line=0):
+        pc = len(self.ops)
+        self._repeat_time[pc] = self._time
+        self.append(OP_REPEAT, value=count, line=line)
+        return pc
+
+    def closeRepeat(self, pc, line=0):
+        self.append(OP_END, mask=pc, line=line)
+        self.masks[pc] = len(self.ops) - 1
+        time_before = self._repeat_time.pop(pc)
+        self._time = time_before + (self._time - time_before) * self.values[pc]
+        self.starts[-1] = self._time  # Loop is left once every iteration has run
+
+    def openTrack(self, name, line=0):
+        pc = len(self.ops)
+        self.time_main = self._time
+        self._time = 0  # Tracks start with the script
+        self._in_track = True
+        self.append(OP_TRACK, line=line)
+        self.tracks.append([name, pc + 1, 0])
+        return pc
+
+    def closeTrack(self, pc, line=0):
+        self.append(OP_HALT, mask=pc, line=line)
+        self.masks[pc] = len(self.ops) - 1
+        self.tracks[-1][2] = self._time
+        self._time = self.time_main
+        self._in_track = False
+
+    def finish(self, line_count):
+        """Build the table of planned start times per source line.
+
+        Steps are compiled in source order, so one pass over the steps followed by one
+        backward pass over the lines gives every line the start time of its first step,
+        or of the next step for blank and comment lines. Lines in loops report their first
+        iteration. Times of lines in tracks are relative to the script start like the
+        main body, since every track starts with the script.
+        """
+        unset = -1.0
+        line_starts = array('d', [unset]) * (line_count + 2)
+        for line, start in zip(self.lines, self.starts):
+            if line_starts[line] == unset:
+                line_starts[line] = start
+        following = self.time_expected
+        for line in range(line_count + 1, -1, -1):
+            if line_starts[line] == unset:
+                line_starts[line] = following
+            else:
+                following = line_starts[line]
+        self.line_starts = line_starts
+
+    def timeAtLine(self, line):
+        if not 0 < line < len(self.line_starts):
+            raise IndexError(f'Line {line} is not in the script.')
+        return self.line_starts[line]
+
+    def seek(self, line):
+        """Locate the first step at or after a source line for a run that resumes there.
+
+        Lines in loops resume in the first iteration with every enclosing loop at its full
+        count. A `}` line resumes after its loop.
+
+        Returns [program counter, loop stack, open mask, close mask, pumps] where pumps is a list
+        of [frequency, valves] of pumps running at that point.
+        """
+        if self.tracks:
+            raise ValueError('Scripts with tracks cannot be resumed from a line.')
+        pc = bisect.bisect_left(self.lines, line)
+        while pc < len(self.ops) and self.ops[pc] == OP_END:
+            pc += 1
+        if pc >= len(self.ops):
+            raise ValueError(f'No steps at or after line {line}.')
+        loops = []
+        for repeat_pc in range(pc):
+            if self.ops[repeat_pc] == OP_REPEAT and self.masks[repeat_pc] > pc:
+                count = int(self.values[repeat_pc])
+                if count == 0:
+                    raise ValueError(f'Line {line} is in a loop that never runs.')
+                loops.append([repeat_pc, count])
+        open_mask, close_mask, pumps = self.stateAt(pc)
+        return [pc, loops, open_mask, close_mask, [[frequency, self.pumpValves(index)] for index, frequency in pumps]]
+
+    def stateAt(self, pc):
+        """Returns [open mask, close mask, pumps] of the steps before a program counter.
+
+        Opening and closing valves only sets and clears bits, so running a loop body any
+        number of times leaves the same state as running it once, and a single pass over
+        the steps gives the state at any point of the run.
+        """
+        if self.checkpoints is None:
+            self.checkpoints = []
+            self._applySteps([0, 0, ()], 0, len(self.ops), self.checkpoints)
+        open_mask, close_mask, pumps, resume = self.checkpoints[pc // self.checkpoint_interval]
+        return self._applySteps([open_mask, close_mask, pumps], resume, pc)
+
+    def _applySteps(self, state, start, stop, checkpoints=None):
+        """Apply steps from start up to stop to a state, optionally recording checkpoints on the way.
+
+        Each checkpoint holds the state and the program counter to continue from, which is
+        past the end of the block for checkpoints in blocks that the path skips.
+        """
+        open_mask, close_mask, pumps = state
+        pc = start
+        while pc < stop:
+            if checkpoints is not None and pc % self.checkpoint_interval == 0:
+                checkpoints.append((open_mask, close_mask, pumps, pc))
+            op = self.ops[pc]
+            if op in OP_VALVES:
+                set_open, set_close = self.valveMasks(pc)
+                open_mask = (open_mask & ~set_close) | set_open
+                close_mask = (close_mask & ~set_open) | set_close
+            elif op == OP_PUMP:
+                index = self.masks[pc]
+                if index == 0:
+                    pumps = () if self.values[pc] == 0 else pumps
+                else:
+                    pumps = tuple(pump for pump in pumps if pump[0] != index)
+                    if self.values[pc] > 0:
+                        pumps += ((index, self.values[pc]),)
+            elif (op == OP_REPEAT and self.values[pc] == 0) or op == OP_TRACK:
+                end = self.masks[pc]
+                if checkpoints is not None:
+                    for skipped in range(pc + 1, end + 1):
+                        if skipped % self.checkpoint_interval == 0:
+                            checkpoints.append((open_mask, close_mask, pumps, end + 1))
+                pc = end
+            pc += 1
+        if checkpoints is not None and pc % self.checkpoint_interval == 0:
+            checkpoints.append((open_mask, close_mask, pumps, pc))
+        return [open_mask, close_mask, pumps]
+
+    def step(self, pc):
+        op = self.ops[pc]
+        if op == OP_OPEN or op == OP_CLOSE:
+            return [OP_NAMES[op]] + self.maskValves(self.masks[pc])
+        if op == OP_SET:
+            open_mask, close_mask = self.sets[self.masks[pc]]
+            return [OP_NAMES[op], self.maskValves(open_mask), self.maskValves(close_mask)]
+        if op == OP_WAIT:
+            return [OP_NAMES[op], self.values[pc]]
+        if op == OP_PUMP:
+            return [OP_NAMES[op], self.values[pc]] + self.pumpValves(self.masks[pc])
+        if op == OP_REPEAT:
+            return [OP_NAMES[op], int(self.values[pc])]
+        if op == OP_TRACK:
+            for name, start, _ in self.tracks:
+                if start == pc + 1:
+                    return [OP_NAMES[op], name]
+        return [OP_NAMES[op]]
+
+    def pumpIndex(self, valves):
+        valves = list(valves)
+        if valves in self.pumps:
+            return self.pumps.index(valves)
+        self.pumps.append(valves)
+        return len(self.pumps) - 1
+
+    def pumpValves(self, index):
+        return list(self.pumps[index])
+
+    def valveMasks(self, pc):
+        op = self.ops[pc]
+        if op == OP_SET:
+            return list(self.sets[self.masks[pc]])
+        if op == OP_OPEN:
+            return [self.masks[pc], 0]
+        return [0, self.masks[pc]]
+
+    def valveMask(self, valve):
+        return 1 << self.valve_index[valve]
+
+    def maskValves(self, mask):
+        valves = []
+        while mask:
+            bit = mask & -mask
+            valves.append(self.valve_list[bit.bit_length() - 1])
+            mask ^= bit
+        return valves
+
+
+class TrackCursor():
+    """Execution position of one track of a ScriptProgram.
+
+    Attributes
+    ----------
+    name: str               - Track name, 'main' for steps outside of track blocks
+    pc: int                 - Program counter of the next step to execute
+    loops: list             - [repeat program counter, iterations remaining] of active repeat blocks
+    time: float             - Planned time, relative to script start, when the next step is due
+    line: int               - Source line of the last executed step
+    waiting: bool           - Cursor is waiting for a wait step to elapse
+    step_duration: float    - Duration of the current wait step
+    done: bool              - Track has no steps left
+    """
+
+    def __init__(self, name, pc):
+        self.name = name
+        self.pc = pc
+        self.loops = []
+        self.time = 0
+        self.line = 0
+        self.waiting = False
+        self.step_duration = 0
+        self.done = False
+
+    def settle(self, program):
+        """Step through block boundaries so that the program counter rests on an executable step.
+
+        Loops are iterated by jumping between the REPEAT and END steps of a block, so
+        repeated steps are never expanded in memory. Track blocks are jumped over and
+        a HALT step ends the track.
+        """
+        ops = program.ops
+        while self.pc < len(ops):
+            op = ops[self.pc]
+            if op == OP_REPEAT:
+                count = int(program.values[self.pc])
+                end = program.masks[self.pc]
+                if count > 0 and end != self.pc + 1:
+                    self.loops.append([self.pc, count])
+                    self.pc += 1
+                else:  # Nothing to execute in block
+                    self.pc = end + 1
+            elif op == OP_END:
+                loop = self.loops[-1]
+                loop[1] -= 1
+                if loop[1] > 0:
+                    self.pc = loop[0] + 1
+                else:
+                    self.loops.pop()
+                    self.pc += 1
+            elif op == OP_TRACK:
+                self.pc = program.masks[self.pc] + 1
+            elif op == OP_HALT:
+                break
+            else:
+                return
+        self.done = True
+
+
+class ScriptFile():
+    """Script file that is read line by line instead of being loaded into memory.
+
+    The byte offset of every `index_interval`-th line is indexed when the file is opened,
+    so a page of lines anywhere in the file is read with one seek.
+
+    Attributes
+    ----------
+    path: str               - Path of the script file
+    line_count: int         - Number of lines in the file
+    offsets: array          - Byte offset of every index_interval-th line
+
+    Methods
+    -------
+    lines()                 - Yields every line of the file without its line break
+    window(line, size)      - Returns [first line number, lines] of a page of lines around a line
+    """
+    index_interval = 256
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = array('Q')
+        self.line_count = 0
+        offset = 0
+        with open(path, 'rb') as f:
+            for raw in f:
+                if self.line_count % self.index_interval == 0:
+                    self.offsets.append(offset)
+                offset += len(raw)
+                self.line_count += 1
+
+    def lines(self):
+        with open(self.path, 'r') as f:
+            for line in f:
+                yield line.rstrip('\n')
+
+    def window(self, line, size):
+        """Returns [first line number, lines] of up to size lines centered on a line."""
+        first = max(min(line - size // 2, self.line_count - size + 1), 1)
+        if first > self.line_count:
+            return [first, []]
+        block = (first - 1) // self.index_interval
+        lines = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offsets[block])
+            for _ in range(first - 1 - block * self.index_interval):
+                f.readline()
+            for raw in f:
+                lines.append(raw.decode().rstrip('\r\n'))
+                if len(lines) == size:
+                    break
+        return [first, lines]
+
+
+class ChunkPrefetch():
+    """Compiles the chunks of a streamed script on a background thread, one chunk ahead.
+
+    The next chunk is compiled while the engine runs the current one, so the engine does
+    not parse when a chunk runs out. A queue of one chunk bounds the lookahead: the
+    thread waits with a compiled chunk until the engine takes the queued one.
+
+    Methods
+    -------
+    next()                  - Returns the next chunk, None at the end of the script
+    close()                 - Stop compiling, the thread exits at the end of the chunk being compiled
+    """
+
+    def __init__(self, chunks, timeout=0.1):
+        self.chunks = chunks
+        self.timeout = timeout
+        self.queue = queue.Queue(maxsize=1)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def next(self):
+        """Returns the next chunk, waiting for it if it is still compiled. Raises SyntaxError of the chunk."""
+        program, error = self.queue.get()
+        if error is not None:
+            raise error
+        return program
+
+    def close(self):
+        self.closed.set()
+
+    def _run(self):
+        try:
+            for program in self.chunks:
+                if not self._put((program, None)):
+                    return
+        except SyntaxError as e:
+            self._put((None, e))
+            return
+        self._put((None, None))
+
+    def _put(self, item):
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=self.timeout)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class ScriptCache():
+    """Least recently used cache of compiled ScriptPrograms.
+
+    Programs are addressed by a hash of the script text and the ordered valve list, since
+    valve bit masks depend on valve order. Programs can optionally be persisted to a
+    directory so that they survive server restarts. Persisted programs are unpickled when
+    read, so the directory must only be writable by the server.
+
+    Attributes
+    ----------
+    size: int               - Maximum number of programs kept in memory
+    persist_dir: str        - Directory for persisted programs, None to keep programs in memory only
+    persist_size: int       - Maximum number of persisted programs, the least recently used are deleted
+    hits: int               - Number of lookups that returned a program
+    misses: int             - Number of lookups that did not return a program
+
+    Methods
+    -------
+    key(text, valve_list)   - Returns the cache key of a script
+    get(key)                - Returns cached program or None
+    put(key, program)       - Store a program
+    clear()                 - Remove every program from memory
+    statusGet()             - Returns cache size and hit counts
+    """
+    version = 4  # Increment when the ScriptProgram layout changes to invalidate persisted programs
+
+    def __init__(self, size=32, persist_dir=None, persist_size=256):
+        self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+        self.size = size
+        self.persist_dir = persist_dir
+        self.persist_size = persist_size
+        self.programs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.persist_dir:
+            try:
+                os.makedirs(self.persist_dir, exist_ok=True)
+            except OSError as e:
+                self.logger.warning(f'Compiled scripts are kept in memory only, {self.persist_dir} is not writable. {e}')
+                self.persist_dir = None
+
+    def key(self, text, valve_list):
+        digest = hashlib.sha256(f'{self.version}\n'.encode())
+        digest.update('\n'.join(valve_list or []).encode())
+        digest.update(b'\0')
+        digest.update(text.encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        program = self.programs.get(key)
+        if program is not None:
+            self.programs.move_to_end(key)
+        else:
+            program = self._load(key)
+            if program is not None:
+                self._store(key, program)
+        if program is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return program
+
+    def put(self, key, program):
+        self._store(key, program)
+        if self.persist_dir:
+            try:
+                path = self._path(key)
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(program, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + '.tmp', path)
+                self._evict()
+            except OSError as e:
+                self.logger.warning(f'Failed to persist compiled script. {e}')
+
+    def clear(self):
+        self.programs.clear()
+
+    def statusGet(self):
+        return {'programs': len(self.programs), 'size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+    def _store(self, key, program):
+        self.programs[key] = program
+        self.programs.move_to_end(key)
+        while len(self.programs) > self.size:
+            self.programs.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.persist_dir, key + '.program')
+
+    def _evict(self):
+        """Delete the least recently used persisted programs beyond persist_size."""
+        entries = []
+        with os.scandir(self.persist_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.program'):
+                    entries.append((entry.stat().st_mtime_ns, entry.path))
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.persist_size, 0)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _load(self, key):
+        if not self.persist_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                program = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            self.logger.warning(f'Discarding unreadable compiled script {key}. {e}')
+            return None
+        try:
+            os.utime(path)  # Eviction deletes the least recently used programs first
+        except OSError:
+            pass
+        return program if isinstance(program, ScriptProgram) else None
@@ -0,0 +1,143 @@
+'''Fast-forward simulation of scripts for pre-flight checks.'''
+import logging
+import queue
+
+from plfluidics.hardware.valve_controller import SimulatedValveController
+from plfluidics.server.clock import VirtualClock
+from plfluidics.server.models import ModelScript
+
+
+class ScriptSimulator():
+    """Runs scripts through the script engine on a virtual clock.
+
+    The simulator takes the place of the controller script processor. Messages from the
+    engine are applied to a SimulatedValveController as soon as they are submitted and
+    stamped with virtual time, and pause steps are resumed automatically. A script of
+    several hours completes in the time it takes the engine to step through it.
+
+    Attributes
+    ----------
+    valve_states: dict      - Valve alias:'open'/'closed' pairings at the start of each run
+    controller: ValveController - Simulated controller that receives valve operations
+
+    Methods
+    -------
+    run(text)               - Simulate a script, returns duration, valve timeline and invalid actions
+    put(msg)                - Receive a message from the script engine
+    """
+
+    def __init__(self, valve_states, valve_controller=None, cache=None, logger_name=None):
+        """
+        Parameters
+        ----------
+        valve_states: dict                  - Valve alias:'open'/'closed' pairings, e.g. ModelHardware valve_states
+        valve_controller: ValveController   - Controller to drive, a SimulatedValveController is created if None
+        cache: ScriptCache                  - Compiled script cache shared with the script model
+        """
+        if logger_name:
+            self.logger = logging.getLogger(logger_name)
+        else:
+            self.logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+        self.valve_states = dict(valve_states)
+        if valve_controller is None:
+            valve_controller = SimulatedValveController([[index, False, False, valve] for index, valve in enumerate(self.valve_states)])
+        self.controller = valve_controller
+        self.cache = cache
+        self.reset()
+
+    def reset(self):
+        self.clock = VirtualClock()
+        self.userQ = queue.Queue()
+        self.states = dict(self.valve_states)
+        self.pumps = {}
+        self.timeline = []
+        self.invalid = []
+        self.line = 0
+        self.time_end = 0
+
+    def run(self, text):
+        """Simulate a script from start to finish.
+
+        Raises a SyntaxError if the script is not formatted properly.
+
+        Returns dict with the simulated duration in seconds, the timeline of valve and pump
+        changes, actions that could not be carried out as written and the final valve states.
+        """
+        self.reset()
+        model = ModelScript(self.userQ, self, list(self.valve_states), logger_name=f'{self.logger.name}.script', cache=self.cache, clock=self.clock)
+        time_expected = model.processScript(text).time_expected
+        self.logger.debug(f'Simulating script. Expected duration: {time_expected} s')
+        self.userQ.put('start-pause')
+        model.engine()
+        self.logger.info(f'Simulated script: {self.time_end} s, {len(self.timeline)} changes, {len(self.invalid)} invalid actions.')
+        return {'duration': self.time_end,
+                'expected': time_expected,
+                'timeline': self.timeline,
+                'invalid': self.invalid,
+                'valve_states': dict(self.states)}
+
+    def put(self, msg):
+        if msg is None:  # Script engine finished
+            self.time_end = self.clock.now()
+        elif msg[0] == 'line':
+            self.line = msg[1]
+        elif msg[0] == 'valves':
+            self.valvesSet(msg[1], msg[2])
+        elif msg[0] == 'pump':
+            self.pumpSet(msg[2], msg[1])
+        elif msg[0] == 'pause':
+            self.record('pause', [])
+            self.userQ.put('start-pause')  # Nobody to press play
+
+    def record(self, action, valves, **kwargs):
+        self.timeline.append(dict({'time': self.clock.now(), 'line': self.line, 'action': action, 'valves': valves}, **kwargs))
+
+    def reject(self, action, valves, reason):
+        self.invalid.append({'time': self.clock.now(), 'line': self.line, 'action': action, 'valves': valves, 'reason': reason})
+
+    def valvesSet(self, open_list, close_list):
+        """Apply a state change, recording one timeline entry for the opened and one for the closed valves."""
+        changes = {'open': [], 'close': []}
+        for action, valves in (('open', open_list), ('close', close_list)):
+            for valve in valves:
+                if self.valveCheck(action, valve):
+                    changes[action].append(valve)
+        if not changes['open'] and not changes['close']:
+            return
+        self.controller.setValvesState(changes['open'], changes['close'])
+        for action, valves in changes.items():
+            for valve in valves:
+                self.states[valve] = 'open' if action == 'open' else 'closed'
+            if valves:
+                self.record(action, valves)
+
+    def valveCheck(self, action, valve):
+        """Returns True if the valve can change state, otherwise records the invalid action."""
+        state = 'open' if action == 'open' else 'closed'
+        if valve not in self.states:
+            self.reject(action, [valve], 'Valve not in configuration.')
+        elif any(valve in pump for pump in self.pumps):
+            self.reject(action, [valve], 'Valve is driven by a running pump.')
+        elif self.states[valve] == state:
+            self.reject(action, [valve], f'Valve already {state}.')
+        else:
+            return True
+        return False
+
+    def pumpSet(self, valves, frequency):
+        key = tuple(valves)
+        if frequency > 0:
+            busy = [valve for pump in self.pumps if pump != key for valve in pump if valve in key]
+            if busy:
+                self.reject('pump', list(valves), f'Valves already driven by another pump: {busy}')
+                return
+            self.pumps[key] = frequency
+            self.record('pump', list(valves), frequency=frequency)
+            return
+        if valves and key not in self.pumps:
+            self.reject('pump', list(valves), 'No pump running on valves.')
+            return
+        keys = [key] if valves else list(self.pumps)
+        for key in keys:
+            del self.pumps[key]
+            self.record('pump', list(key), frequency=0)
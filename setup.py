@@ -21,7 +21,13 @@ setuptools.setup(
         'ft4222==1.12.0',
         'pyserial==3.5',
         #'waitress==3.0.2',
-        #'eventlet==0.40.2',
     ],
+    extras_require={
+        'eventlet': ['eventlet==0.41.2'],
+        'gevent': ['gevent==26.9.0'],
+        'benchmarks': ['requests==2.34.2',
+                       'python-socketio[client]==5.17.0',
+                       'websocket-client==1.9.2'],
+    },
     test_suite="tests",
 )
@@ -0,0 +1,32 @@
+import importlib.resources
+import unittest
+from unittest import mock
+
+from flask import Flask
+
+from plfluidics.server.controller import MicrofluidicController
+
+
+class SimulationTestCase(unittest.TestCase):
+    """Base of controller tests, loads the simulation config with every valve closed.
+
+    Subclasses pass extra controller arguments by overriding controllerOptions.
+    """
+    config = 'simulation_phage_ip_rev_e.config'
+
+    def setUp(self):
+        self.socketio = mock.Mock()
+        self.app = Flask(__name__)
+        self.ctrl = MicrofluidicController(self.app, self.socketio, **self.controllerOptions())
+        config_path = importlib.resources.files('plfluidics.server.configs').joinpath(self.config)
+        with open(config_path, 'r') as f:
+            config = self.ctrl.config_model.processConfig(f.read())
+        self.ctrl.valve_model.configSet(self.ctrl.config_model.configLinearize(config))
+        self.ctrl.valve_model.driverSet()
+        self.states = self.ctrl.valve_model.data['server']['valve_states']
+        for valve in self.states:
+            self.states[valve] = 'closed'
+        self.seq = self.ctrl.valve_model.state_seq
+
+    def controllerOptions(self):
+        return {}
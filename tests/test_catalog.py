@@ -0,0 +1,73 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from plfluidics.server.catalog import FileCatalog
+
+
+class TestFileCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+        self.write('b.config', {'name': 'b'})
+        self.write('a.config', {'name': 'a'})
+        os.mkdir(os.path.join(self.dir, '__pycache__'))
+        self.catalog = FileCatalog(self.dir, parse=json.loads, check_interval=0)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data, mtime=None):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+
+    def test_names_are_sorted_files(self):
+        self.assertEqual(self.catalog.names(), ['a.config', 'b.config'])
+
+    def test_content_is_read_once(self):
+        self.assertEqual(self.catalog.parsed('a.config'), {'name': 'a'})
+        with mock.patch('builtins.open', side_effect=AssertionError('file read')):
+            self.assertEqual(self.catalog.read('a.config'), '{"name": "a"}')
+            self.assertEqual(self.catalog.parsed('a.config'), {'name': 'a'})
+
+    def test_parsed_content_is_a_copy(self):
+        self.catalog.parsed('a.config')['name'] = 'changed'
+        self.assertEqual(self.catalog.parsed('a.config'), {'name': 'a'})
+
+    def test_changed_file_is_read_again(self):
+        self.catalog.parsed('a.config')
+        self.write('a.config', {'name': 'c'}, mtime=10**18)
+        self.assertEqual(self.catalog.parsed('a.config'), {'name': 'c'})
+
+    def test_added_and_removed_files_are_listed(self):
+        self.catalog.names()
+        os.remove(os.path.join(self.dir, 'b.config'))
+        self.write('c.config', {'name': 'c'})
+        self.catalog.invalidate()
+        self.assertEqual(self.catalog.names(), ['a.config', 'c.config'])
+        with self.assertRaises(FileNotFoundError):
+            self.catalog.read('b.config')
+
+    def test_checks_are_limited_by_interval(self):
+        catalog = FileCatalog(self.dir, check_interval=60)
+        catalog.read('a.config')
+        self.write('a.config', {'name': 'c'}, mtime=10**18)
+        self.assertEqual(catalog.read('a.config'), '{"name": "a"}')
+        catalog.invalidate('a.config')
+        self.assertEqual(catalog.read('a.config'), '{"name": "c"}')
+
+    def test_large_files_are_not_cached(self):
+        catalog = FileCatalog(self.dir, max_bytes=4)
+        self.assertEqual(catalog.read('a.config'), '{"name": "a"}')
+        self.assertIsNone(catalog.entries['a.config']['text'])
+        self.assertEqual(catalog.info('a.config')['size'], 13)
+
+
+if __name__ == '__main__':
+    unittest.main()
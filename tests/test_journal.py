@@ -0,0 +1,122 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from time import sleep
+from unittest import mock
+
+from flask import Flask
+
+from plfluidics.server import journal
+from plfluidics.server.controller import MicrofluidicController
+from plfluidics.server.journal import RunJournal, readJournal
+from simulation_case import SimulationTestCase
+
+HAS_NUMPY = importlib.util.find_spec('numpy') is not None
+
+
+@unittest.skipUnless(HAS_NUMPY, 'Reading journals requires NumPy')
+class TestRunJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'run.plj')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_records_are_read_back(self):
+        run = RunJournal(self.path, ['in', 'out', 'waste'], {'config_name': 'test'})
+        run.event(journal.EVENT_START, journal.SOURCE_USER, 1)
+        run.valvesSet(['waste'], ['in'], journal.SOURCE_SCRIPT)
+        run.event(journal.EVENT_STEP, journal.SOURCE_SCRIPT, 70000, flush=False)
+        run.close()
+        run.valvesSet(['in'], [])  # Ignored after close
+        meta, records = readJournal(self.path)
+        self.assertEqual(meta['valves'], ['in', 'out', 'waste'])
+        self.assertEqual(meta['config_name'], 'test')
+        self.assertEqual(records.dtype.itemsize, journal.RECORD.size)
+        self.assertEqual(records['index'].tolist(), [1, 2, 0, 70000 % 65536, 0])
+        self.assertEqual([journal.STATES[state] for state in records['state']], ['start', 'open', 'closed', 'step', 'end'])
+        self.assertEqual([journal.SOURCES[source] for source in records['source']], ['user', 'script', 'script', 'script', 'system'])
+        self.assertTrue((records['t_ns'][1:] >= records['t_ns'][:-1]).all())
+
+    def test_partial_record_is_ignored(self):
+        run = RunJournal(self.path, ['in'])
+        run.valvesSet(['in'], [])
+        run.close()
+        with open(self.path, 'ab') as f:
+            f.write(b'\x01\x02\x03')
+        _, records = readJournal(self.path)
+        self.assertEqual(len(records), 2)
+
+    def test_other_files_are_rejected(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a journal')
+        with self.assertRaises(ValueError):
+            readJournal(self.path)
+
+
+class TestControllerJournal(SimulationTestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        super().setUp()
+
+    def controllerOptions(self):
+        return {'journal_dir': self.tmp.name}
+
+    def tearDown(self):
+        self.ctrl.journalClose()
+        self.tmp.cleanup()
+
+    def records(self):
+        [name] = os.listdir(self.tmp.name)
+        meta, records = readJournal(os.path.join(self.tmp.name, name))
+        return [(journal.STATES[record['state']], journal.SOURCES[record['source']],
+                 meta['valves'][record['index']] if record['state'] <= journal.STATE_OPEN else int(record['index'])) for record in records]
+
+    @unittest.skipUnless(HAS_NUMPY, 'Reading journals requires NumPy')
+    def test_script_and_user_changes_are_journaled(self):
+        self.ctrl.journalOpen()
+        self.ctrl.scriptDispatch([(0, ['line', 3]), (0, ['valves', ['in'], []]), (0, ['pause'])])
+        self.ctrl.valveToggle({'valve': 'in'})
+        self.ctrl.journalClose()
+        self.assertEqual(self.records(), [('step', 'script', 3), ('open', 'script', 'in'), ('pause', 'script', 3),
+                                          ('closed', 'user', 'in'), ('end', 'system', 0)])
+
+    @unittest.skipUnless(HAS_NUMPY, 'Reading journals requires NumPy')
+    def test_steps_precede_their_valves(self):
+        self.ctrl.journalOpen()
+        self.ctrl.scriptDispatch([(0, ['line', 1]), (0, ['valves', ['in'], []]),
+                                  (0, ['line', 2]), (0, ['valves', ['out'], []]),
+                                  (0, ['line', 3]), (0, ['valves', [], ['in']]),
+                                  (0, ['line', 4])])
+        self.ctrl.journalClose()
+        self.assertEqual(self.records(), [('step', 'script', 1), ('step', 'script', 2), ('open', 'script', 'in'), ('open', 'script', 'out'),
+                                          ('step', 'script', 3), ('closed', 'script', 'in'), ('step', 'script', 4), ('end', 'system', 0)])
+
+    @unittest.skipUnless(HAS_NUMPY, 'Reading journals requires NumPy')
+    def test_pump_phases_are_journaled(self):
+        self.ctrl.journalOpen()
+        self.ctrl.scriptDispatch([(0, ['line', 1]), (0, ['pump', 50, ['in', 'out', 'waste']])])
+        sleep(0.1)
+        self.ctrl.scriptDispatch([(0, ['line', 2]), (0, ['pump', 0, []])])
+        self.ctrl.journalClose()
+        records = self.records()
+        self.assertEqual(records[0], ('step', 'script', 1))
+        self.assertEqual(records[1:4], [('open', 'pump', 'out'), ('closed', 'pump', 'in'), ('closed', 'pump', 'waste')])
+        step = records.index(('step', 'script', 2))
+        pump = [record for record in records[1:step] if record[1] == 'pump']
+        self.assertEqual(len(pump), step - 1)
+        self.assertGreater(len(pump), 3)
+        self.assertEqual(records[step + 1:], [('closed', 'pump', 'in'), ('closed', 'pump', 'out'), ('closed', 'pump', 'waste'), ('end', 'system', 0)])
+
+    def test_disabled_without_directory(self):
+        ctrl = MicrofluidicController(Flask(__name__), mock.Mock())
+        ctrl.journalOpen()
+        self.assertIsNone(ctrl.journal)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import logging
+import unittest
+
+from plfluidics.server.logstream import LogHistory, LogStream
+
+
+class TestLogStream(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = LogStream(backlog=3)
+        self.stream.connect('a')
+        self.stream.connect('b')
+
+    def test_records_are_batched_per_client(self):
+        self.stream.put(['1', '2'])
+        frames = self.stream.frames()
+        self.assertEqual(frames, [['a', {'msgs': ['1', '2'], 'dropped': 0}], ['b', {'msgs': ['1', '2'], 'dropped': 0}]])
+        self.assertFalse(self.stream.pending())
+        self.assertEqual(self.stream.frames(), [])
+
+    def test_client_behind_drops_oldest_records(self):
+        self.stream.put(['1'])
+        self.stream.frames()
+        self.stream.ack('b')
+        self.stream.put(['2', '3', '4', '5'])
+        self.assertEqual(self.stream.frames(), [['b', {'msgs': ['3', '4', '5'], 'dropped': 1}]])
+        self.assertTrue(self.stream.pending())
+        self.stream.ack('a')
+        self.assertEqual(self.stream.frames(), [['a', {'msgs': ['3', '4', '5'], 'dropped': 1}]])
+
+    def test_lost_frame_times_out(self):
+        self.stream.ack_timeout = 0
+        self.stream.disconnect('b')
+        self.stream.put(['1'])
+        self.stream.frames()
+        self.stream.put(['2'])
+        self.assertEqual(self.stream.frames(), [['a', {'msgs': ['2'], 'dropped': 0}]])
+
+
+class TestLogHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.history = LogHistory(capacity=4)
+        self.logger = logging.getLogger('test_logstream.history')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.logger.addHandler(self.history)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.history)
+
+    def test_ring_buffer_keeps_most_recent_records(self):
+        for index in range(6):
+            self.logger.info(f'msg {index}')
+        self.assertEqual(self.history.count, 6)
+        self.assertEqual(self.history.first(), 2)
+        self.assertEqual([record['msg'] for record in self.history.tail(10)], ['msg 2', 'msg 3', 'msg 4', 'msg 5'])
+        self.assertEqual(self.history.tail(1)[0]['seq'], 5)
+        self.assertEqual(self.history.tail(1)[0]['level'], 'INFO')
+
+    def test_pages_before_record_number(self):
+        for index in range(6):
+            self.logger.info(f'msg {index}')
+        self.assertEqual([record['seq'] for record in self.history.page(5, 2)], [3, 4])
+        self.assertEqual([record['seq'] for record in self.history.page(4, 5)], [2, 3])
+        self.assertEqual(self.history.page(2, 5), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
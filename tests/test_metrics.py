@@ -0,0 +1,99 @@
+import unittest
+
+from plfluidics.hardware.valve_controller import SimulatedValveController
+from plfluidics.server.metrics import CounterMetrics, LatencyHistogram, LatencyMetrics, TimedQueue, prometheusText
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_percentiles_within_bucket_resolution(self):
+        histogram = LatencyHistogram()
+        for i in range(1, 101):
+            histogram.record(i * 1e-4)  # 0.1 ms to 10 ms
+        summary = histogram.summary()
+        self.assertEqual(summary['count'], 100)
+        self.assertAlmostEqual(summary['max_ms'], 10)
+        self.assertTrue(5 <= summary['p50_ms'] <= 5 * 1.19)
+        self.assertTrue(9.9 <= summary['p99_ms'] <= 10)
+
+    def test_empty_histogram(self):
+        self.assertEqual(LatencyHistogram().summary()['p99_ms'], 0)
+
+    def test_buckets_are_cumulative(self):
+        histogram = LatencyHistogram()
+        for seconds in [1e-6, 3e-6, 1e-3, 1e3]:
+            histogram.record(seconds)
+        buckets = histogram.buckets()
+        self.assertEqual(buckets[0], [1e-6, 1])
+        self.assertEqual(buckets[2][1], 2)  # 4 us
+        self.assertEqual(buckets[-2][1], 3)
+        self.assertEqual(buckets[-1], [float('inf'), 4])
+        self.assertEqual([count for _, count in buckets], sorted(count for _, count in buckets))
+
+
+class TestLatencyMetrics(unittest.TestCase):
+
+    def test_histograms_are_keyed_by_hop_op_and_driver(self):
+        metrics = LatencyMetrics()
+        metrics.record('queue', 'open', 0.001, 'plrd1')
+        metrics.record('queue', 'open', 0.002, 'plrd1')
+        metrics.recorder('simulation')('write', 'close', 0.003)
+        summary = metrics.summary()
+        self.assertEqual([(entry['driver'], entry['op'], entry['hop'], entry['count']) for entry in summary],
+                         [('plrd1', 'open', 'queue', 2), ('simulation', 'close', 'write', 1)])
+        metrics.reset()
+        self.assertEqual(metrics.summary(), [])
+
+    def test_valve_controller_records_lock_and_write(self):
+        metrics = LatencyMetrics()
+        controller = SimulatedValveController([[0, False, False, 'in']])
+        controller.latency = metrics.recorder('simulation')
+        controller.setValveOpen('in')
+        controller.setValveClose('in')
+        hops = {(entry['op'], entry['hop']) for entry in metrics.summary()}
+        self.assertEqual(hops, {('open', 'lock'), ('open', 'write'), ('close', 'lock'), ('close', 'write')})
+
+    def test_timed_queue_stamps_items(self):
+        q = TimedQueue()
+        q.put(['open', 'in'])
+        stamp, item = q.get_nowait()
+        self.assertEqual(item, ['open', 'in'])
+        self.assertIsInstance(stamp, float)
+
+    def test_timed_queue_counts_tasks(self):
+        q = TimedQueue()
+        q.put('a')
+        q.put_nowait('b')
+        self.assertEqual([q.get()[1], q.get_nowait()[1]], ['a', 'b'])
+        q.task_done()
+        q.task_done()
+        with self.assertRaises(ValueError):
+            q.task_done()
+
+
+class TestPrometheusText(unittest.TestCase):
+
+    def test_counters_gauges_and_histograms(self):
+        counters = CounterMetrics()
+        counters.inc('valve_ops', op='open')
+        counters.inc('valve_ops', 2, op='open')
+        counters.inc('emits', event='update')
+        latency = LatencyMetrics()
+        latency.record('write', 'open', 0.002, 'simulation')
+        gauges = [{'name': 'queue_depth', 'labels': {'queue': 'user'}, 'value': 3}]
+        lines = prometheusText(counters.values(), gauges, latency.buckets()).splitlines()
+        self.assertIn('# TYPE plfluidics_valve_ops_total counter', lines)
+        self.assertIn('plfluidics_valve_ops_total{op="open"} 3', lines)
+        self.assertIn('plfluidics_emits_total{event="update"} 1', lines)
+        self.assertIn('# TYPE plfluidics_queue_depth gauge', lines)
+        self.assertIn('plfluidics_queue_depth{queue="user"} 3', lines)
+        self.assertIn('plfluidics_latency_seconds_bucket{hop="write",op="open",driver="simulation",le="+Inf"} 1', lines)
+        self.assertIn('plfluidics_latency_seconds_count{hop="write",op="open",driver="simulation"} 1', lines)
+
+    def test_label_values_are_escaped(self):
+        text = prometheusText([{'name': 'emits', 'labels': {'event': 'a"b'}, 'value': 1}], [], [])
+        self.assertIn('plfluidics_emits_total{event="a\\"b"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -113,5 +113,11 @@ class TestModelConfig(unittest.TestCase):
         self.assertIn('bsa', result['valves'])
         self.assertFalse(result['valves']['bsa']['inv_polarity'])
 
+    def test_lowercaseDict_keeps_valve_order(self):
+        names = [f'V{i}' for i in range(20)][::-1]
+        data = {'Valves': {name: {'Solenoid_Number': i} for i, name in enumerate(names)}}
+        result = self.model.lowercaseDict(data)
+        self.assertEqual(list(result['valves']), [name.lower() for name in names])
+
 if __name__ == '__main__':
     unittest.main()
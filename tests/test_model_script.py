@@ -1,6 +1,9 @@
 import unittest
+from unittest import mock
 import queue
+import threading
 from plfluidics.server.models import ModelScript
+from plfluidics.server.script import OP_OPEN, OP_WAIT, OP_CLOSE
 
 class TestModelScript(unittest.TestCase):
     def setUp(self):
@@ -11,12 +14,12 @@ class TestModelScript(unittest.TestCase):
 
     def test_processScript_valid(self):
         script = "open waste\r\nwait 1 s\r\nclose waste\r\nwait 1 m"
-        processed, approx_time = self.model.processScript(script)
-        self.assertEqual(processed[0], ['open', 'waste'])
-        self.assertEqual(processed[1], ['wait', 1])
-        self.assertEqual(processed[2], ['close', 'waste'])
-        self.assertEqual(processed[3], ['wait', 60])
-        self.assertEqual(approx_time, 61)
+        program = self.model.processScript(script)
+        self.assertEqual(program[0], ['open', 'waste'])
+        self.assertEqual(program[1], ['wait', 1])
+        self.assertEqual(program[2], ['close', 'waste'])
+        self.assertEqual(program[3], ['wait', 60])
+        self.assertEqual(program.time_expected, 61)
 
         def test_processScript_pause(self):
             script = "pause"
@@ -90,4 +93,232 @@ class TestModelScript(unittest.TestCase):
             processed, approx_time = self.model.processScript(script)
             self.assertEqual(processed[0], ['wait', 3600])
             self.assertEqual(approx_time, 3600)
-unittest.main()
+
+    def test_processScript_compiles_program(self):
+        self.model.valve_list = ['in', 'waste']
+        program = self.model.processScript("open waste\nwait 2 s\n# comment\nclose in")
+        self.assertEqual(len(program), 3)
+        self.assertEqual(list(program.ops), [OP_OPEN, OP_WAIT, OP_CLOSE])
+        self.assertEqual(list(program.masks), [0b10, 0, 0b01])
+        self.assertEqual(program.values[1], 2)
+        self.assertEqual(program[2], ['close', 'in'])
+        self.assertEqual(program.time_expected, 2)
+
+    def test_processScript_multiple_valves(self):
+        self.model.valve_list = ['in', 'out', 'waste']
+        program = self.model.processScript("open in waste\nwait 1 s\nclose in out waste # all")
+        self.assertEqual(list(program.masks), [0b101, 0, 0b111])
+        self.assertEqual(program[0], ['open', 'in', 'waste'])
+        with self.assertRaises(SyntaxError):
+            self.model.processScript("open in drain")
+
+    def test_processScript_merges_simultaneous_valve_changes(self):
+        self.model.valve_list = ['in', 'out', 'waste']
+        program = self.model.processScript("open in\nopen out\nwait 0 s\nclose waste\nclose in\nwait 1 s\nopen waste\nrepeat 2 {\nclose waste\n}")
+        self.assertEqual(len(program), 6)
+        self.assertEqual(program[0], ['set', ['out'], ['in', 'waste']])
+        self.assertEqual(program.lines[0], 1)
+        self.assertEqual(program[2], ['open', 'waste'])
+        self.assertEqual(program[4], ['close', 'waste'])  # Loop body is not merged with the step before the loop
+
+    def test_processScript_line_times(self):
+        self.model.valve_list = ['in', 'waste']
+        script = "open in\nwait 2 s\n# rinse\nrepeat 3 {\n  wait 1 s\n  close in\n}\nwait 5 s\ntrack side {\n  wait 4 s\n  open waste\n}"
+        program = self.model.processScript(script)
+        self.assertEqual([program.timeAtLine(line) for line in range(1, 13)], [0, 0, 2, 2, 2, 3, 5, 5, 0, 0, 4, 4])
+        self.assertEqual(program.time_expected, 10)
+        with self.assertRaises(IndexError):
+            program.timeAtLine(20)
+
+    def test_processScript_repeat_blocks(self):
+        script = "repeat 3 {\n  open waste\n  repeat 2 {\n    wait 1 s\n  }\n  close waste\n}"
+        program = self.model.processScript(script)
+        self.assertEqual(len(program), 7)
+        self.assertEqual(program.time_expected, 6)
+        self.assertEqual(program[0], ['repeat', 3])
+        with self.assertRaises(SyntaxError):
+            self.model.processScript("repeat 2 {\nopen waste")
+        with self.assertRaises(SyntaxError):
+            self.model.processScript("open waste\n}")
+
+    def test_engine_iterates_repeat_blocks(self):
+        self.model.processScript("repeat 3 {\nopen waste\nwait 1 ms\nclose waste\n}")
+        engine = threading.Thread(target=self.model.engine, daemon=True)
+        engine.start()
+        self.userQ.put('start-pause')
+        engine.join(timeout=2)
+        self.assertFalse(engine.is_alive())
+        msgs = []
+        while not self.scriptQ.empty():
+            msgs.append(self.scriptQ.get())
+        valve_msgs = [msg for msg in msgs if msg and msg[0] == 'valves']
+        self.assertEqual(valve_msgs, [['valves', ['waste'], []], ['valves', [], ['waste']]] * 3)
+        lines = [msg[1] for msg in msgs if msg and msg[0] == 'line']
+        self.assertEqual(lines[:4], [2, 3, 4, 2])
+
+    def test_processScript_pump_sequence(self):
+        self.model.valve_list = ['p1', 'p2', 'p3']
+        program = self.model.processScript("pump 5 hz p1 p2 p3\nwait 1 s\npump 0 hz")
+        self.assertEqual(program[0], ['pump', 5, 'p1', 'p2', 'p3'])
+        self.assertEqual(program[2], ['pump', 0])
+        with self.assertRaises(SyntaxError):
+            self.model.processScript("pump 5 hz p1 p2")
+
+    def test_processScript_tracks(self):
+        self.model.valve_list = ['in', 'waste']
+        script = "open in\nwait 1 s\ntrack wash {\n  repeat 2 {\n    wait 2 s\n  }\n}\nclose in"
+        program = self.model.processScript(script)
+        self.assertEqual(program.tracks, [['wash', 3, 4]])
+        self.assertEqual(program.time_expected, 4)
+        with self.assertRaises(SyntaxError):
+            self.model.processScript("repeat 2 {\ntrack wash {\n}\n}")
+
+    def test_engine_interleaves_tracks(self):
+        self.model.valve_list = ['in', 'waste']
+        script = "open in\nwait 60 ms\nclose in\ntrack wash {\n  wait 30 ms\n  open waste\n  wait 60 ms\n  close waste\n}"
+        self.model.processScript(script)
+        engine = threading.Thread(target=self.model.engine, daemon=True)
+        engine.start()
+        self.userQ.put('start-pause')
+        engine.join(timeout=2)
+        self.assertFalse(engine.is_alive())
+        msgs = []
+        while not self.scriptQ.empty():
+            msgs.append(self.scriptQ.get())
+        valve_msgs = [msg for msg in msgs if msg and msg[0] == 'valves']
+        self.assertEqual(valve_msgs, [['valves', ['in'], []], ['valves', ['waste'], []], ['valves', [], ['in']], ['valves', [], ['waste']]])
+
+    def test_validate_reports_every_error(self):
+        self.model.valve_list = ['in', 'waste']
+        script = "open inlet\nwait 1 s\nrepeat 2 {\nwait x s\n}\n}\ntrack a {"
+        diagnostics = self.model.validate(script)
+        self.assertEqual([d['line'] for d in diagnostics], [1, 4, 6, 7])
+        self.assertTrue(diagnostics[0]['msg'].startswith('Script formatting error. Line 1 :'))
+
+    def test_validate_parses_changed_lines_only(self):
+        self.model.valve_list = ['in', 'waste']
+        lines = ['open in', 'wait 1 s', 'close in'] * 100
+        self.assertEqual(self.model.validate('\n'.join(lines)), [])
+        lines.insert(150, 'open inlet')
+        with mock.patch.object(self.model, 'lineStep', wraps=self.model.lineStep) as parse:
+            diagnostics = self.model.validate('\n'.join(lines))
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual([d['line'] for d in diagnostics], [151])
+
+    def test_engine_runs_script_to_completion(self):
+        self.model.processScript("open waste\nwait 20 ms\nclose waste")
+        engine = threading.Thread(target=self.model.engine, daemon=True)
+        engine.start()
+        self.userQ.put('start-pause')
+        engine.join(timeout=2)
+        self.assertFalse(engine.is_alive())
+        msgs = []
+        while not self.scriptQ.empty():
+            msgs.append(self.scriptQ.get())
+        valve_msgs = [msg for msg in msgs if msg and msg[0] == 'valves']
+        self.assertEqual(valve_msgs, [['valves', ['waste'], []], ['valves', [], ['waste']]])
+        self.assertIsNone(msgs[-1])
+        self.assertEqual(self.model.state, 'idle')
+
+    def test_engine_blocks_while_paused(self):
+        self.model.processScript("pause\nopen waste")
+        engine = threading.Thread(target=self.model.engine, daemon=True)
+        engine.start()
+        self.userQ.put('start-pause')
+        engine.join(timeout=0.2)
+        self.assertTrue(engine.is_alive())
+        self.assertEqual(self.model.state, 'paused')
+        self.assertIsNone(self.model.interruptTimeout())
+        self.userQ.put('start-pause')
+        engine.join(timeout=2)
+        self.assertFalse(engine.is_alive())
+
+    def test_engine_waits_follow_absolute_timeline(self):
+        self.model.processScript("open waste\nwait 30 ms\nclose waste\nwait 30 ms\nopen waste\nwait 30 ms")
+        engine = threading.Thread(target=self.model.engine, daemon=True)
+        engine.start()
+        self.userQ.put('start-pause')
+        engine.join(timeout=2)
+        self.assertFalse(engine.is_alive())
+        timing = self.model.timingGet()
+        self.assertEqual(timing['steps'], 3)
+        self.assertEqual([line for line, _ in timing['lateness']], [2, 4, 6])
+        self.assertGreaterEqual(min(late for _, late in timing['lateness']), 0)
+
+    def test_seek_reconstructs_valve_and_pump_state(self):
+        self.model.valve_list = ['in', 'waste', 'p1', 'p2', 'p3']
+        script = "open in\npump 5 hz p1 p2 p3\nrepeat 3 {\n  close in\n  open waste\n  wait 1 s\n}\nclose waste\nwait 1 s"
+        program = self.model.processScript(script)
+        pc, loops, open_mask, close_mask, pumps = program.seek(6)
+        self.assertEqual(program.lines[pc], 6)
+        self.assertEqual(len(loops), 1)
+        self.assertEqual(program.maskValves(open_mask), ['waste'])
+        self.assertEqual(program.maskValves(close_mask), ['in'])
+        self.assertEqual(pumps, [[5, ['p1', 'p2', 'p3']]])
+        self.assertEqual(program.timeAtLine(6), 0)
+        _, loops, open_mask, close_mask, _ = program.seek(9)
+        self.assertEqual(loops, [])
+        self.assertEqual(program.maskValves(close_mask), ['in', 'waste'])
+        with self.assertRaises(ValueError):
+            program.seek(20)
+
+    def test_seek_rejects_tracks_and_skipped_loops(self):
+        self.model.valve_list = ['in', 'waste']
+        program = self.model.processScript("open in\ntrack wash {\n  wait 1 s\n}")
+        with self.assertRaises(ValueError):
+            program.seek(3)
+        program = self.model.processScript("repeat 0 {\n  open in\n}\nclose in")
+        with self.assertRaises(ValueError):
+            program.seek(2)
+        self.assertEqual(program.maskValves(program.seek(4)[3]), [])
+
+    def test_engine_starts_at_seek_line(self):
+        self.model.valve_list = ['in', 'waste']
+        self.model.processScript("open in\nwait 10 s\nopen waste\nwait 10 s\nclose in\nwait 10 ms")
+        self.model.seek(5)
+        engine = threading.Thread(target=self.model.engine, daemon=True)
+        engine.start()
+        self.userQ.put('start-pause')
+        engine.join(timeout=2)
+        self.assertFalse(engine.is_alive())
+        msgs = []
+        while not self.scriptQ.empty():
+            msgs.append(self.scriptQ.get())
+        valve_msgs = [msg for msg in msgs if msg and msg[0] == 'valves']
+        self.assertEqual(valve_msgs, [['valves', ['in', 'waste'], []], ['valves', [], ['in']]])
+        self.assertIsNone(self.model.seek_line)
+
+    def test_processStream_splits_at_top_level(self):
+        self.model.valve_list = ['in', 'waste']
+        self.model.stream_steps = 2
+        lines = ['open in', 'wait 1 s', 'repeat 2 {', 'close in', 'wait 1 s', '}', 'open waste']
+        chunks = list(self.model.processStream(iter(lines)))
+        self.assertEqual([list(chunk.lines) for chunk in chunks], [[1, 2], [3, 4, 5, 6], [7]])
+        self.assertEqual([chunk.time_expected for chunk in chunks], [1, 2, 0])
+        with self.assertRaises(SyntaxError):
+            list(self.model.processStream(iter(['track wash {', '}'])))
+        self.model.stream_block_steps = 2
+        with self.assertRaises(SyntaxError):
+            list(self.model.processStream(iter(lines)))
+
+    def test_engine_runs_streamed_script(self):
+        self.model.valve_list = ['in', 'waste']
+        self.model.stream_steps = 2
+        lines = ['open in', 'wait 1 ms', 'repeat 2 {', 'close in', 'wait 1 ms', '}', 'open waste', 'wait 1 ms', 'close waste']
+        self.model.loadStream(iter(lines))
+        engine = threading.Thread(target=self.model.engine, daemon=True)
+        engine.start()
+        self.userQ.put('start-pause')
+        engine.join(timeout=2)
+        self.assertFalse(engine.is_alive())
+        msgs = []
+        while not self.scriptQ.empty():
+            msgs.append(self.scriptQ.get())
+        valve_msgs = [msg for msg in msgs if msg and msg[0] == 'valves']
+        self.assertEqual(valve_msgs, [['valves', ['in'], []], ['valves', [], ['in']], ['valves', [], ['in']],
+                                      ['valves', ['waste'], []], ['valves', [], ['waste']]])
+        self.assertIsNone(self.model.stream)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import unittest
+from time import sleep
+from plfluidics.hardware.valve_controller import SimulatedValveController
+from plfluidics.hardware.peristaltic_pump import PeristalticPump
+
+class TestPeristalticPump(unittest.TestCase):
+    def setUp(self):
+        valves = [[0, False, False, 'p1'], [1, False, False, 'p2'], [2, False, False, 'p3']]
+        self.controller = SimulatedValveController(valves)
+
+    def test_phaseTable_three_valves(self):
+        phases = PeristalticPump.phaseTable(3)
+        pattern = [''.join('1' if closed else '0' for closed in phase) for phase in phases]
+        self.assertEqual(pattern, ['101', '100', '110', '010', '011', '001'])
+
+    def test_phaseTable_changes_one_valve_per_phase(self):
+        phases = PeristalticPump.phaseTable(5)
+        for index, phase in enumerate(phases):
+            changes = sum(a != b for a, b in zip(phase, phases[index - 1]))
+            self.assertEqual(changes, 1)
+
+    def test_requires_three_valves(self):
+        with self.assertRaises(ValueError):
+            PeristalticPump(self.controller, ['p1', 'p2'], 5)
+
+    def test_pump_runs_at_requested_frequency(self):
+        pump = PeristalticPump(self.controller, ['p1', 'p2', 'p3'], 20)
+        pump.start()
+        sleep(0.5)
+        pump.stop()
+        status = pump.statusGet()
+        self.assertFalse(status['running'])
+        self.assertGreaterEqual(status['cycles'], 9)
+        self.assertAlmostEqual(status['achieved'], 20, delta=1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import queue
+import tempfile
+import unittest
+from unittest import mock
+
+from plfluidics.server.models import ModelScript
+from plfluidics.server.script import ScriptCache
+
+
+class TestScriptCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ScriptCache(size=2)
+        self.model = ModelScript(queue.Queue(), queue.Queue(), ['in', 'waste'], cache=self.cache)
+
+    def test_key_depends_on_text_and_valves(self):
+        key = self.cache.key('open in', ['in', 'waste'])
+        self.assertEqual(key, self.cache.key('open in', ['in', 'waste']))
+        self.assertNotEqual(key, self.cache.key('open in ', ['in', 'waste']))
+        self.assertNotEqual(key, self.cache.key('open in', ['waste', 'in']))
+
+    def test_unchanged_script_is_not_parsed(self):
+        script = "open in\nwait 1 s\nclose in"
+        program = self.model.processScript(script)
+        with mock.patch.object(self.model, 'parseLine') as parse:
+            self.assertIs(self.model.processScript(script), program)
+            parse.assert_not_called()
+        self.assertEqual(self.model.time_expected, 1)
+        self.assertEqual(self.cache.statusGet()['hits'], 1)
+
+    def test_invalid_script_is_not_cached(self):
+        with self.assertRaises(SyntaxError):
+            self.model.processScript("open outlet")
+        with self.assertRaises(SyntaxError):
+            self.model.processScript("open outlet")
+        self.assertEqual(self.cache.statusGet()['programs'], 0)
+
+    def test_least_recently_used_program_is_evicted(self):
+        self.model.processScript("open in")
+        self.model.processScript("open waste")
+        self.model.processScript("open in")
+        self.model.processScript("close in")
+        self.assertIsNotNone(self.cache.programs.get(self.cache.key("open in", ['in', 'waste'])))
+        self.assertIsNone(self.cache.programs.get(self.cache.key("open waste", ['in', 'waste'])))
+
+    def test_persisted_programs_survive_restart(self):
+        with tempfile.TemporaryDirectory() as persist_dir:
+            script = "repeat 3 {\nopen in\nwait 2 s\nclose in\n}"
+            ModelScript(queue.Queue(), queue.Queue(), ['in', 'waste'], cache=ScriptCache(persist_dir=persist_dir)).processScript(script)
+            model = ModelScript(queue.Queue(), queue.Queue(), ['in', 'waste'], cache=ScriptCache(persist_dir=persist_dir))
+            with mock.patch.object(model, 'parseLine') as parse:
+                program = model.processScript(script)
+                parse.assert_not_called()
+            self.assertEqual(program.time_expected, 6)
+            self.assertEqual(program[1], ['open', 'in'])
+
+    def test_persisted_programs_are_evicted(self):
+        with tempfile.TemporaryDirectory() as persist_dir:
+            cache = ScriptCache(persist_dir=persist_dir, persist_size=2)
+            model = ModelScript(queue.Queue(), queue.Queue(), ['in', 'waste'], cache=cache)
+            for mtime, script in enumerate(["open in", "open waste", "close in"], start=1):
+                model.processScript(script)
+                os.utime(os.path.join(persist_dir, cache.key(script, ['in', 'waste']) + '.program'), ns=(mtime, mtime))
+            self.assertEqual(sorted(os.listdir(persist_dir)),
+                             sorted(cache.key(script, ['in', 'waste']) + '.program' for script in ["open waste", "close in"]))
+
+    def test_unwritable_directory_keeps_programs_in_memory(self):
+        with tempfile.NamedTemporaryFile() as f:
+            cache = ScriptCache(persist_dir=os.path.join(f.name, 'script_cache'))
+        self.assertIsNone(cache.persist_dir)
+        ModelScript(queue.Queue(), queue.Queue(), ['in'], cache=cache).processScript("open in")
+        self.assertEqual(cache.statusGet()['programs'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from time import sleep
+from unittest import mock
+
+from simulation_case import SimulationTestCase
+
+
+class TestScriptDispatch(SimulationTestCase):
+
+    def test_burst_is_one_transaction_and_one_frame(self):
+        batch = [(0, ['valves', ['in'], []]), (0, ['line', 1]), (0, ['valves', ['out'], ['waste']]),
+                 (0, ['line', 2]), (0, ['progress', {'line': 2}])]
+        with mock.patch.object(self.ctrl.valve_model, 'setValves', wraps=self.ctrl.valve_model.setValves) as set_valves:
+            self.assertFalse(self.ctrl.scriptDispatch(batch))
+        set_valves.assert_called_once_with(['in', 'out'], [])
+        bits = format(self.ctrl.valve_model.valveBits(['in', 'out']), 'x')
+        self.socketio.emit.assert_called_once_with('state', {'v': 1, 'seq': self.seq + 2, 'base': self.seq, 'changed': bits, 'open': bits,
+                                                             'script': {'line': 2, 'progress': {'line': 2}}})
+
+    def test_conflicting_changes_are_applied_in_order(self):
+        batch = [(0, ['valves', ['in'], []]), (0, ['valves', [], ['in']]), (0, ['pause']), (0, None)]
+        with mock.patch.object(self.ctrl.valve_model, 'setValves', wraps=self.ctrl.valve_model.setValves) as set_valves:
+            self.assertTrue(self.ctrl.scriptDispatch(batch))
+        self.assertEqual(set_valves.call_args_list, [mock.call(['in'], []), mock.call([], ['in'])])
+        self.assertEqual(self.states['in'], 'closed')
+        self.assertEqual(self.ctrl.valve_model.state_seq, self.seq + 3)  # Two transactions and the pause
+        bit = format(self.ctrl.valve_model.valveBits(['in']), 'x')
+        self.socketio.emit.assert_called_once_with('state', {'v': 1, 'seq': self.seq + 3, 'base': self.seq, 'changed': bit, 'open': '0',
+                                                             'script': {'state': 'paused'}})
+
+    def test_pump_status_is_reported_while_pumping(self):
+        self.ctrl.scriptDispatch([(0, ['pump', 50, ['in', 'out', 'waste']])])
+        sleep(0.1)
+        gauges = {gauge['name']: gauge for gauge in self.ctrl.metricsJson()['gauges'] if gauge['name'].startswith('pump_')}
+        text, _, _ = self.ctrl.metricsGet()
+        self.ctrl.scriptDispatch([(0, ['pump', 0, []])])
+        self.assertEqual(gauges['pump_requested_hz'], {'name': 'pump_requested_hz', 'labels': {'valves': 'in out waste'}, 'value': 50})
+        self.assertGreater(gauges['pump_achieved_hz']['value'], 0)
+        self.assertIn('plfluidics_pump_achieved_hz{valves="in out waste"}', text)
+        self.assertFalse([gauge for gauge in self.ctrl.metricsGauges() if gauge['name'].startswith('pump_')])
+
+
+if __name__ == '__main__':
+    unittest.main()
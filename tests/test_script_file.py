@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from time import sleep
+
+from plfluidics.server.script import ChunkPrefetch, ScriptFile
+
+
+class TestScriptFile(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'script')
+        with open(self.path, 'w', newline='') as f:
+            f.write('\r\n'.join(f'wait {line} s' for line in range(1, 1001)))
+        self.script_file = ScriptFile(self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_lines_are_read_without_line_breaks(self):
+        self.assertEqual(self.script_file.line_count, 1000)
+        lines = list(self.script_file.lines())
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines[0], 'wait 1 s')
+        self.assertEqual(lines[-1], 'wait 1000 s')
+
+    def test_window_is_centered_on_line(self):
+        self.assertEqual(self.script_file.window(500, 5), [498, ['wait 498 s', 'wait 499 s', 'wait 500 s', 'wait 501 s', 'wait 502 s']])
+        self.assertEqual(self.script_file.window(1, 3), [1, ['wait 1 s', 'wait 2 s', 'wait 3 s']])
+        self.assertEqual(self.script_file.window(1000, 3), [998, ['wait 998 s', 'wait 999 s', 'wait 1000 s']])
+
+
+class TestChunkPrefetch(unittest.TestCase):
+
+    def waitFor(self, condition):
+        for _ in range(100):
+            if condition():
+                return
+            sleep(0.01)
+
+    def test_one_chunk_is_compiled_ahead(self):
+        compiled = []
+        def chunks():
+            for chunk in range(3):
+                compiled.append(chunk)
+                yield chunk
+        prefetch = ChunkPrefetch(chunks(), timeout=0.01)
+        self.waitFor(lambda: len(compiled) == 2)
+        sleep(0.05)
+        self.assertEqual(compiled, [0, 1])  # Queued chunk and the chunk waiting for the queue
+        self.assertEqual(prefetch.next(), 0)
+        self.waitFor(lambda: len(compiled) == 3)
+        self.assertEqual(compiled, [0, 1, 2])
+        self.assertEqual([prefetch.next(), prefetch.next(), prefetch.next()], [1, 2, None])
+
+    def test_syntax_error_is_raised_in_order(self):
+        def chunks():
+            yield 0
+            raise SyntaxError('Script formatting error.')
+        prefetch = ChunkPrefetch(chunks())
+        self.assertEqual(prefetch.next(), 0)
+        with self.assertRaises(SyntaxError):
+            prefetch.next()
+
+    def test_closed_prefetch_stops_compiling(self):
+        def chunks():
+            while True:
+                yield 0
+        prefetch = ChunkPrefetch(chunks(), timeout=0.01)
+        prefetch.close()
+        prefetch.thread.join(timeout=1)
+        self.assertFalse(prefetch.thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
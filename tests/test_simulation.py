@@ -0,0 +1,70 @@
+import queue
+import unittest
+
+from plfluidics.server.clock import VirtualClock
+from plfluidics.server.simulation import ScriptSimulator
+
+
+class TestVirtualClock(unittest.TestCase):
+
+    def test_timed_get_advances_time(self):
+        clock = VirtualClock()
+        with self.assertRaises(queue.Empty):
+            clock.get(queue.Queue(), timeout=2.5)
+        self.assertEqual(clock.now(), 2.5)
+
+    def test_get_returns_pending_item_without_advancing(self):
+        clock = VirtualClock()
+        q = queue.Queue()
+        q.put('skip')
+        self.assertEqual(clock.get(q, timeout=10), 'skip')
+        self.assertEqual(clock.now(), 0)
+
+    def test_tiny_steps_still_advance(self):
+        clock = VirtualClock(start=60)
+        clock.advance(1e-16)
+        self.assertGreater(clock.now(), 60)
+
+
+class TestScriptSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.simulator = ScriptSimulator({'in': 'closed', 'out': 'closed', 'p1': 'closed', 'p2': 'closed', 'p3': 'closed'})
+
+    def test_hours_of_waits_run_instantly(self):
+        result = self.simulator.run("repeat 6 {\nopen in\nwait 30 m\nclose in\nwait 30 m\n}")
+        self.assertEqual(result['duration'], 6 * 3600)
+        self.assertEqual(result['expected'], 6 * 3600)
+        self.assertEqual(len(result['timeline']), 12)
+        self.assertEqual(result['timeline'][1], {'time': 1800, 'line': 4, 'action': 'close', 'valves': ['in']})
+        self.assertEqual(result['invalid'], [])
+
+    def test_tracks_share_the_virtual_timeline(self):
+        result = self.simulator.run("wait 10 s\nopen in\ntrack side {\nwait 4 s\nopen out\n}")
+        self.assertEqual([(event['time'], event['valves']) for event in result['timeline']], [(4, ['out']), (10, ['in'])])
+        self.assertEqual(result['duration'], 10)
+
+    def test_pause_steps_resume_automatically(self):
+        result = self.simulator.run("open in\npause\nwait 5 s\nclose in")
+        self.assertEqual([event['action'] for event in result['timeline']], ['open', 'pause', 'close'])
+        self.assertEqual(result['duration'], 5)
+
+    def test_invalid_actions_are_reported(self):
+        result = self.simulator.run("open in\nwait 1 s\nopen in\npump 2 hz p1 p2 p3\nwait 1 s\nclose p2\npump 0 hz p1 p2 p3\npump 0 hz in out p1")
+        self.assertEqual([(action['line'], action['reason']) for action in result['invalid']],
+                         [(3, 'Valve already open.'), (6, 'Valve is driven by a running pump.'), (8, 'No pump running on valves.')])
+        self.assertEqual(result['valve_states']['in'], 'open')
+
+    def test_simultaneous_changes_are_one_timeline_step(self):
+        result = self.simulator.run("open in out\nclose p1\nopen p1\nwait 1 s\nclose in out")
+        self.assertEqual([(event['time'], event['action'], event['valves']) for event in result['timeline']],
+                         [(0, 'open', ['in', 'out', 'p1']), (1, 'close', ['in', 'out'])])
+        self.assertEqual(result['invalid'], [])
+
+    def test_invalid_script_raises(self):
+        with self.assertRaises(SyntaxError):
+            self.simulator.run("open drain")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import unittest
+
+from plfluidics.hardware.valve_controller import ValveControllerFT425R, ValveControllerPLRD1, ValveControllerRGS
+
+
+class FakeDRV81008():
+    addr_en = 0x0000
+
+    def __init__(self):
+        self.en = 0
+        self.writes = []
+
+    def cmdWriteAddr(self, addr, data):
+        self.writes.append(data)
+        self.en = data
+
+
+class FakeUSB():
+
+    def __init__(self):
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append(data)
+
+
+class FakePLRD1(ValveControllerPLRD1):
+
+    def _initValveBanks(self, valve_param_list):
+        self.device = {'A': FakeDRV81008(), 'B': FakeDRV81008(), 'C': FakeDRV81008()}
+
+    def __del__(self):
+        pass
+
+
+class FakeRGS(ValveControllerRGS):
+
+    def _initValveBanks(self, valve_param_list):
+        self.device = FakeUSB()
+
+    def __del__(self):
+        pass
+
+
+class FakeFT425R(ValveControllerFT425R):
+
+    def _initValveBanks(self, valve_param_list):
+        self.device = FakeUSB()
+
+
+class TestValvesState(unittest.TestCase):
+
+    def test_plrd1_writes_each_bank_once(self):
+        controller = FakePLRD1([[0, False, False, 'a'], [1, False, False, 'b'], [2, True, False, 'c'], [9, False, False, 'd']])
+        for device in controller.device.values():
+            device.writes.clear()
+        controller.setValvesState(open_list=['a', 'd'], close_list=['b', 'c'])
+        self.assertEqual(controller.device['A'].writes, [0b010])
+        self.assertEqual(controller.device['B'].writes, [0b00])
+        self.assertEqual(controller.device['C'].writes, [])
+        self.assertEqual([controller.valve_dict[v].getState() for v in 'abcd'], [False, True, True, False])
+
+    def test_plrd1_matches_single_valve_writes(self):
+        params = [[addr, addr % 3 == 0, False, f'v{addr}'] for addr in range(8)]
+        grouped, single = FakePLRD1(params), FakePLRD1(params)
+        grouped.setValvesState(open_list=['v1', 'v3'], close_list=['v0', 'v4', 'v6'])
+        for valve in ['v1', 'v3']:
+            single.setValveOpen(valve)
+        for valve in ['v0', 'v4', 'v6']:
+            single.setValveClose(valve)
+        self.assertEqual(grouped.device['A'].en, single.device['A'].en)
+
+    def test_rgs_sends_one_write(self):
+        controller = FakeRGS([[0, False, False, 'a'], [5, False, False, 'b']])
+        controller.device.writes.clear()
+        controller.setValvesState(open_list=['a'], close_list=['b'])
+        self.assertEqual(controller.device.writes, [b'L\x00H\x05'])
+
+    def test_ft425r_writes_each_valve(self):
+        controller = FakeFT425R([[0, False, False, 'a'], [5, True, False, 'b']])
+        controller.device.writes.clear()
+        controller.setValvesState(open_list=['a'], close_list=['b'])
+        self.assertEqual(controller.device.writes, [b'L\x00', b'L\x05'])
+        controller.setValvesOpen(['b'])
+        controller.setValvesClose(['a'])
+        self.assertEqual(controller.device.writes[2:], [b'H\x05', b'H\x00'])
+        self.assertEqual([controller.valve_dict[v].getState() for v in 'ab'], [True, False])
+
+    def test_unknown_valve_changes_nothing(self):
+        controller = FakeRGS([[0, False, False, 'a']])
+        controller.device.writes.clear()
+        with self.assertRaises(KeyError):
+            controller.setValvesState(open_list=['a', 'z'])
+        self.assertEqual(controller.device.writes, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from unittest import mock
+
+from simulation_case import SimulationTestCase
+
+
+class TestValveStates(SimulationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.states['out'] = 'open'
+
+    def test_target_state_is_diffed_and_applied_once(self):
+        target = {'in': 'open', 'out': 'closed', 'waste': 'closed'}
+        with mock.patch.object(self.ctrl.valve_model, 'setValves', wraps=self.ctrl.valve_model.setValves) as set_valves:
+            self.assertEqual(self.ctrl.valveStatesSet({'states': target}), {'open': ['in'], 'close': ['out']})
+        set_valves.assert_called_once_with(['in'], ['out'])
+        self.socketio.emit.assert_called_once_with('state', self.ctrl.valve_model.stateDelta(self.seq))
+        self.assertEqual(self.states['in'], 'open')
+        self.assertEqual(self.states['out'], 'closed')
+
+    def test_invalid_target_changes_nothing(self):
+        self.assertIn('error', self.ctrl.valveStatesSet({'states': {'in': 'open', 'inlet': 'open'}}))
+        self.assertIn('error', self.ctrl.valveStatesSet({'states': {'in': 'half'}}))
+        self.assertEqual(self.states['in'], 'closed')
+        self.socketio.emit.assert_not_called()
+
+    def test_rest_endpoint(self):
+        self.app.add_url_rule('/valveStates', view_func=self.ctrl.valveStates, methods=['GET', 'POST'])
+        client = self.app.test_client()
+        response = client.post('/valveStates', json={'states': {'in': 'open'}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['open'], ['in'])
+        self.assertEqual(client.get('/valveStates').get_json()['valve_states']['in'], 'open')
+        self.assertEqual(client.post('/valveStates', json={'states': ['in']}).status_code, 400)
+
+    def test_state_frames_encode_valves_as_bitmask(self):
+        valves = list(self.states)
+        snapshot = self.ctrl.stateSnapshot()
+        self.assertEqual(snapshot, {'v': 1, 'seq': self.seq, 'valves': valves, 'open': format(1 << valves.index('out'), 'x'),
+                                    'script': {'state': 'idle', 'line': 1, 'progress': None}})
+        self.ctrl.valveToggle({'valve': 'in'})
+        delta = self.socketio.emit.call_args.args[1]
+        bit = 1 << valves.index('in')
+        self.assertEqual(delta, {'v': 1, 'seq': self.seq + 1, 'base': self.seq, 'changed': format(bit, 'x'), 'open': format(bit, 'x')})
+
+    def test_reconnecting_client_receives_changes_since_its_state(self):
+        valves = list(self.states)
+        self.ctrl.valveToggle({'valve': 'in'})
+        self.ctrl.valveToggle({'valve': 'out'})
+        self.ctrl.valveToggle({'valve': 'in'})
+        self.ctrl.valve_model.scriptSet(state='running', line=3)
+        self.ctrl.valve_model.scriptSet(line=4)
+        bits = (1 << valves.index('in')) | (1 << valves.index('out'))
+        self.assertEqual(self.ctrl.stateSync({'seq': self.seq}),
+                         {'v': 1, 'seq': self.seq + 5, 'base': self.seq, 'changed': format(bits, 'x'), 'open': '0',
+                          'script': {'state': 'running', 'line': 4}})
+        self.assertEqual(self.ctrl.stateSync({'seq': self.seq + 4}),
+                         {'v': 1, 'seq': self.seq + 5, 'base': self.seq + 4, 'changed': '0', 'open': '0', 'script': {'line': 4}})
+        self.assertEqual(self.ctrl.stateSync({'seq': self.seq + 5})['changed'], '0')
+
+    def test_client_without_known_state_receives_snapshot(self):
+        self.assertIn('valves', self.ctrl.stateSync({'seq': -1}))
+        self.assertIn('valves', self.ctrl.stateSync({'seq': self.seq + 100}))
+        self.assertIn('valves', self.ctrl.stateSync({}))
+        self.ctrl.valve_model.driverSet()  # Config reloaded, valve order may differ
+        self.assertIn('valves', self.ctrl.stateSync({'seq': self.seq}))
+        self.ctrl.valve_model.history = type(self.ctrl.valve_model.history)(maxlen=1)
+        self.ctrl.valveToggle({'valve': 'in'})
+        self.ctrl.valveToggle({'valve': 'in'})
+        self.assertIn('valves', self.ctrl.stateSync({'seq': self.ctrl.valve_model.state_seq - 2}))
+        self.assertNotIn('valves', self.ctrl.stateSync({'seq': self.ctrl.valve_model.state_seq - 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()